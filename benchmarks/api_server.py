@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Compare the API servers under concurrent load. Start zd with "apiserver": {"type": "cherrypy"} or {"type": "asyncio"}
+in zd.json, then run e.g.:
+
+    python3 benchmarks/api_server.py --url http://localhost:3000 --user root --password toor --machine ubuntu
+
+Keep-alive clients request the machine list as fast as they can while followers hold log streams of a machine open,
+as e.g. a web ui showing consoles would. Results are printed as json.
+"""
+import json
+import base64
+import asyncio
+import argparse
+from time import time
+from urllib.parse import urlsplit
+
+
+class Client(object):
+    """
+    Minimal HTTP/1.1 client keeping its connection alive
+    """
+    def __init__(self, host, port, authorization):
+        self.host = host
+        self.port = port
+        self.authorization = authorization
+        self.reader = self.writer = None
+
+    async def request(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nAuthorization: {}\r\n\r\n"
+                          .format(path, self.host, self.authorization).encode())
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ")[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        await self.reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def follow(host, port, authorization, machine, stop):
+    """
+    Hold a log stream open until stop is set
+    """
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write("GET /api/v1/machine/{}/log?follow=1&tail=0 HTTP/1.1\r\nHost: {}\r\nAuthorization: {}\r\n\r\n"
+                     .format(machine, host, authorization).encode())
+        while not stop.is_set():
+            try:
+                if not await asyncio.wait_for(reader.read(65536), 0.5):
+                    return
+            except asyncio.TimeoutError:
+                pass
+        writer.close()
+    except OSError:
+        pass
+
+
+async def load(client, deadline, latencies, errors):
+    while time() < deadline:
+        started = time()
+        try:
+            status = await asyncio.wait_for(client.request("/api/v1/machine/"), 10)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            client.close()
+            errors.append("connection")
+            continue
+        if status == 200:
+            latencies.append(time() - started)
+        else:
+            errors.append(status)
+    client.close()
+
+
+def percentile(values, fraction):
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3) if values else None
+
+
+async def benchmark(args):
+    url = urlsplit(args.url)
+    authorization = "Basic " + base64.b64encode("{}:{}".format(args.user, args.password).encode()).decode()
+    stop = asyncio.Event()
+    followers = [asyncio.ensure_future(follow(url.hostname, url.port or 80, authorization, args.machine, stop))
+                 for _ in range(args.followers if args.machine else 0)]
+    await asyncio.sleep(1)
+
+    latencies, errors = [], []
+    started = time()
+    deadline = started + args.duration
+    await asyncio.gather(*[load(Client(url.hostname, url.port or 80, authorization), deadline, latencies, errors)
+                           for _ in range(args.concurrency)])
+    elapsed = time() - started
+    stop.set()
+    await asyncio.gather(*followers)
+
+    latencies.sort()
+    return {"url": args.url,
+            "concurrency": args.concurrency,
+            "followers": len(followers),
+            "duration": round(elapsed, 3),
+            "requests": len(latencies),
+            "errors": len(errors),
+            "requests_per_second": round(len(latencies) / elapsed, 1),
+            "latency_ms": {"p50": percentile(latencies, 0.5),
+                           "p90": percentile(latencies, 0.9),
+                           "p99": percentile(latencies, 0.99),
+                           "max": percentile(latencies, 1)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API server benchmark")
+    parser.add_argument("--url", default="http://localhost:3000", help="zd API address")
+    parser.add_argument("--user", default="", help="API user")
+    parser.add_argument("--password", default="", help="API password")
+    parser.add_argument("--concurrency", type=int, default=50, help="keep-alive clients issuing requests")
+    parser.add_argument("--followers", type=int, default=0, help="log streams held open meanwhile")
+    parser.add_argument("--machine", help="machine whose log the followers stream")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(benchmark(args)), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Load test of API authentication. Runs a zd daemon with each API server against the stand-in binaries in
+benchmarks/bin and has many distinct clients call it, each on a new connection without cookies: a third get a token of
+their own and use it, a third send basic credentials and a third send junk. The daemon's memory is sampled after each
+batch of clients. Exits with status 1 if it grew by more than --max-growth MiB after the first batch, which warms the
+daemon up, if a response set a cookie, or if a client was not answered as its credentials deserve, e.g.:
+
+    python3 benchmarks/auth_load.py --clients 10000 --max-growth 5
+"""
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import argparse
+import tempfile
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+from run import Daemon, USER, PASSWORD
+
+
+BASIC = "Basic " + base64.b64encode("{}:{}".format(USER, PASSWORD).encode()).decode()
+
+
+def get_rss(pid):
+    """
+    Return the resident memory of a process in MiB
+    """
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def send(port, method, path, authorization):
+    """
+    Send a request on a new connection and return its status, body and whether it set a cookie
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request(method, path, body=b"" if method == "POST" else None, headers={"Authorization": authorization})
+        response = conn.getresponse()
+        return response.status, response.read(), response.getheader("Set-Cookie") is not None
+    finally:
+        conn.close()
+
+
+def run_client(port, number):
+    """
+    Act as one distinct client and return the problems found
+    """
+    try:
+        return check_client(port, number)
+    except (OSError, http.client.HTTPException) as e:
+        return ["client {}: {}".format(number, e)]
+
+
+def check_client(port, number):
+    kind = ("token", "basic", "junk")[number % 3]
+    cookie = False
+    if kind == "token":
+        status, body, cookie = send(port, "POST", "/api/v1/auth/token", BASIC)
+        if status != 200:
+            return ["token {}: issuing answered {}".format(number, status)]
+        authorization = "Bearer " + json.loads(body)["token"]
+        expected = 200
+    elif kind == "basic":
+        authorization, expected = BASIC, 200
+    else:
+        authorization = "Basic " + base64.b64encode("client{}:wrong".format(number).encode()).decode()
+        expected = 401
+    problems = ["{} {}: a response set a cookie".format(kind, number)] if cookie else []
+    status, _, cookie = send(port, "GET", "/api/v1/machine/?summary=1", authorization)
+    if status != expected:
+        problems.append("{} {}: answered {} instead of {}".format(kind, number, status, expected))
+    if cookie:
+        problems.append("{} {}: a response set a cookie".format(kind, number))
+    return problems
+
+
+def load(args, daemon):
+    """
+    Send the clients in batches and return the daemon's memory after each, the request rate and the problems found
+    """
+    samples = [round(get_rss(daemon.proc.pid), 1)]
+    problems = []
+    started = time.time()
+    batch = args.clients // args.batches
+    with ThreadPoolExecutor(args.workers) as pool:
+        for i in range(args.batches):
+            for found in pool.map(run_client, [daemon.port] * batch, range(i * batch, (i + 1) * batch)):
+                problems += found
+            samples.append(round(get_rss(daemon.proc.pid), 1))
+    elapsed = time.time() - started
+    return samples, round(batch * args.batches / elapsed, 1), problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zd API authentication load test")
+    parser.add_argument("--clients", type=int, default=6000, help="distinct clients per API server")
+    parser.add_argument("--batches", type=int, default=6, help="batches the clients are sent in, memory is sampled "
+                                                               "after each")
+    parser.add_argument("--workers", type=int, default=16, help="clients connected at once")
+    parser.add_argument("--max-growth", type=float, default=5, help="MiB the daemon may grow by after the first batch")
+    parser.add_argument("--apiservers", default="cherrypy,asyncio", help="API servers to load")
+    parser.add_argument("--port", type=int, default=3099, help="API port of the daemons")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory and daemon logs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="zd-auth-")
+    results, problems = [], []
+    try:
+        for apiserver in args.apiservers.split(","):
+            print("Loading the {} API server...".format(apiserver), file=sys.stderr)
+            daemon = Daemon(os.path.join(workdir, apiserver), args.port, apiserver=apiserver)
+            daemon.write_machines(10)
+            daemon.start()
+            try:
+                daemon.wait_ready()
+                samples, request_rate, found = load(args, daemon)
+            finally:
+                daemon.stop()
+            growth = round(samples[-1] - samples[1], 1)
+            if growth > args.max_growth:
+                found.append("{} grew by {} MiB after the first batch, more than {} MiB".format(
+                    apiserver, growth, args.max_growth))
+            results.append({"apiserver": apiserver, "clients": args.clients // args.batches * args.batches,
+                            "rss_mib": samples, "growth_mib": growth, "clients_per_second": request_rate,
+                            "problems": len(found)})
+            problems += ["{}: {}".format(apiserver, problem) for problem in found]
+    finally:
+        if args.keep:
+            print("Scratch directory kept at {}".format(workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=4))
+    for problem in problems[:50]:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
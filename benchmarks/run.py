@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of the zd daemon. Each scenario runs a real daemon against the stand-in qemu, qemu-img, virtiofsd
+and docker executables in benchmarks/bin, so no virtualization is needed. Results are written as json, e.g.:
+
+    python3 benchmarks/run.py --output results/$(git rev-parse --short HEAD).json
+    python3 benchmarks/run.py --scenarios cold_start,shutdown --machines 50 --state-files 1000,10000
+"""
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from argparse import Namespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from zhypervisor import __version__  # NOQA
+from zhypervisor.client import ZClient  # NOQA
+from api_server import benchmark as api_benchmark  # NOQA
+
+
+USER, PASSWORD = "bench", "bench"
+
+
+class Daemon(object):
+    """
+    A zd daemon running in a scratch directory with the fake binaries on its PATH
+    """
+    def __init__(self, workdir, port, apiserver="cherrypy"):
+        self.workdir = workdir
+        self.port = port
+        self.datastore = os.path.join(workdir, "datastore")
+        self.config_path = os.path.join(workdir, "zd.json")
+        self.config = {"nodename": "bench",
+                       "access": [[USER, PASSWORD, 0]],
+                       "apiport": port,
+                       "apiserver": {"type": apiserver},
+                       "datastores": {"default": {"path": self.datastore, "init": True}},
+                       "metrics": {"interval": 3600},
+                       "logging": {"level": "WARNING", "format": "text", "levels": {"cherrypy": "WARNING"}},
+                       "shutdown": {"machine_timeout": 30, "timeout": 120}}
+        self.proc = None
+        self.client = ZClient("http://127.0.0.1:{}".format(port), USER, PASSWORD, connections=32)
+
+    def write_machines(self, count, machine_type="q", autostart=False, prefix="m"):
+        """
+        Write machine state files directly, as a daemon that has been managing them would have
+        """
+        directory = os.path.join(self.datastore, "machines")
+        os.makedirs(directory, exist_ok=True)
+        machine_ids = []
+        for i in range(count):
+            machine_id = "{}{}".format(prefix, i)
+            with open(os.path.join(directory, machine_id + ".json"), "w") as f:
+                json.dump({"machine_id": machine_id, "properties": machine_properties(machine_type, autostart)}, f)
+            machine_ids.append(machine_id)
+        return machine_ids
+
+    def start(self):
+        os.makedirs(self.workdir, exist_ok=True)
+        with open(self.config_path, "w") as f:
+            json.dump(self.config, f)
+        env = dict(os.environ, PATH=os.path.join(HERE, "bin") + os.pathsep + os.environ["PATH"], PYTHONPATH=ROOT,
+                   FAKE_DOCKER_STATE=os.path.join(self.workdir, "docker"))
+        self.log = open(os.path.join(self.workdir, "zd.log"), "ab")
+        started = time.time()
+        self.proc = subprocess.Popen([sys.executable, "-c", "from zhypervisor.daemon import main; main()",
+                                      "-c", self.config_path], env=env, stdout=self.log, stderr=self.log)
+        return started
+
+    def wait_ready(self, timeout=600):
+        """
+        Wait until the API answers and return when it first did
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise Exception("zd exited with {}, see {}".format(self.proc.returncode, self.log.name))
+            try:
+                self.client.request("GET", "/")
+                return time.time()
+            except OSError:
+                time.sleep(0.02)
+        raise Exception("zd did not answer within {}s".format(timeout))
+
+    def wait_status(self, machine_ids, status, timeout=600):
+        """
+        Wait until all the machines have the status and return when they did
+        """
+        machine_ids = set(machine_ids)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            statuses = {machine["machine_id"]: machine["_status"]
+                        for machine in self.client.get_machines(summary=True)}
+            if all(statuses.get(machine_id) == status for machine_id in machine_ids):
+                return time.time()
+            time.sleep(0.05)
+        raise Exception("machines did not become {} within {}s".format(status, timeout))
+
+    def rss_bytes(self):
+        with open("/proc/{}/status".format(self.proc.pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+
+    def stop(self, timeout=600):
+        """
+        Stop the daemon as an init system would and return when it exited
+        """
+        self.client.close()
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+            raise Exception("zd did not exit within {}s".format(timeout))
+        finally:
+            self.log.close()
+        return time.time()
+
+
+def machine_properties(machine_type, autostart=False):
+    if machine_type == "docker":
+        return {"type": "docker", "image": "busybox", "cmd": "sleep 1000000", "autostart": autostart}
+    return {"type": "q", "mem": 64, "autostart": autostart}
+
+
+def count_processes(workdir):
+    """
+    Return the number of fake machine processes of a scenario still running
+    """
+    count = 0
+    for pid in os.listdir("/proc"):
+        try:
+            with open("/proc/{}/cmdline".format(pid), "rb") as f:
+                cmdline = f.read()
+            with open("/proc/{}/environ".format(pid), "rb") as f:
+                environ = f.read()
+        except (OSError, ValueError):
+            continue
+        if os.path.join(HERE, "bin").encode() in cmdline and \
+                (workdir.encode() in cmdline or workdir.encode() in environ):
+            count += 1
+    return count
+
+
+def rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def scenario_cold_start(args, workdir):
+    """
+    Time from launching the daemon until its API answers, with many stopped machines in its state
+    """
+    results = []
+    for count in args.state_files:
+        daemon = Daemon(os.path.join(workdir, str(count)), args.port)
+        daemon.write_machines(count)
+        started = daemon.start()
+        ready = daemon.wait_ready()
+        rss = daemon.rss_bytes()
+        listed = time.time()
+        daemon.client.get_machines()
+        listed = time.time() - listed
+        daemon.stop()
+        results.append({"state_files": count, "seconds": round(ready - started, 3), "rss_bytes": rss,
+                        "list_seconds": round(listed, 3)})
+    return results
+
+
+def scenario_autostart(args, workdir):
+    """
+    Time from launching the daemon until all autostarted machines are running
+    """
+    results = []
+    for machine_type in args.types:
+        daemon = Daemon(os.path.join(workdir, machine_type), args.port)
+        machine_ids = daemon.write_machines(args.machines, machine_type=machine_type, autostart=True)
+        started = daemon.start()
+        ready = daemon.wait_ready()
+        running = daemon.wait_status(machine_ids, "running")
+        daemon.stop()
+        results.append({"type": machine_type, "machines": args.machines, "api_ready_seconds": round(ready - started, 3),
+                        "all_running_seconds": round(running - started, 3),
+                        "machines_per_second": rate(args.machines, running - started)})
+    return results
+
+
+def scenario_api_latency(args, workdir):
+    """
+    Latency percentiles of listing machines under concurrent keep-alive clients, per API server
+    """
+    results = []
+    for apiserver in args.apiservers:
+        daemon = Daemon(os.path.join(workdir, apiserver), args.port, apiserver=apiserver)
+        daemon.write_machines(args.machines)
+        daemon.start()
+        daemon.wait_ready()
+        for concurrency in args.concurrency:
+            result = asyncio.run(api_benchmark(Namespace(url="http://127.0.0.1:{}".format(args.port), user=USER,
+                                                         password=PASSWORD, concurrency=concurrency, followers=0,
+                                                         machine=None, duration=args.duration)))
+            del result["url"]
+            result["apiserver"] = apiserver
+            results.append(result)
+        daemon.stop()
+    return results
+
+
+def scenario_bulk(args, workdir):
+    """
+    Start then stop many machines through the API at once
+    """
+    results = []
+    for machine_type in args.types:
+        daemon = Daemon(os.path.join(workdir, machine_type), args.port)
+        machine_ids = daemon.write_machines(args.machines, machine_type=machine_type)
+        daemon.start()
+        daemon.wait_ready()
+        started = time.time()
+        errors = [e for e in daemon.client.start_machines(machine_ids).values() if isinstance(e, Exception)]
+        running = daemon.wait_status(machine_ids, "running")
+        stopping = time.time()
+        errors += [e for e in daemon.client.stop_machines(machine_ids).values() if isinstance(e, Exception)]
+        stopped = daemon.wait_status(machine_ids, "stopped")
+        daemon.stop()
+        results.append({"type": machine_type, "machines": args.machines, "errors": len(errors),
+                        "start_seconds": round(running - started, 3),
+                        "starts_per_second": rate(args.machines, running - started),
+                        "stop_seconds": round(stopped - stopping, 3),
+                        "stops_per_second": rate(args.machines, stopped - stopping)})
+    return results
+
+
+def scenario_disks(args, workdir):
+    """
+    Create then delete many disks through the API at once
+    """
+    daemon = Daemon(workdir, args.port)
+    daemon.start()
+    daemon.wait_ready()
+    disk_ids = ["d{}.bin".format(i) for i in range(args.machines)]
+    spec = {"type": "qdisk", "datastore": "default", "size": 1024, "fmt": "qcow2"}
+    started = time.time()
+    errors = [e for e in daemon.client.fan_out(daemon.client.put_disk, disk_ids, spec).values()
+              if isinstance(e, Exception)]
+    created = time.time()
+    errors += [e for e in daemon.client.fan_out(daemon.client.delete_disk, disk_ids).values()
+               if isinstance(e, Exception)]
+    deleted = time.time()
+    daemon.stop()
+    return [{"disks": len(disk_ids), "errors": len(errors), "create_seconds": round(created - started, 3),
+             "delete_seconds": round(deleted - created, 3)}]
+
+
+def scenario_shutdown(args, workdir):
+    """
+    Time from signalling the daemon until it exited, having stopped all its running machines
+    """
+    results = []
+    for machine_type in args.types:
+        daemon = Daemon(os.path.join(workdir, machine_type), args.port)
+        machine_ids = daemon.write_machines(args.machines, machine_type=machine_type, autostart=True)
+        daemon.start()
+        daemon.wait_ready()
+        daemon.wait_status(machine_ids, "running")
+        started = time.time()
+        exited = daemon.stop()
+        results.append({"type": machine_type, "machines": args.machines, "seconds": round(exited - started, 3),
+                        "leftover_processes": count_processes(daemon.workdir)})
+    return results
+
+
+SCENARIOS = {"cold_start": scenario_cold_start,
+             "autostart": scenario_autostart,
+             "api_latency": scenario_api_latency,
+             "bulk": scenario_bulk,
+             "disks": scenario_disks,
+             "shutdown": scenario_shutdown}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "-C", ROOT, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    def int_list(value):
+        return [int(i) for i in value.split(",")]
+
+    parser = argparse.ArgumentParser(description="zd end-to-end benchmarks")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument("--machines", type=int, default=100, help="machines started by the process scenarios")
+    parser.add_argument("--state-files", type=int_list, default=[1000, 10000], help="machine counts for cold_start")
+    parser.add_argument("--types", default="q,docker", help="machine types for autostart, bulk and shutdown")
+    parser.add_argument("--apiservers", default="cherrypy,asyncio", help="API servers for api_latency")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 16, 64], help="client counts for api_latency")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per api_latency run")
+    parser.add_argument("--port", type=int, default=3099, help="API port of the daemons")
+    parser.add_argument("--output", help="file to write results to instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory and daemon logs")
+    args = parser.parse_args()
+    args.types = args.types.split(",")
+    args.apiservers = args.apiservers.split(",")
+
+    report = {"version": __version__,
+              "revision": git_revision(),
+              "python": platform.python_version(),
+              "cpus": os.cpu_count(),
+              "time": time.time(),
+              "results": {}}
+    workdir = tempfile.mkdtemp(prefix="zd-bench-")
+    try:
+        for name in args.scenarios.split(","):
+            print("Running {}...".format(name), file=sys.stderr)
+            report["results"][name] = SCENARIOS[name](args, os.path.join(workdir, name))
+    finally:
+        if args.keep:
+            print("Scratch directory kept at {}".format(workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
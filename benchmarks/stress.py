@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Stress test of the machine lifecycle. Runs zd daemons against the stand-in binaries in benchmarks/bin and hammers
+machines with concurrent start, stop and restart requests while their processes are killed behind zd's back to force
+respawns. Half the workers pile onto a single machine, the others spread over all of them. Each round ends by either
+stopping every machine through the API or signalling the daemon in the middle of the load. Exits with status 1 if a
+request failed with anything but a conflict, a machine was left in an unsettled state, a machine's status disagreed with
+its processes, or processes were left behind, e.g.:
+
+    python3 benchmarks/stress.py --machines 20 --workers 16 --duration 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import argparse
+import tempfile
+import threading
+
+from run import Daemon, count_processes, machine_properties, HERE
+from zhypervisor.client import ZClientError
+
+
+def machine_pids(workdir, machine_id):
+    """
+    Return the pids of the stand-in processes running a machine: qemu listening on the machine's QMP socket, or the
+    foreground docker run of its container
+    """
+    qmp = "/{}.qmp,".format(machine_id).encode()
+    pids = []
+    for pid in os.listdir("/proc"):
+        try:
+            with open("/proc/{}/cmdline".format(pid), "rb") as f:
+                args = f.read().split(b"\0")
+            with open("/proc/{}/environ".format(pid), "rb") as f:
+                environ = f.read()
+        except (OSError, ValueError):
+            continue
+        if not any(os.path.join(HERE, "bin").encode() in arg for arg in args) or \
+                not (any(workdir.encode() in arg for arg in args) or workdir.encode() in environ):
+            continue
+        named = any(args[i] == b"--name" and args[i + 1] == machine_id.encode() for i in range(len(args) - 1))
+        if named and b"run" in args or any(qmp in arg for arg in args):
+            pids.append(int(pid))
+    return pids
+
+
+class Hammer(object):
+    """
+    Worker threads sending random lifecycle operations until stopped
+    """
+    def __init__(self, daemon, machine_ids, workers):
+        self.daemon = daemon
+        self.machine_ids = machine_ids
+        self.workers = workers
+        self.done = threading.Event()
+        self.signalled = threading.Event()
+        self.counts = {}
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def operate(self, machine_id):
+        operation = random.choice(("start", "stop", "restart", "kill"))
+        if operation == "kill":
+            for pid in machine_pids(self.daemon.workdir, machine_id):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        else:
+            try:
+                getattr(self.daemon.client, operation + "_machine")(machine_id)
+            except Exception as e:
+                # Conflicts are expected from racing operations, and anything goes once the daemon was signalled
+                if not (isinstance(e, ZClientError) and e.status == 409 or self.signalled.is_set()):
+                    with self.lock:
+                        self.failures.append("{} {}: {}".format(operation, machine_id, e))
+                operation = "conflict"
+        with self.lock:
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+
+    def work(self, single):
+        while not self.done.is_set():
+            self.operate(self.machine_ids[0] if single else random.choice(self.machine_ids))
+            time.sleep(random.random() * 0.02)
+
+    def run(self, duration):
+        threads = [threading.Thread(target=self.work, args=[i % 2 == 0], daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        return threads
+
+    def stop(self, threads):
+        self.done.set()
+        for thread in threads:
+            thread.join()
+
+
+def wait_settled(daemon, timeout):
+    """
+    Wait for every machine to be running or stopped and return their statuses
+    """
+    deadline = time.time() + timeout
+    while True:
+        statuses = {machine["machine_id"]: machine["_status"] for machine in daemon.client.get_machines(summary=True)}
+        if all(status in ("running", "stopped") for status in statuses.values()) or time.time() > deadline:
+            return statuses
+        time.sleep(0.1)
+
+
+def stress_round(args, workdir, machine_type, signal_daemon):
+    """
+    Hammer the machines of a new daemon, then check the machines and processes it leaves. Returns the round's result
+    and the list of problems found.
+    """
+    daemon = Daemon(workdir, args.port)
+    properties = dict(machine_properties(machine_type), respawn=True)
+    directory = os.path.join(daemon.datastore, "machines")
+    os.makedirs(directory)
+    machine_ids = ["s{}".format(i) for i in range(args.machines)]
+    for machine_id in machine_ids:
+        with open(os.path.join(directory, machine_id + ".json"), "w") as f:
+            json.dump({"machine_id": machine_id, "properties": properties}, f)
+    daemon.start()
+    daemon.wait_ready()
+    hammer = Hammer(daemon, machine_ids, args.workers)
+    threads = hammer.run(args.duration)
+    problems = []
+    if signal_daemon:
+        # The daemon must stop machines in every state, including ones being spawned at that moment
+        hammer.signalled.set()
+        daemon.stop()
+        hammer.stop(threads)
+    else:
+        hammer.stop(threads)
+        statuses = wait_settled(daemon, args.settle)
+        for machine_id, status in sorted(statuses.items()):
+            pids = machine_pids(workdir, machine_id)
+            if status not in ("running", "stopped"):
+                problems.append("{} is still {}".format(machine_id, status))
+            elif len(pids) != (1 if status == "running" else 0):
+                problems.append("{} is {} with processes {}".format(machine_id, status, pids))
+        errors = [e for e in daemon.client.stop_machines(machine_ids).values() if isinstance(e, Exception)]
+        problems += ["stop {}".format(e) for e in errors]
+        statuses = wait_settled(daemon, args.settle)
+        problems += ["{} is {} after being stopped".format(machine_id, status)
+                     for machine_id, status in sorted(statuses.items()) if status != "stopped"]
+        daemon.stop()
+    problems += hammer.failures
+    leftover = count_processes(workdir)
+    if leftover:
+        problems.append("{} processes left behind".format(leftover))
+    return {"type": machine_type, "machines": args.machines, "end": "signal" if signal_daemon else "stop",
+            "operations": hammer.counts, "leftover_processes": leftover, "problems": len(problems)}, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zd lifecycle stress test")
+    parser.add_argument("--machines", type=int, default=20, help="machines per daemon")
+    parser.add_argument("--workers", type=int, default=16, help="threads sending operations at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per round")
+    parser.add_argument("--rounds", type=int, default=1, help="rounds per machine type and way of ending them")
+    parser.add_argument("--settle", type=float, default=30, help="seconds machines get to settle after the load")
+    parser.add_argument("--types", default="q,docker", help="machine types to stress")
+    parser.add_argument("--port", type=int, default=3098, help="API port of the daemons")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory and daemon logs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="zd-stress-")
+    results, problems = [], []
+    try:
+        for round_number in range(args.rounds):
+            for machine_type in args.types.split(","):
+                for signal_daemon in (False, True):
+                    print("Stressing {} machines, ending with {}...".format(
+                        machine_type, "a signal" if signal_daemon else "a stop"), file=sys.stderr)
+                    name = "{}-{}-{}".format(machine_type, round_number, "signal" if signal_daemon else "stop")
+                    result, found = stress_round(args, os.path.join(workdir, name), machine_type, signal_daemon)
+                    results.append(result)
+                    problems += found
+    finally:
+        if args.keep:
+            print("Scratch directory kept at {}".format(workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=4))
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
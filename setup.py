@@ -12,5 +12,6 @@ setup(name='zhypervisor',
       author_email='dave@davepedu.com',
       packages=['zhypervisor', 'zhypervisor.clients', 'zhypervisor.api', 'zhypervisor.tools'],
       entry_points={'console_scripts': ['zd = zhypervisor.daemon:main',
+                                        'zctl = zhypervisor.client:main',
                                         'zd_ifup = zhypervisor.tools.ifup:main']},
       zip_safe=False)
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import pytest
+import subprocess
+
+from zhypervisor.client import ZClient
+from zhypervisor.daemon import ZHypervisorDaemon
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIN = os.path.join(ROOT, "benchmarks", "bin")  # stand-in qemu, qemu-img, docker and virtiofsd
+USER, PASSWORD = "test", "test"
+
+
+def write_state(workdir, name, machines, config):
+    """
+    Create a daemon's datastore with the given machines in it and return its zd.json
+    :param machines: mapping of machine id -> properties written to the state directory before the daemon starts
+    :param config: keys of zd.json, on top of the defaults
+    """
+    datastore = workdir / name / "datastore"
+    (datastore / "machines").mkdir(parents=True)
+    for machine_id, properties in (machines or {}).items():
+        with open(str(datastore / "machines" / (machine_id + ".json")), "w") as f:
+            json.dump({"machine_id": machine_id, "properties": properties}, f)
+    return dict({"nodename": name,
+                 "access": [[USER, PASSWORD, 0]],
+                 "datastores": {"default": {"path": str(datastore), "init": True}},
+                 "metrics": {"interval": 3600},
+                 "shutdown": {"machine_timeout": 10, "timeout": 30}}, **config)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def make_daemon(tmp_path, monkeypatch):
+    """
+    Factory of zd daemons running in the test's scratch directory against the stand-in binaries. Machines, the output
+    collector and health probes run as under zd, but the API is not served: requests are passed to its servers
+    directly. Daemons are stopped at the end of the test.
+    """
+    monkeypatch.setenv("PATH", BIN + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_DOCKER_STATE", str(tmp_path / "docker"))
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)}
+    daemons = []
+
+    def make(name="zd", machines=None, **config):
+        daemon = ZHypervisorDaemon(write_state(tmp_path, name, machines, config))
+        daemon.output.start()
+        daemon.health.start()
+        daemon.init_machines()
+        daemons.append(daemon)
+        return daemon
+
+    yield make
+
+    for daemon in daemons:
+        daemon.running = False
+        daemon.jobs.stop()
+        daemon.pool.stop()
+        daemon.stop_machines()
+        daemon.health.stop()
+        daemon.output.stop()
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+@pytest.fixture
+def start_daemon(tmp_path):
+    """
+    Factory of zd daemons run as processes serving their API on a free localhost port, for tests needing several nodes,
+    e.g. both ends of a migration. Each is returned as a ZClient of its API, and stopped with SIGINT at the end of the
+    test.
+    """
+    procs = []
+
+    def start(name, machines=None, **config):
+        config = write_state(tmp_path, name, machines, dict({"apiport": get_free_port()}, **config))
+        config_path = str(tmp_path / name / "zd.json")
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+        env = dict(os.environ, PATH=BIN + os.pathsep + os.environ["PATH"], PYTHONPATH=ROOT,
+                   FAKE_DOCKER_STATE=str(tmp_path / name / "docker"))
+        with open(str(tmp_path / name / "zd.log"), "ab") as log:
+            proc = subprocess.Popen([sys.executable, "-c", "from zhypervisor.daemon import main; main()",
+                                     "-c", config_path], env=env, stdout=log, stderr=log)
+        procs.append(proc)
+        client = ZClient("http://127.0.0.1:{}".format(config["apiport"]), USER, PASSWORD)
+        deadline = time.time() + 30
+        while True:
+            try:
+                client.request("GET", "/")
+                return client
+            except OSError:
+                if proc.poll() is not None or time.time() > deadline:
+                    raise Exception("zd {} did not come up, see {}".format(name, tmp_path / name / "zd.log"))
+                time.sleep(0.05)
+
+    yield start
+
+    for proc in procs:
+        proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
@@ -0,0 +1,128 @@
+"""
+Stand-ins for the daemon and machine processes, so machine logic can be tested without qemu, docker or a running zd
+"""
+import subprocess
+from time import time, sleep
+from itertools import count
+from threading import Event, Lock
+
+from zhypervisor.util import Machine, LaunchPlan
+from zhypervisor.metrics import Instrumentation
+
+
+class FakeHealth(object):
+    def watch(self, machine_spec, proc):
+        pass
+
+
+class FakeMaster(object):
+    """
+    The parts of ZHypervisorDaemon machines use
+    """
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.stats = Instrumentation()
+        self.health = FakeHealth()
+        self.machines = {}
+        self.disks = {}
+        self.datastores = {}
+
+
+class FakeSpec(object):
+    """
+    MachineSpec holding any Machine class
+    """
+    def __init__(self, master, machine_id, properties, machine_type):
+        self.master = master
+        self.machine_id = machine_id
+        self.properties = properties
+        self.machine = machine_type(self)
+
+
+class FakeProcess(object):
+    """
+    Popen-like handle of a process that runs until it is told to exit
+    """
+    pids = count(1000000)
+
+    def __init__(self):
+        self.pid = next(self.pids)
+        self.returncode = None
+        self.exited = Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired("fake", timeout)
+        return self.returncode
+
+    def exit(self, returncode=0):
+        if self.returncode is None:
+            self.returncode = returncode
+            self.exited.set()
+
+    def kill(self):
+        self.exit(-9)
+
+    def terminate(self):
+        self.exit(-15)
+
+
+class FakeMachine(Machine):
+    """
+    Machine whose processes are FakeProcesses, exiting as soon as they are powered down. Respawn delays are short so
+    tests run quickly.
+    """
+    machine_type = "fake"
+    respawn_delay = 0.01
+    crashloop_threshold = 3
+    crashloop_window = 60
+    max_backoff = 0.08
+
+    def __init__(self, machine_spec):
+        super().__init__(machine_spec)
+        self.procs = []  # every process spawned, in order
+        self.states = []  # every state entered, in order
+        self.spawn_gate = None  # Event spawn() waits on before returning, if set
+        self.procs_lock = Lock()
+
+    def transition(self, state):
+        super().transition(state)
+        self.states.append(state)
+
+    def compile_plan(self):
+        return LaunchPlan(argv=("fake", self.spec.machine_id), disks=(), netifaces=())
+
+    def spawn(self, plan):
+        if self.spawn_gate is not None:
+            self.spawn_gate.wait()
+        proc = FakeProcess()
+        with self.procs_lock:
+            self.procs.append(proc)
+        return proc
+
+    def send_powerdown(self, proc):
+        proc.exit(0)
+
+    def running_procs(self):
+        with self.procs_lock:
+            return [proc for proc in self.procs if proc.poll() is None]
+
+
+def make_machine(properties=None, machine_type=FakeMachine, machine_id="m1", master=None):
+    master = master or FakeMaster()
+    spec = FakeSpec(master, machine_id, dict({"type": "fake"}, **(properties or {})), machine_type)
+    master.machines[machine_id] = spec
+    return spec.machine
+
+
+def wait_for(condition, timeout=5):
+    """
+    Wait until condition() is true, failing the test if it isn't within timeout seconds
+    """
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline, "timed out waiting for {}".format(condition)
+        sleep(0.005)
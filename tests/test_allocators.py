@@ -0,0 +1,127 @@
+import json
+import pytest
+from threading import Thread
+
+from zhypervisor.allocators import Allocator, AllocationError, MachineAllocators
+
+
+def test_released_values_are_handed_out_again_first():
+    allocator = Allocator("value", 10, 19)
+    values = [allocator.allocate("m{}".format(i)) for i in range(5)]
+    assert values == [10, 11, 12, 13, 14]
+    allocator.release("m3")
+    allocator.release("m1")
+    assert [allocator.allocate("n{}".format(i)) for i in range(3)] == [13, 11, 15]
+    assert allocator.get("n0") == 13
+    assert allocator.get("new") == 16
+
+
+def test_range_runs_out():
+    allocator = Allocator("value", 0, 2)
+    for owner in ("a", "b", "c"):
+        allocator.allocate(owner)
+    with pytest.raises(AllocationError, match="No free value left"):
+        allocator.allocate("d")
+    allocator.release("b")
+    assert allocator.allocate("d") == 1
+
+
+def test_reserved_values_are_skipped():
+    allocator = Allocator("value", 0, 9)
+    allocator.sync("a", [1, 3])
+    allocator.allocate("b")
+    allocator.release("a")
+    assert [allocator.allocate(owner) for owner in ("c", "d", "e", "f")] == [1, 2, 3, 4]
+    assert list(allocator.free) == []
+
+
+def test_sync_conflicts_change_nothing():
+    allocator = Allocator("value", 0, 9)
+    allocator.sync("a", [1, 2])
+    with pytest.raises(AllocationError, match="in use by a"):
+        allocator.sync("b", [3, 2])
+    assert allocator.held == {"a": {1, 2}}
+    allocator.sync("a", [2, 4])
+    assert allocator.owners == {2: "a", 4: "a"}
+
+
+def test_transfer():
+    allocator = Allocator("value", 0, 9)
+    allocator.allocate("instance")
+    allocator.allocate("machine")
+    allocator.transfer("instance", "machine")
+    assert allocator.held == {"machine": {0}}
+    assert allocator.allocate("other") == 1
+
+
+def test_bulk_claims_from_many_threads_never_collide():
+    allocator = Allocator("value", 0, 99999)
+    results = {}
+
+    def claim(worker):
+        for i in range(500):
+            owner = "w{}-{}".format(worker, i)
+            results[owner] = allocator.allocate(owner)
+            if i % 3 == 0:
+                allocator.release(owner)
+                del results[owner]
+
+    threads = [Thread(target=claim, args=(worker, )) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results.values())) == len(results)
+    assert {value: owner for owner, value in results.items()} == allocator.owners
+
+
+def test_serialize_round_trip():
+    allocator = Allocator("value", 0, 99)
+    for i in range(6):
+        allocator.allocate("m{}".format(i))
+    allocator.release("m2")
+    allocator.release("m4")
+    loaded = Allocator("value", 0, 99)
+    loaded.load(json.loads(json.dumps(allocator.serialize())))
+    assert loaded.owners == allocator.owners
+    assert loaded.held == allocator.held
+    assert [loaded.allocate(owner) for owner in ("a", "b", "c")] == [2, 4, 6]
+
+
+class FakeState(object):
+    def __init__(self):
+        self.saved = "{}"
+
+    def get_allocators(self):
+        return json.loads(self.saved)
+
+    def write_allocators(self, allocators):
+        self.saved = json.dumps(allocators)
+
+
+def test_assign_allocates_what_is_not_set():
+    allocators = MachineAllocators(FakeState())
+    properties = {"vnc": True, "netifaces": [{"type": "nic"}, {"type": "tap"},
+                                             {"type": "nic", "macaddr": "52:54:00:00:00:05"}]}
+    assigned = allocators.assign("m1", properties)
+    assert properties["vnc"] is True and "macaddr" not in properties["netifaces"][0]
+    assert assigned["vnc"] == 10
+    assert [iface.get("macaddr") for iface in assigned["netifaces"]] == ["52:54:00:00:00:00", None,
+                                                                         "52:54:00:00:00:05"]
+    with pytest.raises(AllocationError, match="52:54:00:00:00:05 is in use by m1"):
+        allocators.assign("m2", {"netifaces": [{"type": "nic", "macaddr": "52:54:00:00:00:05"}]})
+    assert "m2" not in allocators.mac.held
+
+
+def test_machine_allocators_round_trip(make_daemon):
+    daemon = make_daemon()
+    for i in range(3):
+        daemon.add_machine("m{}".format(i), {"type": "q", "vnc": True, "netifaces": [{"type": "nic"}]}, write=True)
+    daemon.allocators.tap.get("m0")
+    daemon.remove_machine("m1")
+    daemon.allocators.save()
+
+    loaded = MachineAllocators(daemon.state)
+    for name, allocator in daemon.allocators.allocators.items():
+        assert loaded.allocators[name].owners == allocator.owners
+    assert loaded.vnc.allocate("m3") == daemon.machines["m0"].properties["vnc"] + 1  # m1's display
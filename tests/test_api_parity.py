@@ -0,0 +1,159 @@
+"""
+The cherrypy and asyncio API servers must answer alike. A daemon is run with each server from the same state and sent
+the same requests in process: through cherrypy's WSGI application tree, and through AsyncApiServer.respond(). Status,
+content type and body of the responses are compared. Values that differ between any two daemons, such as timestamps,
+are left out. Errors are compared by status and message only, as cherrypy wraps the message in an html page.
+"""
+import io
+import re
+import sys
+import json
+import base64
+import cherrypy
+from time import sleep
+from urllib.parse import urlencode, urlsplit
+from cherrypy.lib.httputil import HeaderMap
+
+from tests.conftest import USER, PASSWORD
+
+
+AUTHORIZATION = "Basic " + base64.b64encode("{}:{}".format(USER, PASSWORD).encode()).decode()
+
+MACHINES = {"m{}".format(i): {"type": "q", "mem": 64} for i in range(3)}
+
+# Requests sent to both servers in order, as (method, path, form parameters, authenticated)
+REQUESTS = [
+    ("GET", "/", None, True),
+    ("GET", "/api/v1/machine/", None, False),
+    ("GET", "/api/v1/machine/", None, True),
+    ("GET", "/api/v1/machine/?summary=1", None, True),
+    ("GET", "/api/v1/machine/m0", None, True),
+    ("GET", "/api/v1/machine/nope", None, True),
+    ("PUT", "/api/v1/machine/p1", {"machine_spec": json.dumps({"type": "q", "mem": 64})}, True),
+    ("PUT", "/api/v1/machine/p2", {"machine_spec": json.dumps({"type": "q", "mem": "lots"})}, True),
+    ("PUT", "/api/v1/machine/p3", {"machine_spec": "{not json"}, True),
+    ("GET", "/api/v1/machine/p1", None, True),
+    ("GET", "/api/v1/machine/p1/property/mem", None, True),
+    ("PUT", "/api/v1/machine/p1/property/mem", {"value": "128"}, True),
+    ("GET", "/api/v1/machine/p1/start", None, True),
+    ("GET", "/api/v1/machine/p1/start", None, True),
+    ("GET", "/api/v1/machine/p1/log?tail=abc", None, True),
+    ("GET", "/api/v1/machine/p1/log?tail=1000", None, True),
+    ("GET", "/api/v1/machine/p1/stop", None, True),
+    ("GET", "/api/v1/machine/nope/start", None, True),
+    ("DELETE", "/api/v1/machine/p1", None, True),
+    ("GET", "/api/v1/disk/", None, True),
+    ("PUT", "/api/v1/disk/d1.bin", {"disk_spec": json.dumps({"type": "qdisk", "datastore": "default", "size": 64,
+                                                             "fmt": "qcow2"})}, True),
+    ("GET", "/api/v1/disk/d1.bin", None, True),
+    ("GET", "/api/v1/disk/nope", None, True),
+    ("DELETE", "/api/v1/disk/d1.bin", None, True),
+    ("GET", "/api/v1/job/", None, True),
+    ("GET", "/api/v1/job/nope", None, True),
+    ("GET", "/api/v1/template/", None, True),
+    ("GET", "/api/v1/admin/profile?seconds=abc", None, True),
+    ("GET", "/api/v1/nope", None, True),
+    ("POST", "/api/v1/machine/", None, True),
+]
+
+# Keys whose values depend on when a request was served rather than on what was asked
+VOLATILE_KEYS = ("_boot", "_health", "time", "started", "created", "finished", "updated", "uptime")
+
+
+def normalize(status, content_type, body):
+    """
+    Return a response as compared: json without volatile values, the message of errors, or the text of other bodies
+    """
+    text = body.decode("UTF-8", errors="replace")
+    if status >= 400:
+        if content_type == "text/html":
+            message = re.search(r"<p>(.*?)</p>", text, re.S)
+            text = message.group(1) if message else ""
+        # Tracebacks of 500s follow the message, in a <pre> for cherrypy
+        return status, text.split("\n\n")[0].strip()
+    if content_type.startswith("application/json"):
+        def strip(value):
+            if isinstance(value, dict):
+                return {key: strip(item) for key, item in value.items() if key not in VOLATILE_KEYS}
+            if isinstance(value, list):
+                return [strip(item) for item in value]
+            return value
+        return status, content_type, strip(json.loads(body))
+    return status, content_type, text.strip()
+
+
+def encode(params):
+    return urlencode(params).encode() if params is not None else b""
+
+
+def send_cherrypy(method, path, params, authenticated):
+    """
+    Serve a request with cherrypy's WSGI application tree, as its HTTP server would
+    """
+    url = urlsplit(path)
+    body = encode(params)
+    environ = {"REQUEST_METHOD": method, "SCRIPT_NAME": "", "PATH_INFO": url.path, "QUERY_STRING": url.query,
+               "SERVER_NAME": "127.0.0.1", "SERVER_PORT": "3000", "SERVER_PROTOCOL": "HTTP/1.1",
+               "REMOTE_ADDR": "127.0.0.1", "REMOTE_PORT": "50000", "CONTENT_LENGTH": str(len(body)),
+               "wsgi.version": (1, 0), "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(body),
+               "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+               "HTTP_HOST": "127.0.0.1:3000"}
+    if params is not None:
+        environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+    if authenticated:
+        environ["HTTP_AUTHORIZATION"] = AUTHORIZATION
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split()[0])
+        started["headers"] = dict(headers)
+
+    chunks = cherrypy.tree(environ, start_response)
+    try:
+        data = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return normalize(started["status"], started["headers"].get("Content-Type", "").split(";")[0], data)
+
+
+def send_asyncio(server, method, path, params, authenticated):
+    """
+    Serve a request with the asyncio server, from its parsed request line and headers on
+    """
+    body = encode(params)
+    headers = HeaderMap()
+    headers["Host"] = "127.0.0.1:3000"
+    if params is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    if authenticated:
+        headers["Authorization"] = AUTHORIZATION
+    response = server.loop.run_until_complete(server.respond(None, method, path, headers, body, True))
+    data = response.body.encode("UTF-8") if isinstance(response.body, str) else response.body or b""
+    return normalize(response.status, response.headers.get("Content-Type", "").split(";")[0], data)
+
+
+def run_requests(send):
+    responses = []
+    for request in REQUESTS:
+        responses.append(send(*request))
+        sleep(0.1)  # let machines started by a request settle before the next one
+    return responses
+
+
+def test_servers_answer_alike(make_daemon):
+    # Each daemon mounts its API on cherrypy's global tree, so they are run one after the other
+    make_daemon("cherrypy", machines=MACHINES, nodename="zd")
+    cherrypy_responses = run_requests(send_cherrypy)
+
+    server = make_daemon("asyncio", machines=MACHINES, nodename="zd", apiserver={"type": "asyncio"}).api
+    try:
+        asyncio_responses = run_requests(lambda *request: send_asyncio(server, *request))
+    finally:
+        server.executor.shutdown()
+        server.log_executor.shutdown()
+        server.loop.close()
+
+    differences = ["{} {}:\n    cherrypy: {}\n    asyncio:  {}".format(request[0], request[1], ours, theirs)
+                   for request, ours, theirs in zip(REQUESTS, cherrypy_responses, asyncio_responses) if ours != theirs]
+    assert not differences, "\n".join(differences)
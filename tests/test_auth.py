@@ -0,0 +1,106 @@
+import base64
+import pytest
+
+from zhypervisor.api import auth
+from zhypervisor.api.auth import Authenticator
+
+
+ACCESS = [["root", "toor", 0], ["other", "secret"]]
+
+
+def basic(username, password):
+    return "Basic " + base64.b64encode("{}:{}".format(username, password).encode()).decode()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Control the time seen by the authenticator
+    """
+    now = [1000000.0]
+    monkeypatch.setattr(auth, "time", lambda: now[0])
+    return now
+
+
+def test_basic_credentials():
+    authenticator = Authenticator(ACCESS)
+    assert authenticator.check(basic("root", "toor")) == "root"
+    assert authenticator.check(basic("other", "secret")) == "other"
+    assert authenticator.check(basic("root", "wrong")) is None
+    assert authenticator.check(basic("nobody", "toor")) is None
+    assert authenticator.check("Basic !!!") is None
+    assert authenticator.check("") is None
+
+
+def test_tokens_are_accepted_until_they_expire(clock):
+    authenticator = Authenticator(ACCESS, token_ttl=60)
+    token, expires = authenticator.issue_token("root")
+    assert expires == int(clock[0]) + 60
+    assert authenticator.check("Bearer " + token) == "root"
+    clock[0] += 59
+    assert authenticator.check("Bearer " + token) == "root"
+    clock[0] += 1
+    assert authenticator.check("Bearer " + token) is None
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda token: token.replace("root:", "other:", 1),
+    lambda token: token.replace(token.split(":")[1], str(int(token.split(":")[1]) + 3600), 1),
+    lambda token: token[:-1] + ("0" if token[-1] != "0" else "1"),
+    lambda token: token.rsplit(":", 1)[0],
+    lambda token: "root:never:" + token.rsplit(":", 1)[1],
+])
+def test_tampered_tokens_are_rejected(tamper):
+    authenticator = Authenticator(ACCESS)
+    token, _ = authenticator.issue_token("root")
+    assert authenticator.check("Bearer " + tamper(token)) is None
+
+
+def test_tokens_are_bound_to_the_secret_and_password():
+    authenticator = Authenticator(ACCESS, secret="s1")
+    token, _ = authenticator.issue_token("root")
+    assert Authenticator(ACCESS, secret="s1").check("Bearer " + token) == "root"
+    assert Authenticator(ACCESS, secret="s2").check("Bearer " + token) is None
+    assert Authenticator(ACCESS).check("Bearer " + token) is None
+    authenticator.configure([["root", "changed", 0]], secret="s1")
+    assert authenticator.check("Bearer " + token) is None
+
+
+def test_removed_users_are_rejected_at_once():
+    authenticator = Authenticator(ACCESS)
+    token, _ = authenticator.issue_token("other")
+    assert authenticator.check(basic("other", "secret")) == "other"
+    assert authenticator.check("Bearer " + token) == "other"
+    authenticator.configure([ACCESS[0]])
+    assert authenticator.check(basic("other", "secret")) is None
+    assert authenticator.check("Bearer " + token) is None
+
+
+def test_cache_holds_successful_checks_only_and_is_bounded():
+    authenticator = Authenticator(ACCESS, cache_size=3)
+    for i in range(100):
+        authenticator.check(basic("client{}".format(i), "wrong"))
+    assert len(authenticator.cache) == 0
+    headers = [basic("root", "toor"), basic("other", "secret"), "Bearer " + authenticator.issue_token("root")[0],
+               "Bearer " + authenticator.issue_token("other")[0]]
+    for header in headers[:3]:
+        authenticator.check(header)
+    assert list(authenticator.cache) == headers[:3]
+    authenticator.check(headers[0])  # now the most recently used
+    authenticator.check(headers[3])  # evicts the least recently used
+    assert list(authenticator.cache) == [headers[2], headers[0], headers[3]]
+
+
+def test_cached_basic_checks_expire(clock, monkeypatch):
+    authenticator = Authenticator(ACCESS, basic_ttl=60)
+    header = basic("root", "toor")
+    assert authenticator.check(header) == "root"
+    verified = []
+    verify = authenticator.verify
+    monkeypatch.setattr(authenticator, "verify", lambda header, now: verified.append(header) or verify(header, now))
+    clock[0] += 59
+    assert authenticator.check(header) == "root"
+    assert verified == []
+    clock[0] += 1
+    assert authenticator.check(header) == "root"
+    assert verified == [header]
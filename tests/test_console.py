@@ -0,0 +1,91 @@
+import os
+from time import time
+from threading import Thread
+
+from zhypervisor.console import RingBuffer, MachineLog
+from tests.fakes import wait_for
+
+
+def test_ring_buffer_reads_across_the_wraparound():
+    buffer = RingBuffer(8)
+    buffer.write(b"abcdef")
+    assert buffer.read(0) == (b"abcdef", 0)
+    buffer.write(b"ghij")
+    assert buffer.end == 10
+    assert buffer.read(2) == (b"cdefghij", 2)
+    assert buffer.read(5) == (b"fghij", 5)
+    assert buffer.read(10) == (b"", 10)
+
+
+def test_ring_buffer_skips_overwritten_output():
+    buffer = RingBuffer(8)
+    for chunk in (b"012", b"345", b"678", b"9ab"):
+        buffer.write(chunk)
+    assert buffer.read(0) == (b"456789ab", 4)
+
+
+def test_ring_buffer_keeps_the_end_of_an_oversized_write():
+    buffer = RingBuffer(8)
+    buffer.write(b"xyz")
+    buffer.write(b"0123456789abcdef")
+    assert buffer.end == 19
+    assert buffer.read(0) == (b"89abcdef", 11)
+    buffer.write(b"gh")
+    assert buffer.read(15) == (b"cdefgh", 15)
+
+
+def test_machine_log_tails_and_follows(tmp_path):
+    log = MachineLog(str(tmp_path / "m1.log"), buffer_size=16)
+    log.write(b"hello ")
+    log.write(b"world")
+    data, position = log.tail(5)
+    assert (data, position) == (b"world", 11)
+    assert log.wait(position, timeout=0.01) == (b"", 11)
+    log.write(b"!")
+    assert log.wait(position, timeout=0.01) == (b"!", 12)
+    log.flush()
+    with open(str(tmp_path / "m1.log"), "rb") as f:
+        assert f.read() == b"hello world!"
+
+
+def test_machine_log_rotates_its_file(tmp_path):
+    path = str(tmp_path / "m1.log")
+    log = MachineLog(path, max_bytes=10, backups=2)
+    for chunk in (b"aaaaaaaa", b"bbbbbbbb", b"cccccccc", b"dddddddd"):
+        log.write(chunk)
+        log.flush()
+    with open(path, "rb") as f:
+        assert f.read() == b"dddddddd"
+    with open(path + ".1", "rb") as f:
+        assert f.read() == b"cccccccc"
+    assert os.path.exists(path + ".2")
+    assert not os.path.exists(path + ".3")
+    log.delete()
+    assert not os.path.exists(path) and not os.path.exists(path + ".1")
+
+
+def test_machine_log_leaves_out_what_its_file_falls_behind_on(tmp_path):
+    log = MachineLog(str(tmp_path / "m1.log"), queue_size=8)
+    with log.file_lock:  # as a log file on stalled storage would
+        log.write(b"1234")
+        wait_for(lambda: log.queued == 0)  # the writer thread took the first chunk and waits for the file
+        for chunk in (b"5678", b"abcd", b"efgh", b"ijkl"):
+            log.write(chunk)
+        assert log.tail(20) == (b"12345678abcdefghijkl", 20)
+    log.flush()
+    with open(str(tmp_path / "m1.log"), "rb") as f:
+        assert f.read() == b"12345678abcd\n[zd: 8 bytes of output left out, the log file fell behind]\n"
+
+
+def test_cherrypy_follow_ends_after_the_timeout(make_daemon):
+    daemon = make_daemon(machines={"m1": {"type": "q", "mem": 16}}, apiserver={"follow_timeout": 0.5})
+    chunks = []
+    started = time()
+    follower = Thread(target=lambda: chunks.extend(daemon.api.app_v1.machine.log.GET("m1", tail=0, follow="true")))
+    follower.start()
+    follower.join(5)
+    ended = time()
+    daemon.running = False  # ends the stream if the timeout did not
+    follower.join()
+    assert 0.5 <= ended - started < 5
+    assert chunks == [b""]
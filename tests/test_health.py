@@ -0,0 +1,100 @@
+import socket
+import pytest
+
+from zhypervisor.health import TimerWheel, HealthMonitor
+from tests.fakes import FakeMaster, FakeProcess, make_machine, wait_for
+
+
+def advance(wheel, ticks):
+    """
+    Advance the wheel and return the items that expired on each tick, by tick number
+    """
+    expired = {}
+    for _ in range(ticks):
+        items = wheel.advance()
+        if items:
+            expired[wheel.now] = items
+    return expired
+
+
+def test_timer_wheel_expires_items_on_their_tick():
+    wheel = TimerWheel(tick=0.5, slots=8)
+    wheel.schedule(1, "a")
+    wheel.schedule(1.2, "b")
+    wheel.schedule(0, "c")  # at least one tick out
+    wheel.schedule(1, "d")
+    assert advance(wheel, 4) == {1: ["c"], 2: ["a", "d"], 3: ["b"]}
+
+
+def test_timer_wheel_keeps_items_beyond_one_turn():
+    wheel = TimerWheel(tick=1, slots=4)
+    wheel.schedule(2, "near")
+    wheel.schedule(6, "far")  # lands in the same slot, one turn later
+    wheel.schedule(13, "farther")
+    assert advance(wheel, 20) == {2: ["near"], 6: ["far"], 13: ["farther"]}
+    assert all(slot == [] for slot in wheel.slots)
+
+
+def test_timer_wheel_schedules_from_the_current_tick():
+    wheel = TimerWheel(tick=1, slots=4)
+    advance(wheel, 10)
+    wheel.schedule(3, "item")
+    assert advance(wheel, 4) == {13: ["item"]}
+
+
+@pytest.fixture
+def listener():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        yield sock.getsockname()[1]
+
+
+@pytest.fixture
+def monitor():
+    monitor = HealthMonitor(FakeMaster(), tick=0.01)
+    monitor.start()
+    yield monitor
+    monitor.stop()
+
+
+def test_probes_of_a_replaced_process_are_dropped(monitor, listener):
+    machine = make_machine({"probes": [{"type": "tcp", "port": listener, "delay": 0.01, "interval": 0.01}]},
+                           master=monitor.master)
+    machine.proc = FakeProcess()
+    monitor.watch(machine.spec, machine.proc)
+    old = monitor.machines["m1"][0]
+    wait_for(lambda: old.last_check is not None)
+
+    machine.proc = FakeProcess()
+    monitor.watch(machine.spec, machine.proc)
+    new = monitor.machines["m1"][0]
+    wait_for(lambda: new.last_check is not None)
+    checked = old.last_check
+    wait_for(lambda: all(state is not old for slot in monitor.wheel.slots for _, state in slot))
+    assert old.last_check == checked
+    assert new.is_healthy()
+
+
+def test_failing_probe_makes_the_machine_unhealthy(monitor):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]  # nothing listens on it
+    machine = make_machine({"probes": [{"type": "tcp", "port": port, "delay": 0.01, "interval": 0.01,
+                                        "failures": 2}]}, master=monitor.master)
+    machine.proc = FakeProcess()
+    monitor.watch(machine.spec, machine.proc)
+    state = monitor.machines["m1"][0]
+    wait_for(lambda: not state.is_healthy())
+    assert state.last_error
+
+
+def test_watch_after_stop_is_ignored():
+    monitor = HealthMonitor(FakeMaster(), tick=0.01)
+    monitor.start()
+    monitor.stop()
+    assert monitor.loop.is_closed()
+    machine = make_machine({"probes": [{"type": "tcp", "port": 1}]}, master=monitor.master)
+    machine.proc = FakeProcess()
+    monitor.watch(machine.spec, machine.proc)
+    assert "m1" not in monitor.machines
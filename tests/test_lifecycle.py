@@ -0,0 +1,197 @@
+import random
+import pytest
+from time import time, sleep
+from threading import Thread, Event
+
+from zhypervisor.util import MachineState, TRANSITIONS, InvalidTransition
+from tests.fakes import make_machine, wait_for
+
+
+def test_transitions_cover_every_state():
+    states = {value for name, value in vars(MachineState).items() if not name.startswith("_")}
+    assert set(TRANSITIONS) == states
+    for targets in TRANSITIONS.values():
+        assert targets <= states
+
+
+@pytest.mark.parametrize("source,target", [(source, target) for source in TRANSITIONS for target in TRANSITIONS
+                                           if target not in TRANSITIONS[source]])
+def test_invalid_transitions_raise(source, target):
+    machine = make_machine()
+    machine.state = source
+    with machine.state_lock:
+        with pytest.raises(InvalidTransition):
+            machine.transition(target)
+    assert machine.state == source
+
+
+def test_start_and_stop():
+    machine = make_machine()
+    machine.start_machine()
+    assert machine.get_status() == MachineState.RUNNING
+    assert len(machine.running_procs()) == 1
+    machine.stop_machine()
+    assert machine.get_status() == MachineState.STOPPED
+    assert machine.running_procs() == []
+    assert machine.states == [MachineState.STARTING, MachineState.RUNNING, MachineState.STOPPING,
+                              MachineState.STOPPED]
+
+
+def test_start_twice_conflicts():
+    machine = make_machine()
+    machine.start_machine()
+    with pytest.raises(InvalidTransition):
+        machine.start_machine()
+    assert len(machine.procs) == 1
+    machine.stop_machine()
+
+
+def test_exit_without_respawn_stops():
+    machine = make_machine()
+    machine.start_machine()
+    machine.procs[0].exit(1)
+    assert machine.wait_stopped(5)
+    sleep(machine.respawn_delay * 5)
+    assert len(machine.procs) == 1
+
+
+def test_unexpected_exit_respawns():
+    machine = make_machine({"respawn": True})
+    machine.start_machine()
+    machine.procs[0].exit(1)
+    wait_for(lambda: len(machine.procs) == 2 and machine.get_status() == MachineState.RUNNING)
+    assert machine.boot["kind"] == "respawn"
+    machine.stop_machine()
+    assert machine.running_procs() == []
+
+
+def crash(machine, times):
+    """
+    Make the machine's process exit unexpectedly, waiting for each respawn
+    """
+    for _ in range(times):
+        spawned = len(machine.procs)
+        wait_for(lambda: machine.get_status() == MachineState.RUNNING)
+        machine.procs[-1].exit(1)
+        wait_for(lambda: len(machine.procs) > spawned)
+
+
+def test_crashloop_backoff_doubles_up_to_the_maximum():
+    machine = make_machine({"respawn": True})
+    machine.start_machine()
+    crash(machine, machine.crashloop_threshold - 1)
+    assert MachineState.CRASHLOOPING not in machine.states
+    assert machine.backoff == 0
+
+    backoffs = []
+    for _ in range(4):
+        crash(machine, 1)
+        backoffs.append(machine.backoff)
+    assert machine.states.count(MachineState.CRASHLOOPING) == 4
+    assert backoffs == [machine.respawn_delay * 2, machine.respawn_delay * 4, machine.max_backoff,
+                        machine.max_backoff]
+    wait_for(lambda: machine.get_status() == MachineState.RUNNING)
+    machine.stop_machine()
+
+
+def test_exits_outside_the_window_reset_the_backoff():
+    machine = make_machine({"respawn": True})
+    machine.crashloop_window = 0.001
+    machine.start_machine()
+    crash(machine, machine.crashloop_threshold * 2)
+    assert MachineState.CRASHLOOPING not in machine.states
+    assert machine.backoff == 0
+    machine.stop_machine()
+
+
+def test_stop_cancels_a_pending_respawn():
+    machine = make_machine({"respawn": True})
+    machine.respawn_delay = 60
+    machine.start_machine()
+    machine.procs[0].exit(1)
+    wait_for(lambda: machine.respawn_timer is not None)
+    assert machine.get_status() == MachineState.STARTING
+    machine.stop_machine()
+    assert machine.get_status() == MachineState.STOPPED
+    assert machine.respawn_timer is None
+    assert len(machine.procs) == 1
+
+
+def test_stop_while_crashlooping():
+    machine = make_machine({"respawn": True})
+    machine.max_backoff = 60  # keep it crashlooping while it is stopped
+    machine.start_machine()
+    crash(machine, machine.crashloop_threshold - 1)
+    machine.respawn_delay = 30
+    machine.procs[-1].exit(1)
+    wait_for(lambda: machine.get_status() == MachineState.CRASHLOOPING)
+    machine.stop_machine()
+    assert machine.get_status() == MachineState.STOPPED
+    assert machine.running_procs() == []
+
+
+def test_powerdown_while_spawning_kills_the_new_process():
+    machine = make_machine()
+    machine.spawn_gate = Event()
+    starter = Thread(target=machine.start_machine)
+    starter.start()
+    wait_for(lambda: machine.get_status() == MachineState.STARTING)
+    machine.powerdown()
+    machine.spawn_gate.set()
+    starter.join(5)
+    assert machine.wait_stopped(5)
+    assert len(machine.procs) == 1
+    assert machine.running_procs() == []
+
+
+def restart(machine):
+    # As the restart endpoint does: stop and start while holding the operation lock
+    with machine.lock:
+        machine.stop_machine()
+        machine.start_machine()
+
+
+def test_concurrent_operations_settle():
+    """
+    Start, stop, restart, kill and crash one machine from many threads at once. Whatever the interleaving, the machine
+    must end up running one process or stopped with none.
+    """
+    machine = make_machine({"respawn": True})
+    done = Event()
+    failures = []
+
+    def work():
+        operations = {"start": machine.start_machine, "stop": machine.stop_machine, "kill": machine.kill_machine,
+                      "restart": lambda: restart(machine), "powerdown": machine.powerdown,
+                      "crash": lambda: machine.procs and machine.procs[-1].exit(1)}
+        while not done.is_set():
+            name = random.choice(list(operations))
+            try:
+                operations[name]()
+            except InvalidTransition:
+                pass
+            except Exception as e:
+                failures.append("{}: {!r}".format(name, e))
+            sleep(random.random() * 0.002)
+
+    threads = [Thread(target=work, daemon=True) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    sleep(2)
+    done.set()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+    assert failures == []
+
+    deadline = time() + 5
+    while machine.get_status() not in (MachineState.RUNNING, MachineState.STOPPED) and time() < deadline:
+        sleep(0.01)
+    status = machine.get_status()
+    assert status in (MachineState.RUNNING, MachineState.STOPPED)
+    assert len(machine.running_procs()) == (1 if status == MachineState.RUNNING else 0)
+    assert len(machine.procs) > 1
+
+    machine.stop_machine()
+    assert machine.get_status() == MachineState.STOPPED
+    assert machine.running_procs() == []
@@ -0,0 +1,110 @@
+import json
+import queue
+import logging
+import pytest
+
+from zhypervisor.logging import LevelFilter, RateLimitFilter, DroppingQueueHandler, JsonFormatter, TextFormatter, \
+    update_logging
+
+
+@pytest.fixture
+def handler():
+    """
+    Install a DroppingQueueHandler on the root logger as setup_logging does, without its writer thread, and restore
+    logging afterwards
+    """
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    handler = DroppingQueueHandler(queue.Queue(100))
+    handler.addFilter(LevelFilter({"noisy": "WARNING"}))
+    root.handlers = [handler]
+    logging.getLogger("noisy").setLevel(logging.WARNING)
+    yield handler
+    root.handlers = handlers
+    root.setLevel(level)
+    for name in ("noisy", "chatty"):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+
+
+def make_record(name, level):
+    return logging.LogRecord(name, level, __file__, 0, "message", None, None)
+
+
+def test_level_filter_applies_the_closest_configured_ancestor():
+    level_filter = LevelFilter({"a": "WARNING", "a.b": logging.DEBUG})
+    assert not level_filter.filter(make_record("a", logging.INFO))
+    assert not level_filter.filter(make_record("a.c.d", logging.INFO))
+    assert level_filter.filter(make_record("a.b.c", logging.DEBUG))
+    assert level_filter.filter(make_record("other", logging.DEBUG))
+
+
+def test_level_filter_rejects_unknown_levels():
+    with pytest.raises(ValueError):
+        LevelFilter({"a": "VERBOSE"})
+
+
+def test_update_logging_replaces_the_levels(handler):
+    update_logging(level="INFO", levels={"chatty": "ERROR"})
+    level_filters = [f for f in handler.filters if isinstance(f, LevelFilter)]
+    assert [f.levels for f in level_filters] == [{"chatty": logging.ERROR}]
+    assert logging.getLogger().level == logging.INFO
+    assert logging.getLogger("chatty").level == logging.ERROR
+    assert logging.getLogger("noisy").level == logging.NOTSET
+
+
+@pytest.mark.parametrize("settings", [{"level": "VERBOSE"}, {"level": "INFO", "levels": {"chatty": "VERBOSE"}}])
+def test_update_logging_with_an_unknown_level_keeps_the_current_levels(handler, settings):
+    logging.getLogger().setLevel(logging.WARNING)
+    with pytest.raises(ValueError):
+        update_logging(**settings)
+    level_filters = [f for f in handler.filters if isinstance(f, LevelFilter)]
+    assert [f.levels for f in level_filters] == [{"noisy": logging.WARNING}]
+    assert logging.getLogger().level == logging.WARNING
+    assert logging.getLogger("noisy").level == logging.WARNING
+    assert logging.getLogger("chatty").level == logging.NOTSET
+    handler.handle(make_record("noisy.child", logging.ERROR))
+    assert handler.queue.qsize() == 1
+
+
+def limited_record(created, msg="message", name="zhypervisor", machine_id=None):
+    record = logging.LogRecord(name, logging.WARNING, __file__, 0, msg, None, None)
+    record.created = created
+    if machine_id is not None:
+        record.machine_id = machine_id
+    return record
+
+
+def test_rate_limit_lets_a_burst_through_per_interval():
+    rate_limit = RateLimitFilter(interval=10, burst=3)
+    assert [rate_limit.filter(limited_record(i)) for i in range(6)] == [True, True, True, False, False, False]
+    record = limited_record(10)
+    assert rate_limit.filter(record)
+    assert record.suppressed == 3
+    following = limited_record(11)
+    assert rate_limit.filter(following)
+    assert not getattr(following, "suppressed", 0)
+
+
+def test_rate_limit_tells_messages_apart():
+    rate_limit = RateLimitFilter(interval=10, burst=1)
+    assert rate_limit.filter(limited_record(0, machine_id="m1"))
+    assert rate_limit.filter(limited_record(0, machine_id="m2"))
+    assert rate_limit.filter(limited_record(0, msg="other"))
+    assert rate_limit.filter(limited_record(0, name="cherrypy"))
+    assert not rate_limit.filter(limited_record(1, machine_id="m1"))
+
+
+def test_rate_limit_forgets_expired_messages_when_full():
+    rate_limit = RateLimitFilter(interval=10, burst=1, max_keys=3)
+    for i in range(3):
+        rate_limit.filter(limited_record(i, msg="message {}".format(i)))
+    rate_limit.filter(limited_record(10.5, msg="new"))  # only the first window has expired
+    assert set(key[2] for key in rate_limit.windows) == {"message 1", "message 2", "new"}
+
+
+def test_suppressed_counts_are_formatted():
+    record = limited_record(0, machine_id="m1")
+    record.suppressed = 7
+    entry = json.loads(JsonFormatter().format(record))
+    assert (entry["suppressed"], entry["machine_id"], entry["message"]) == (7, "m1", "message")
+    assert TextFormatter().format(record).endswith("message (7 similar messages suppressed)")
@@ -0,0 +1,23 @@
+from threading import Event
+
+from zhypervisor.metrics import CountingExecutor
+from tests.fakes import wait_for
+
+
+def test_counting_executor_reports_waiting_tasks():
+    executor = CountingExecutor(2)
+    gate = Event()
+    try:
+        futures = [executor.submit(gate.wait) for _ in range(5)]
+        wait_for(lambda: executor.dequeued == 2)
+        assert executor.queue_length() == 3
+        assert futures[4].cancel()
+        assert executor.queue_length() == 2
+        gate.set()
+        for future in futures[:4]:
+            assert future.result(5) is True
+        assert executor.queue_length() == 0
+        assert executor.submit(sum, [1, 2], start=3).result(5) == 6
+    finally:
+        gate.set()
+        executor.shutdown()
@@ -0,0 +1,95 @@
+"""
+Live migration between two daemons on localhost, against the stand-in qemu. The target is a zd process serving its API,
+the source runs in process so that failures of the handover can be injected into its client of the target.
+"""
+import pytest
+
+from zhypervisor.client import ZClient, ZClientError
+from tests.conftest import USER, PASSWORD
+from tests.fakes import wait_for
+
+
+MACHINE = {"type": "q", "mem": 16}
+
+
+@pytest.fixture
+def nodes(make_daemon, start_daemon):
+    """
+    Return a source daemon running machine m1, and a client of the target node "b" it may migrate machines to
+    """
+    target = start_daemon("b", migration={"address": "127.0.0.1"})
+    url = "http://127.0.0.1:{}".format(target.port)
+    source = make_daemon("a", machines={"m1": MACHINE},
+                         migration={"peers": {"b": {"url": url, "username": USER, "password": PASSWORD}},
+                                    "poll_interval": 0.05})
+    source.machines["m1"].start()
+    wait_for(lambda: source.machines["m1"].machine.get_status() == "running")
+    return source, target
+
+
+def migrate(source, machine_id="m1", target="b"):
+    job = source.migration.migrate(machine_id, target)
+    wait_for(lambda: job.finished is not None, timeout=60)
+    return job
+
+
+def guest_status(source, machine_id="m1"):
+    return source.machines[machine_id].machine.qmp.execute("query-status")["status"]
+
+
+def test_migration_moves_the_machine(nodes):
+    source, target = nodes
+    job = migrate(source)
+    assert job.status == "done", job.error
+    assert "m1" not in source.machines
+    assert target.get_machine("m1")["_status"] == "running"
+
+
+def test_failed_handover_resumes_the_source_once_the_target_discarded_it(nodes, monkeypatch):
+    source, target = nodes
+
+    def commit_incoming(client, machine_id):
+        raise ZClientError(500, "handover failed")
+
+    monkeypatch.setattr(ZClient, "commit_incoming", commit_incoming)
+    job = migrate(source)
+    assert job.status == "failed"
+    assert "handover failed" in job.error
+    assert guest_status(source) == "running"
+    assert source.machines["m1"].machine.get_status() == "running"
+    with pytest.raises(ZClientError) as e:
+        target.get_machine("m1")
+    assert e.value.status == 404
+
+
+def test_lost_handover_leaves_the_source_paused(nodes, monkeypatch):
+    """
+    The target took the machine over but its answer was lost: the guest runs there, so it must not be resumed here
+    """
+    source, target = nodes
+    commit_incoming = ZClient.commit_incoming
+
+    def lose_answer(client, machine_id):
+        commit_incoming(client, machine_id)
+        raise ConnectionResetError("connection lost")
+
+    monkeypatch.setattr(ZClient, "commit_incoming", lose_answer)
+    job = migrate(source)
+    assert job.status == "failed"
+    assert "left paused" in job.error
+    assert guest_status(source) != "running"
+    assert target.get_machine("m1")["_status"] == "running"
+
+
+def test_unreachable_target_leaves_the_source_paused(nodes, monkeypatch):
+    source, target = nodes
+
+    def unreachable(client, machine_id):
+        raise ConnectionRefusedError("connection refused")
+
+    monkeypatch.setattr(ZClient, "commit_incoming", unreachable)
+    monkeypatch.setattr(ZClient, "abort_incoming", unreachable)
+    job = migrate(source)
+    assert job.status == "failed"
+    assert "left paused" in job.error
+    assert guest_status(source) != "running"
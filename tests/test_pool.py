@@ -0,0 +1,101 @@
+import os
+import pytest
+
+from zhypervisor.pool import WarmPool, Template
+from zhypervisor.schema import SpecError
+from tests.fakes import wait_for
+
+
+PROPERTIES = {"type": "q", "mem": 64, "vnc": True, "drives": [{"disk": "base.bin"}],
+              "netifaces": [{"type": "nic"}, {"type": "tap"}]}
+
+
+@pytest.fixture
+def daemon(make_daemon):
+    daemon = make_daemon(pool={"interval": 0.05})
+    daemon.add_disk("base.bin", {"type": "qdisk", "datastore": "default", "size": 64, "fmt": "qcow2"}, write=True)
+    return daemon
+
+
+def ready(daemon, template_id, count):
+    wait_for(lambda: len(daemon.pool.templates[template_id].instances) == count, timeout=30)
+
+
+@pytest.mark.parametrize("properties,message", [
+    ({"type": "docker", "image": "nginx"}, "Only qemu machines"),
+    (dict(PROPERTIES, vnc=5), "vnc"),
+    (dict(PROPERTIES, netifaces=[{"type": "nic", "macaddr": "52:54:00:00:00:01"}]), "macaddr"),
+    (dict(PROPERTIES, netifaces=[{"type": "tap", "ifname": "tap9"}]), "ifname"),
+])
+def test_templates_cannot_share_per_machine_settings(daemon, properties, message):
+    with pytest.raises(SpecError, match=message):
+        WarmPool.validate(daemon, {"pool_size": 1, "properties": properties})
+
+
+class FakeInstance(object):
+    def __init__(self, mem):
+        self.mem = mem
+
+
+def test_refills_the_least_full_pool_within_the_budget(daemon):
+    pool = WarmPool(daemon, memory_budget=300)
+    for template_id, size, mem, ready_instances in (("a", 4, 64, 2), ("b", 2, 64, 0), ("c", 1, 512, 0)):
+        template = pool.templates[template_id] = Template(template_id, {"pool_size": size,
+                                                                       "properties": {"mem": mem}})
+        template.instances = [FakeInstance(mem) for _ in range(ready_instances)]
+    assert pool.next_template(set()).template_id == "b"  # c does not fit in the budget
+    assert pool.next_template({"b"}).template_id == "a"
+    pool.templates["b"].instances.append(FakeInstance(64))
+    assert pool.next_template(set()).template_id == "a"  # half full, as b, and listed first
+    pool.templates["a"].instances.append(FakeInstance(64))
+    assert pool.memory_used() == 256
+    assert pool.next_template(set()) is None  # another instance would exceed the budget
+
+
+def test_claims_warm_instances_then_boots_the_rest(daemon):
+    daemon.pool.start()
+    daemon.pool.add_template("web", {"pool_size": 2, "properties": PROPERTIES}, write=True)
+    ready(daemon, "web", 2)
+    daemon.add_machine("web-2", dict(PROPERTIES), write=True)
+
+    claimed = daemon.pool.claim("web", count=3)
+    assert [machine_spec.machine_id for machine_spec in claimed] == ["web-1", "web-3", "web-4"]
+    assert [machine_spec.machine.boot["kind"] for machine_spec in claimed] == ["warm", "warm", "start"]
+    for machine_spec in claimed:
+        wait_for(lambda: machine_spec.machine.get_status() == "running")
+        assert daemon.machines[machine_spec.machine_id] is machine_spec
+        drive = machine_spec.properties["drives"][0]["disk"]
+        assert drive != "base.bin" and daemon.disks[drive].properties["backing"] == "base.bin"
+        assert os.path.exists(daemon.disks[drive].get_path())
+    displays = [machine_spec.properties["vnc"] for machine_spec in claimed]
+    macs = [machine_spec.properties["netifaces"][0]["macaddr"] for machine_spec in claimed]
+    assert len(set(displays)) == len(set(macs)) == 3
+    assert {machine["machine_id"] for machine in daemon.state.get_machines()} >= {"web-1", "web-3", "web-4"}
+    ready(daemon, "web", 2)  # refilled in the background
+
+
+def test_claims_are_checked_before_any_instance_is_used(daemon):
+    daemon.pool.start()
+    daemon.pool.add_template("web", {"pool_size": 1, "properties": PROPERTIES}, write=True)
+    ready(daemon, "web", 1)
+    daemon.add_machine("taken", dict(PROPERTIES), write=True)
+    with pytest.raises(SpecError):
+        daemon.pool.claim("web", machine_ids=["new", "taken"])
+    with pytest.raises(SpecError):
+        daemon.pool.claim("web", machine_ids=["new", "new"])
+    with pytest.raises(KeyError):
+        daemon.pool.claim("nope")
+    assert "new" not in daemon.machines
+    assert len(daemon.pool.templates["web"].instances) == 1
+
+
+def test_changing_a_template_discards_its_instances(daemon):
+    daemon.pool.start()
+    daemon.pool.add_template("web", {"pool_size": 1, "properties": PROPERTIES}, write=True)
+    ready(daemon, "web", 1)
+    old = daemon.pool.templates["web"].instances[0]
+    daemon.pool.add_template("web", {"pool_size": 1, "properties": dict(PROPERTIES, mem=128)}, write=True)
+    assert not old.is_alive()
+    assert not any(disk_id in daemon.disks for disk_id in old.disks)
+    ready(daemon, "web", 1)
+    assert daemon.pool.templates["web"].instances[0].mem == 128
@@ -0,0 +1,55 @@
+import pytest
+
+from zhypervisor.machine import MachineSpec
+from zhypervisor.schema import SpecError
+
+
+KERNEL = {"kernel": "kernels/vmlinuz"}
+
+
+@pytest.fixture
+def daemon(make_daemon, tmp_path):
+    kernels = tmp_path / "zd" / "datastore" / "kernels"
+    kernels.mkdir(parents=True)
+    (kernels / "vmlinuz").write_bytes(b"")
+    return make_daemon()
+
+
+def network_args(daemon, netifaces, machine=None):
+    properties = {"type": "q", "kernel": KERNEL, "netifaces": netifaces}
+    if machine:
+        properties["machine"] = machine
+    machine_spec = daemon.add_machine("vm", properties)
+    return machine_spec.machine.get_args_network("tap7")
+
+
+def test_pc_nics_and_backends_share_a_hub(daemon):
+    args = network_args(daemon, [{"type": "nic", "model": "e1000", "macaddr": "52:54:00:00:00:01"}, {"type": "tap"}])
+    assert args == ["-net", "nic,model=e1000,macaddr=52:54:00:00:00:01",
+                    "-net", "tap,ifname=tap7,script=/root/zhypervisor/testenv/bin/zd_ifup,downscript=no"]
+
+
+def test_microvm_backends_get_a_virtio_net_device_each(daemon):
+    args = network_args(daemon, [{"type": "nic", "macaddr": "52:54:00:00:00:01"}, {"type": "tap"},
+                                 {"type": "nic", "vlan": 0}, {"type": "user", "vlan": 0}], machine="microvm")
+    assert args == ["-netdev", "tap,ifname=tap7,script=/root/zhypervisor/testenv/bin/zd_ifup,downscript=no,id=net0",
+                    "-device", "virtio-net-device,netdev=net0,mac=52:54:00:00:00:01",
+                    "-netdev", "user,id=net1",
+                    "-device", "virtio-net-device,netdev=net1"]
+    machine = daemon.machines["vm"].machine
+    assert [(iface_type, ifname) for iface_type, ifname, _ in machine.get_plan().netifaces] == \
+        [("nic", None), ("tap", str(machine.tap)), ("nic", None), ("user", None)]
+
+
+def test_microvm_backend_without_nic(daemon):
+    args = network_args(daemon, [{"type": "tap"}], machine="microvm")
+    assert args[2:] == ["-device", "virtio-net-device,netdev=net0"]
+
+
+@pytest.mark.parametrize("netifaces", [[{"type": "nic"}],
+                                       [{"type": "nic"}, {"type": "tap"}, {"type": "nic"}],
+                                       [{"type": "nic", "model": "e1000"}, {"type": "tap"}]])
+def test_microvm_rejects_nics_it_cannot_attach(daemon, netifaces):
+    with pytest.raises(SpecError):
+        MachineSpec.validate(daemon, "vm", {"type": "q", "machine": "microvm", "kernel": KERNEL,
+                                            "netifaces": netifaces})
@@ -0,0 +1,243 @@
+from threading import Lock
+from collections import deque
+
+from zhypervisor.schema import SpecError
+
+
+class AllocationError(SpecError):
+    pass
+
+
+class Allocator(object):
+    """
+    Hands out integers from a range without collisions. Released values are put on a free list and handed out again
+    before new ones, so allocating and releasing take constant time no matter how large the range is.
+    """
+    def __init__(self, name, start, end, format=str):
+        """
+        :param name: what is being allocated, used in error messages
+        :param start: lowest value of the range
+        :param end: highest value of the range
+        :param format: callable turning a value into its display form, used in error messages
+        """
+        self.name = name
+        self.start = start
+        self.end = end
+        self.format = format
+        self.next = start  # lowest value never handed out
+        self.free = deque()  # released values. May contain values reserved since, which are skipped
+        self.owners = {}  # Mapping of value -> owner
+        self.held = {}  # Mapping of owner -> set of values
+        self.lock = Lock()
+
+    def allocate(self, owner):
+        """
+        Return an unused value and record it as held by owner
+        """
+        with self.lock:
+            return self._allocate(owner)
+
+    def get(self, owner):
+        """
+        Return the value held by owner, allocating one if it holds none
+        """
+        with self.lock:
+            held = self.held.get(owner)
+            if held:
+                return next(iter(held))
+            return self._allocate(owner)
+
+    def check(self, owner, values):
+        """
+        Raise AllocationError if any of the values is held by an owner other than the given one
+        """
+        for value in values:
+            holder = self.owners.get(value, owner)
+            if holder != owner:
+                raise AllocationError("{} {} is in use by {}".format(self.name, self.format(value), holder))
+
+    def sync(self, owner, values):
+        """
+        Make owner hold exactly the given values, e.g. the ones set in its spec. New values are reserved and values no
+        longer wanted are released. Nothing changes if any value is held by another owner.
+        """
+        values = set(values)
+        with self.lock:
+            self.check(owner, values)
+            for value in values:
+                self._take(value, owner)
+            for value in self.held.get(owner, set()) - values:
+                self._release(value)
+
+    def release(self, owner):
+        """
+        Release every value held by owner
+        """
+        with self.lock:
+            for value in list(self.held.get(owner, ())):
+                self._release(value)
+
+    def transfer(self, old_owner, new_owner):
+        """
+        Hand every value held by one owner to another, releasing what the new owner held before
+        """
+        with self.lock:
+            for value in list(self.held.get(new_owner, ())):
+                self._release(value)
+            for value in self.held.pop(old_owner, set()):
+                self._take(value, new_owner)
+
+    def _allocate(self, owner):
+        while self.free:
+            value = self.free.popleft()
+            if value not in self.owners:
+                break
+        else:
+            while self.next in self.owners:
+                self.next += 1
+            if self.next > self.end:
+                raise AllocationError("No free {} left".format(self.name))
+            value = self.next
+            self.next += 1
+        self._take(value, owner)
+        return value
+
+    def _take(self, value, owner):
+        self.owners[value] = owner
+        self.held.setdefault(owner, set()).add(value)
+
+    def _release(self, value):
+        owner = self.owners.pop(value)
+        self.held[owner].discard(value)
+        if not self.held[owner]:
+            del self.held[owner]
+        # Values past next were reserved rather than handed out and will be reached by next again
+        if self.start <= value < self.next:
+            self.free.append(value)
+
+    def serialize(self):
+        with self.lock:
+            return {"next": self.next,
+                    "owners": {str(value): owner for value, owner in self.owners.items()}}
+
+    def load(self, data):
+        """
+        Restore state produced by serialize()
+        """
+        with self.lock:
+            self.next = data.get("next", self.start)
+            self.owners = {}
+            self.held = {}
+            for value, owner in data.get("owners", {}).items():
+                self._take(int(value), owner)
+            self.free = deque(value for value in range(self.start, min(self.next, self.end + 1))
+                              if value not in self.owners)
+
+
+class MachineAllocators(object):
+    """
+    Allocators for values that must be unique per machine: vnc displays, mac addresses of nics and the numbers of tap
+    devices. Persisted in the state datastore.
+    """
+    def __init__(self, state, mac_prefix="52:54:00", vnc=(10, 999), tap=(0, 99999)):
+        """
+        :param state: ZConfig to persist allocations with
+        :param mac_prefix: first three octets of allocated mac addresses
+        :param vnc: first and last vnc display to allocate
+        :param tap: first and last tap device number to allocate
+        """
+        self.state = state
+        self.mac_prefix = mac_prefix.lower()
+        self.mac = Allocator("mac address", 0, 0xffffff, format=self.format_mac)
+        self.vnc = Allocator("vnc display", *vnc)
+        self.tap = Allocator("tap device", *tap)
+        self.allocators = {"mac": self.mac, "vnc": self.vnc, "tap": self.tap}
+        self.save_lock = Lock()
+        for name, data in self.state.get_allocators().items():
+            if name in self.allocators:
+                self.allocators[name].load(data)
+
+    def format_mac(self, value):
+        return "{}:{:02x}:{:02x}:{:02x}".format(self.mac_prefix, value >> 16, (value >> 8) & 0xff, value & 0xff)
+
+    def parse_mac(self, mac):
+        """
+        Return the allocator value of a mac address, or None if the address is outside of the allocated range
+        """
+        mac = mac.lower()
+        if not mac.startswith(self.mac_prefix + ":"):
+            return None
+        try:
+            return int(mac[len(self.mac_prefix) + 1:].replace(":", ""), 16)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def get_nics(properties):
+        netifaces = properties.get("netifaces")
+        if not isinstance(netifaces, list):
+            return []
+        return [iface for iface in netifaces if isinstance(iface, dict) and iface.get("type") == "nic"]
+
+    def reserve(self, owner, properties):
+        """
+        Make the owner hold exactly the vnc display and mac addresses set in some machine properties, releasing ones it
+        held that are no longer set
+        :raises AllocationError: if a display or address is held by another machine. Nothing is changed in that case.
+        """
+        if not isinstance(properties, dict):
+            return  # left to validation to reject
+        vnc = properties.get("vnc")
+        displays = [vnc] if isinstance(vnc, int) and not isinstance(vnc, bool) else []
+        macs = [self.parse_mac(nic["macaddr"]) for nic in self.get_nics(properties)
+                if isinstance(nic.get("macaddr"), str)]
+        macs = [mac for mac in macs if mac is not None]
+        self.vnc.check(owner, displays)
+        self.mac.check(owner, macs)
+        self.vnc.sync(owner, displays)
+        self.mac.sync(owner, macs)
+
+    def assign(self, owner, properties):
+        """
+        Return a copy of machine properties with a vnc display allocated if "vnc" is true and a mac address allocated
+        for every nic that has none. Values that are already set are reserved, see reserve().
+        :raises AllocationError: if a value that is set is held by another machine, or a range of values is used up
+        """
+        self.reserve(owner, properties)
+        if not isinstance(properties, dict):
+            return properties
+        properties = dict(properties)
+        if isinstance(properties.get("netifaces"), list):
+            properties["netifaces"] = [dict(iface) if isinstance(iface, dict) else iface
+                                       for iface in properties["netifaces"]]
+        if properties.get("vnc") is True:
+            properties["vnc"] = self.vnc.allocate(owner)
+        for nic in self.get_nics(properties):
+            if "macaddr" not in nic:
+                nic["macaddr"] = self.format_mac(self.mac.allocate(owner))
+        return properties
+
+    def release(self, owner):
+        for allocator in self.allocators.values():
+            allocator.release(owner)
+
+    def transfer(self, old_owner, new_owner):
+        for allocator in self.allocators.values():
+            allocator.transfer(old_owner, new_owner)
+
+    def prune(self, owners):
+        """
+        Release everything held by owners not in the given set, such as machines removed while the daemon was down
+        """
+        for allocator in self.allocators.values():
+            with allocator.lock:
+                stale = set(allocator.held) - set(owners)
+            for owner in stale:
+                allocator.release(owner)
+
+    def save(self):
+        """
+        Write all allocations to the state datastore
+        """
+        with self.save_lock:
+            self.state.write_allocators({name: allocator.serialize() for name, allocator in self.allocators.items()})
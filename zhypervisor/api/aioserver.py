@@ -0,0 +1,315 @@
+import json
+import types
+import asyncio
+import logging
+import cherrypy
+import traceback
+from time import time
+from http import HTTPStatus
+from urllib.parse import urlsplit, unquote, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from cherrypy._cprequest import Request, Response
+from cherrypy.lib.httputil import Host, HeaderMap, valid_status
+
+from zhypervisor.api.api import endpoint_name
+
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPResponse(object):
+    """
+    A response ready to be written out
+    """
+    def __init__(self, status, body=b"", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+def parse_params(query, body=b"", content_type=""):
+    """
+    Merge query string and urlencoded form parameters the way cherrypy does: repeated parameters become lists
+    """
+    pairs = parse_qsl(query, keep_blank_values=True)
+    if content_type.split(";")[0].strip() == "application/x-www-form-urlencoded":
+        pairs += parse_qsl(body.decode("UTF-8"), keep_blank_values=True)
+    params = {}
+    for name, value in pairs:
+        if name in params:
+            if not isinstance(params[name], list):
+                params[name] = [params[name]]
+            params[name].append(value)
+        else:
+            params[name] = value
+    return params
+
+
+class AsyncApiServer(object):
+    """
+    HTTP/1.1 server built on asyncio, as an alternative to cherrypy's thread-per-connection server. Connections are
+    kept alive and cost no thread while idle, and log follows are streamed from the event loop. Requests are routed
+    through the cherrypy application tree and served by the same endpoint objects, run on a thread pool since they may
+    block on machine lifecycle operations.
+    """
+    def __init__(self, api, host="0.0.0.0", port=3000, workers=16, keepalive_timeout=75, max_body=16777216,
+                 poll_interval=0.25, log_workers=4):
+        """
+        :param api: ZApi whose mounted applications are served
+        :param workers: threads endpoints are run on
+        :param keepalive_timeout: seconds an idle connection is kept open
+        :param max_body: largest request body accepted, in bytes
+        :param poll_interval: seconds between checks for new output of followed logs
+        :param log_workers: threads followed logs are read on, apart from the endpoints' threads so a slow disk can't
+                            hold them up
+        """
+        self.api = api
+        self.master = api.master
+        self.auth = api.auth
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body = max_body
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="api")
+        self.log_executor = ThreadPoolExecutor(log_workers, thread_name_prefix="api-log")
+        self.loop = asyncio.new_event_loop()
+        self.stopping = None
+        self.stopped = False
+        self.server = None
+        self.connections = {}  # Mapping of open connection's StreamWriter -> task serving it
+
+    def run(self):
+        """
+        Serve until stop() is called
+        """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.log_executor.shutdown(wait=False)
+            self.loop.close()
+        logger.info("API has shut down")
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+        if self.stopped:
+            return
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        logger.info("Serving the API on %s:%s with asyncio", self.host, self.port)
+        await self.stopping.wait()
+        self.server.close()
+        # Log streams end at their next poll, requests in progress get a few seconds to finish
+        await asyncio.sleep(self.poll_interval)
+        for writer in self.connections.keys():
+            writer.close()
+        if self.connections:
+            await asyncio.wait(list(self.connections.values()), timeout=5)
+
+    def stop(self):
+        self.stopped = True
+        if self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        logger.info("API shutting down...")
+
+    def rebind(self, port):
+        """
+        Move the API to another port. Connections already open are kept. If the new port cannot be bound the error is
+        raised and the old one kept.
+        """
+        if self.server is None:
+            self.port = port  # not serving yet
+            return
+        asyncio.run_coroutine_threadsafe(self.bind(port), self.loop).result()
+        logger.info("API moved to port %s", port)
+
+    async def bind(self, port):
+        server = await asyncio.start_server(self.handle_connection, self.host, port)
+        self.server.close()
+        self.server = server
+        self.port = port
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests of one connection until either side closes it
+        """
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+                except asyncio.LimitOverrunError:
+                    await self.write(writer, HTTPResponse(431), keep_alive=False)
+                    return
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    await self.write(writer, HTTPResponse(400), keep_alive=False)
+                    return
+                headers = HeaderMap()
+                for line in lines[1:]:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip()] = value.strip()
+
+                connection = headers.get("Connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                if "Transfer-Encoding" in headers:
+                    await self.write(writer, HTTPResponse(501), keep_alive=False)
+                    return
+                try:
+                    length = int(headers.get("Content-Length", 0))
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= self.max_body:
+                    await self.write(writer, HTTPResponse(413 if length > 0 else 400), keep_alive=False)
+                    return
+                body = await reader.readexactly(length) if length else b""
+
+                response = await self.respond(writer, method, target, headers, body, keep_alive)
+                if response is None:
+                    return  # streamed
+                await self.write(writer, response, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self.connections[writer]
+            writer.close()
+
+    async def write(self, writer, response, keep_alive):
+        body = response.body
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        elif body is None:
+            body = b""
+        head = ["HTTP/1.1 {} {}".format(response.status, HTTPStatus(response.status).phrase),
+                "Server: zd",
+                "Content-Length: {}".format(len(body)),
+                "Connection: {}".format("keep-alive" if keep_alive else "close")]
+        head += ["{}: {}".format(name, value) for name, value in response.headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def respond(self, writer, method, target, headers, body, keep_alive):
+        """
+        Authenticate and serve a request. Returns the HTTPResponse to send, or None if the response was streamed.
+        """
+        started = time()
+        username = None
+        if self.auth.users:
+            username = self.auth.check(headers.get("Authorization", ""))
+            if username is None:
+                return HTTPResponse(401, valid_status(401)[2], {"Content-Type": "text/plain",
+                                                                "WWW-Authenticate": 'Basic realm="zd"'})
+
+        url = urlsplit(target)
+        path = unquote(url.path)
+        try:
+            params = parse_params(url.query, body, headers.get("Content-Type", ""))
+        except UnicodeDecodeError:
+            return HTTPResponse(400)
+
+        segments = [segment for segment in path.split("/") if segment]
+        if method == "GET" and segments[:3] == ["api", "v1", "machine"] and len(segments) == 5 and \
+                segments[4] == "log" and params.get("follow") in [True, 'True', 'true', 'yes', '1', 1]:
+            await self.follow_log(writer, segments[3], params, keep_alive)
+            return None
+
+        response, endpoint = await self.loop.run_in_executor(self.executor, self.call, method, path, params,
+                                                             headers, username)
+        self.master.stats.observe("zd_api_request_seconds", time() - started, endpoint=endpoint,
+                                  status=str(response.status))
+        return response
+
+    def call(self, method, path, params, headers, username):
+        """
+        Route a request through the cherrypy application tree and run its endpoint. Runs on the thread pool. Returns
+        the HTTPResponse and the name of the endpoint.
+        """
+        script_name = cherrypy.tree.script_name(path)
+        app = cherrypy.tree.apps.get(script_name)
+        if app is None:
+            # cherrypy answers paths outside of its applications with an empty 404
+            return HTTPResponse(404), "none"
+
+        request = Request(Host("127.0.0.1", self.port), Host("", 0), "http", "HTTP/1.1")
+        response = Response()
+        cherrypy.serving.load(request, response)
+        self.master.profiler.enter()
+        try:
+            request.app = app
+            request.method = method
+            request.script_name = script_name
+            request.path_info = path[len(script_name):] or "/"
+            request.headers = headers
+            request.params = params
+            request.login = username
+            try:
+                request.get_resource(request.path_info)
+                allowed = request.config.get("tools.allow.methods")
+                if request.config.get("tools.allow.on") and allowed and method not in allowed:
+                    raise cherrypy.HTTPError(405)
+                body = request.handler()
+                if isinstance(body, types.GeneratorType):
+                    body = b"".join(chunk if isinstance(chunk, bytes) else chunk.encode("UTF-8") for chunk in body)
+            except cherrypy.HTTPError as e:
+                message = getattr(e, "_message", None) or valid_status(e.code)[2]
+                return HTTPResponse(e.code, message, {"Content-Type": "text/plain"}), endpoint_name(request)
+            except Exception:
+                logger.exception("Error serving %s %s", method, path)
+                message = "{}\n\n{}".format(valid_status(500)[2], traceback.format_exc())
+                return HTTPResponse(500, message, {"Content-Type": "text/plain"}), endpoint_name(request)
+
+            if request.config.get("tools.json_out.on"):
+                body = json.dumps(body)
+                content_type = "application/json"
+            else:
+                content_type = response.headers.get("Content-Type", "text/html")
+            headers = {"Content-Type": content_type}
+            for name in ("Content-Disposition", ):
+                if name in response.headers:
+                    headers[name] = response.headers[name]
+            return HTTPResponse(200, body, headers), endpoint_name(request)
+        finally:
+            self.master.profiler.exit()
+            cherrypy.serving.clear()
+
+    async def follow_log(self, writer, machine_id, params, keep_alive):
+        """
+        Stream a machine's output as it is produced, without tying up a thread while waiting. Mirrors ZApiMachineLog.
+        The log is read on the log threads, as reads of detached machines' log files may block.
+        """
+        machine_spec = self.master.machines.get(machine_id)
+        if machine_spec is None:
+            response = HTTPResponse(404, valid_status(404)[2], {"Content-Type": "text/plain"})
+            await self.write(writer, response, keep_alive)
+            return
+        try:
+            tail = int(params.get("tail", 16384))
+            assert tail >= 0
+        except (ValueError, AssertionError):
+            message = "tail must be a non-negative integer"
+            await self.write(writer, HTTPResponse(400, message, {"Content-Type": "text/plain"}), keep_alive)
+            return
+
+        log = self.master.output.get_log(machine_spec)
+        data, position = await self.loop.run_in_executor(self.log_executor, log.tail, tail)
+        writer.write(b"HTTP/1.1 200 OK\r\nServer: zd\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        while True:
+            if data:
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                await writer.drain()
+            elif writer.is_closing() or self.stopping.is_set() or not self.master.running:
+                break
+            else:
+                await asyncio.sleep(self.poll_interval)
+            data, position = await self.loop.run_in_executor(self.log_executor, log.wait, position, 0)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
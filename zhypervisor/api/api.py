@@ -1,8 +1,21 @@
 import cherrypy
 import logging
 import json
+import socket
+from time import time
 from threading import Thread
 
+from zhypervisor.profiling import ProfilerBusy
+from zhypervisor.api.auth import Authenticator, AuthTool
+from zhypervisor.schema import SpecError
+from zhypervisor.util import InvalidTransition
+from zhypervisor.jobs import JobConflict
+from zhypervisor.migration import MigrationError
+from zhypervisor.diskjobs import DiskJobError
+
+
+logger = logging.getLogger(__name__)
+
 
 class Mountable(object):
     """
@@ -22,14 +35,56 @@ class Mountable(object):
         return self
 
 
-class ZApi(object):
+def endpoint_name(request):
+    """
+    Return the name of the handler that served a request, e.g. ZApiMachines.GET, for labelling metrics
+    """
+    # json_out replaces the page handler with a wrapper and keeps the original here
+    handler = getattr(request, "_json_inner_handler", None) or request.handler
+    handler = getattr(handler, "callable", None)
+    if handler is not None and hasattr(handler, "__self__"):
+        return "{}.{}".format(type(handler.__self__).__name__, handler.__name__)
+    return "none"
+
+
+class InstrumentTool(cherrypy.Tool):
+    """
+    Records the latency of every request, labelled by the handler that served it, and runs requests under the daemon
+    profiler while a cprofile capture is in progress
+    """
     def __init__(self, master):
+        super().__init__("on_start_resource", self.start_request)
+        self.master = master
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.serving.request.hooks.attach("on_end_request", self.end_request)
+
+    def start_request(self):
+        cherrypy.serving.request.zd_started = time()
+        self.master.profiler.enter()
+
+    def end_request(self):
+        self.master.profiler.exit()
+        request = cherrypy.serving.request
+        self.master.stats.observe("zd_api_request_seconds", time() - request.zd_started,
+                                  endpoint=endpoint_name(request), status=cherrypy.serving.response.status.split()[0])
+
+
+class ZApi(object):
+    def __init__(self, master, follow_timeout=None):
         """
         Main component of the API service. Inits and assembles the various classes. Provides .run() and .stop() to
         control it.
         :param master: parent BastionController reference.
+        :param follow_timeout: seconds after which streams of followed logs end, as each holds a server thread
         """
         self.master = master
+        self.follow_timeout = follow_timeout
+        self.stopping = False
+        self.auth = Authenticator(self.master.config.get("access", []), **self.master.config.get("auth", {}))
+        cherrypy.tools.zinstrument = InstrumentTool(self.master)
+        cherrypy.tools.zauth = AuthTool(self.auth)
         self.app_v1 = ZApiV1(self).mount('/api/v1')
         # self.app_root = BSApiRoot(self).mount('/api')
         # self.ui = Mountable(conf={'/': {
@@ -38,10 +93,6 @@ class ZApi(object):
         #                          'tools.staticdir.index': 'index.html'}}).mount('/ui')
 
         cherrypy.config.update({
-            'sessionFilter.on': True,
-            'tools.sessions.on': True,
-            'tools.sessions.locking': 'explicit',
-            'tools.sessions.timeout': 525600,
             'request.show_tracebacks': True,
             'server.socket_port': self.master.config.get("apiport", 3000),
             'server.thread_pool': 25,
@@ -49,17 +100,43 @@ class ZApi(object):
             'server.show_tracebacks': True,
             'server.socket_timeout': 5,
             'log.screen': False,
-            'engine.autoreload.on': False
+            'engine.autoreload.on': False,
+            'tools.zinstrument.on': True,
+            'tools.zauth.on': True
         })
 
     def run(self):
         cherrypy.engine.start()
+        if self.stopping:
+            cherrypy.engine.exit()
         cherrypy.engine.block()
-        logging.info("API has shut down")
+        logger.info("API has shut down")
 
     def stop(self):
-        cherrypy.engine.exit()
-        logging.info("API shutting down...")
+        self.stopping = True
+        # Exiting the engine while it starts kills the process on the spot, leaving machines running. A stop during
+        # startup, such as a signal while the server binds its port, is carried out by run() once the engine started.
+        if cherrypy.engine.state != cherrypy.engine.states.STARTING:
+            cherrypy.engine.exit()
+        logger.info("API shutting down...")
+
+    def rebind(self, port):
+        """
+        Move the API to another port. Requests in progress are finished first. If the new port cannot be bound the error
+        is raised and the old one kept.
+        """
+        if cherrypy.engine.state != cherrypy.engine.states.STARTED:
+            cherrypy.server.socket_port = port  # not serving yet
+            return
+        # The server thread failing to bind would exit the engine, so the port is tried before the server is stopped
+        with socket.socket() as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((cherrypy.server.socket_host, port))
+        cherrypy.server.stop()
+        cherrypy.server.httpserver = None  # built again for the new address on start
+        cherrypy.server.socket_port = port
+        cherrypy.server.start()
+        logger.info("API moved to port %s", port)
 
 
 class ZApiV1(Mountable):
@@ -70,6 +147,8 @@ class ZApiV1(Mountable):
         super().__init__(conf={
             "/machine": {'request.dispatch': cherrypy.dispatch.MethodDispatcher()},
             "/disk": {'request.dispatch': cherrypy.dispatch.MethodDispatcher()},
+            "/template": {'request.dispatch': cherrypy.dispatch.MethodDispatcher()},
+            "/job": {'request.dispatch': cherrypy.dispatch.MethodDispatcher()},
             # "/task": {'request.dispatch': cherrypy.dispatch.MethodDispatcher()},
             # "/logs": {
             #     'tools.staticdir.on': True,
@@ -80,6 +159,10 @@ class ZApiV1(Mountable):
         self.root = root
         self.machine = ZApiMachines(self.root)
         self.disk = ZApiDisks(self.root)
+        self.template = ZApiTemplates(self.root)
+        self.job = ZApiJobs(self.root)
+        self.admin = ZApiAdmin(self.root)
+        self.auth = ZApiAuth(self.root)
         # self.task = BSApiTask(self.root)
         # self.control = BSApiControl(self.root)
         # self.socket = ApiWebsockets(self.root)
@@ -88,6 +171,65 @@ class ZApiV1(Mountable):
     def index(self):
         yield "It works!"
 
+    @cherrypy.expose
+    def metrics(self):
+        """
+        Latest resource usage of all machines and the daemon's own instrumentation in prometheus text format
+        """
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return self.root.master.metrics.render_prometheus() + self.root.master.stats.render_prometheus()
+
+
+class ZApiAuth(object):
+    """
+    Endpoints for API credentials
+    """
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_out()
+    def token(self):
+        """
+        Issue a bearer token for the authenticated user, to use instead of sending the password with every request
+        """
+        if not self.root.auth.users:
+            raise cherrypy.HTTPError(status=404, message="Authentication is disabled")
+        token, expires = self.root.auth.issue_token(cherrypy.serving.request.login)
+        return {"token": token, "expires": expires}
+
+
+class ZApiAdmin(object):
+    """
+    Endpoints for inspecting the daemon itself
+    """
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.expose
+    def profile(self, seconds=10, mode="sample", interval=0.01):
+        """
+        Profile the daemon for some seconds and return the result as a download
+        :param seconds: duration of the capture
+        :param mode: "sample" for stack sampling of all threads, "cprofile" for a pstats profile of API requests
+        :param interval: stack sampling interval in seconds
+        """
+        if mode not in ("sample", "cprofile"):
+            raise cherrypy.HTTPError(status=400, message="mode must be one of 'sample' or 'cprofile'")
+        try:
+            seconds, interval = float(seconds), float(interval)
+            assert 0 < seconds < float("inf") and 0 < interval < float("inf")
+        except (ValueError, AssertionError):
+            raise cherrypy.HTTPError(status=400, message="seconds and interval must be positive numbers")
+        try:
+            filename, data = self.root.master.profiler.profile(seconds, mode=mode, interval=interval)
+        except ProfilerBusy as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
+        cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+        cherrypy.response.headers["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+        return data
+
 
 @cherrypy.popargs("machine_id")
 class ZApiMachineStop(object):
@@ -124,7 +266,12 @@ class ZApiMachineStart(object):
         """
         Start the machine
         """
-        self.root.master.machines[machine_id].start()
+        try:
+            self.root.master.machines[machine_id].start()
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+        except InvalidTransition as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
         return machine_id
 
 
@@ -144,8 +291,183 @@ class ZApiMachineRestart(object):
         Start the machine
         """
         assert machine_id in self.root.master.machines
-        self.root.master.forceful_stop(machine_id)
-        self.root.master.machines[machine_id].start()
+        machine_spec = self.root.master.machines[machine_id]
+        # Hold the machine's lock so no other operation on it can sneak in between stopping and starting
+        with machine_spec.machine.lock:
+            self.root.master.forceful_stop(machine_id)
+            try:
+                machine_spec.start()
+            except SpecError as e:
+                raise cherrypy.HTTPError(status=400, message=str(e))
+            except InvalidTransition as e:
+                raise cherrypy.HTTPError(status=409, message=str(e))
+        return machine_id
+
+
+@cherrypy.popargs("machine_id")
+class ZApiMachineMetrics(object):
+    """
+    Endpoint to view a machine's resource usage
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def GET(self, machine_id, history=False):
+        """
+        Return the latest metrics sample of the machine
+        :param history: if true, also return all retained samples
+        """
+        if machine_id not in self.root.master.machines:
+            raise cherrypy.HTTPError(status=404)
+        history = history in [True, 'True', 'true', 'yes', '1', 1]
+        return self.root.master.metrics.get_machine(machine_id, history=history)
+
+
+@cherrypy.popargs("machine_id")
+class ZApiMachineHealth(object):
+    """
+    Endpoint to view the results of a machine's health probes
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def GET(self, machine_id):
+        """
+        Return the machine's health status and the latest result of each probe
+        """
+        if machine_id not in self.root.master.machines:
+            raise cherrypy.HTTPError(status=404)
+        return self.root.master.health.get_machine(machine_id)
+
+
+@cherrypy.popargs("machine_id")
+class ZApiMachineLog(object):
+    """
+    Endpoint to read a machine's console output
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def GET(self, machine_id, tail=16384, follow=False):
+        """
+        Return the end of the machine's output as plain text
+        :param tail: number of bytes to return
+        :param follow: if true, keep the response open and stream new output as it is produced, for up to the API's
+                       follow_timeout
+        """
+        try:
+            machine_spec = self.root.master.machines[machine_id]
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        try:
+            tail = int(tail)
+            assert tail >= 0
+        except (ValueError, AssertionError):
+            raise cherrypy.HTTPError(status=400, message="tail must be a non-negative integer")
+        follow = follow in [True, 'True', 'true', 'yes', '1', 1]
+
+        log = self.root.master.output.get_log(machine_spec)
+        data, position = log.tail(tail)
+        cherrypy.response.headers["Content-Type"] = "text/plain; charset=utf-8"
+        if not follow:
+            return data
+
+        cherrypy.response.stream = True
+        deadline = None if self.root.follow_timeout is None else time() + self.root.follow_timeout
+
+        def stream(data, position):
+            yield data
+            while self.root.master.running and (deadline is None or time() < deadline):
+                data, position = log.wait(position)
+                if data:
+                    yield data
+        return stream(data, position)
+
+
+@cherrypy.popargs("machine_id")
+class ZApiMachineMigrate(object):
+    """
+    Endpoint to move running machines to other nodes
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def POST(self, machine_id, target, bandwidth=None, downtime=None):
+        """
+        Start a live migration of the machine. Returns the job carrying it out, see /job.
+        :param target: nodename of one of the peers in the 'migration' key of zd.json
+        :param bandwidth: limit of the migration stream in MiB/s
+        :param downtime: longest pause of the guest at switchover in milliseconds
+        """
+        try:
+            return self.root.master.migration.migrate(machine_id, target, bandwidth, downtime).serialize()
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        except (SpecError, ValueError) as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+        except (InvalidTransition, JobConflict) as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
+
+
+@cherrypy.popargs("machine_id")
+class ZApiMachineIncoming(object):
+    """
+    Endpoint receiving machines migrated from other nodes, used by the source node of a migration
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def POST(self, machine_id, machine_spec, source=None):
+        """
+        Launch the machine waiting for its migration. Returns the address and port to stream it to.
+        :param machine_spec: json dictionary of the machine's properties
+        :param source: nodename of the source node
+        """
+        try:
+            return self.root.master.migration.prepare_incoming(machine_id, json.loads(machine_spec), source)
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+        except (InvalidTransition, MigrationError) as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
+
+    @cherrypy.tools.json_out()
+    def PUT(self, machine_id):
+        """
+        Take ownership of the machine once its migration completed
+        """
+        try:
+            self.root.master.migration.commit_incoming(machine_id)
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        except (InvalidTransition, MigrationError) as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
+        return machine_id
+
+    @cherrypy.tools.json_out()
+    def DELETE(self, machine_id):
+        """
+        Discard the machine after its migration failed
+        """
+        try:
+            self.root.master.migration.abort_incoming(machine_id)
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        except InvalidTransition as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
         return machine_id
 
 
@@ -183,8 +505,12 @@ class ZApiMachineProperty(object):
         except KeyError:
             raise cherrypy.HTTPError(status=404)
 
-        machine.properties[prop] = value
-        machine.save()
+        properties = dict(machine.properties)
+        properties[prop] = value
+        try:
+            self.root.master.add_machine(machine_id, properties, write=True)
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
         return [machine_id, prop, value]
 
     @cherrypy.tools.json_out()
@@ -198,8 +524,14 @@ class ZApiMachineProperty(object):
         except KeyError:
             raise cherrypy.HTTPError(status=404)
 
-        del machine.properties[prop]
-        machine.save()
+        if prop not in machine.properties:
+            raise cherrypy.HTTPError(status=404)
+        properties = dict(machine.properties)
+        del properties[prop]
+        try:
+            self.root.master.add_machine(machine_id, properties, write=True)
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
         return [machine_id, prop]
 
 
@@ -221,6 +553,11 @@ class ZApiMachines():
         self.start = ZApiMachineStart(self.root)
         self.restart = ZApiMachineRestart(self.root)
         self.property = ZApiMachineProperty(self.root)
+        self.metrics = ZApiMachineMetrics(self.root)
+        self.health = ZApiMachineHealth(self.root)
+        self.log = ZApiMachineLog(self.root)
+        self.migrate = ZApiMachineMigrate(self.root)
+        self.incoming = ZApiMachineIncoming(self.root)
 
     @cherrypy.tools.json_out()
     def GET(self, machine_id=None, summary=False):
@@ -233,9 +570,11 @@ class ZApiMachines():
         machines = {}
         for _machine_id, machine_spec in self.root.master.machines.items():
             machine = {"machine_id": _machine_id,
-                       "_status": machine_spec.machine.get_status()}
+                       "_status": machine_spec.machine.get_status(),
+                       "_health": self.root.master.health.get_status(_machine_id)}
             if not summary:
-                machine.update({"properties": machine_spec.serialize()})
+                machine.update({"properties": machine_spec.serialize(),
+                                "_boot": machine_spec.machine.boot})
 
             machines[_machine_id] = machine
         if machine_id is not None:
@@ -259,7 +598,10 @@ class ZApiMachines():
             "Machine must be stopped to modify"
 
         machine_spec = json.loads(machine_spec)
-        self.root.master.add_machine(machine_id, machine_spec, write=True)
+        try:
+            self.root.master.add_machine(machine_id, machine_spec, write=True)
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
         return machine_id
 
     def DELETE(self, machine_id):
@@ -277,6 +619,65 @@ class ZApiMachines():
         return machine_id
 
 
+@cherrypy.popargs("disk_id")
+class ZApiDiskConvert(object):
+    """
+    Endpoint to rewrite disk images with qemu-img convert
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def POST(self, disk_id, fmt=None, compress=False, sparse=None, preallocation=None):
+        """
+        Start converting the disk's image. Returns the job carrying it out, see /job.
+        :param fmt: format to convert to, raw or qcow2. Defaults to the disk's format
+        :param compress: compress the image, qcow2 only
+        :param sparse: bytes of consecutive zeroes left unallocated in the new image, 0 to allocate everything
+        :param preallocation: preallocation mode of the new image
+        """
+        compress = compress in [True, 'True', 'true', 'yes', '1', 1]
+        try:
+            return self.root.master.disk_jobs.convert(disk_id, fmt, compress, sparse, preallocation).serialize()
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        except (SpecError, ValueError) as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+        except (InvalidTransition, JobConflict) as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
+
+
+@cherrypy.popargs("disk_id")
+class ZApiDiskResize(object):
+    """
+    Endpoint to resize disk images
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def POST(self, disk_id, size, shrink=False, preallocation=None):
+        """
+        Start resizing the disk's image. Returns the job carrying it out, see /job.
+        :param size: new size in megabytes
+        :param shrink: allow the disk to become smaller
+        :param preallocation: preallocation mode of the added space
+        """
+        shrink = shrink in [True, 'True', 'true', 'yes', '1', 1]
+        try:
+            return self.root.master.disk_jobs.resize(disk_id, size, shrink, preallocation).serialize()
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        except (SpecError, ValueError) as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+        except (InvalidTransition, JobConflict, DiskJobError) as e:
+            raise cherrypy.HTTPError(status=409, message=str(e))
+
+
 @cherrypy.popargs("disk_id")
 class ZApiDisks():
     """
@@ -291,6 +692,8 @@ class ZApiDisks():
         TODO how to attach/detach?
         """
         self.root = root
+        self.convert = ZApiDiskConvert(self.root)
+        self.resize = ZApiDiskResize(self.root)
 
     @cherrypy.tools.json_out()
     def GET(self, disk_id=None, summary=False):
@@ -336,3 +739,132 @@ class ZApiDisks():
         """
         self.root.master.remove_disk(disk_id)
         return disk_id
+
+
+class ZApiTemplateClaim(object):
+    """
+    Endpoint to create machines from templates
+    """
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def POST(self, template_id, machine_id=None, count=None):
+        """
+        Create and start machines from the template, resuming warm instances where they are ready
+        :param machine_id: id of the machine to create
+        :param count: number of machines to create instead, named <template_id>-<n>. Returns the list of their ids
+        """
+        if template_id not in self.root.master.pool.templates:
+            raise cherrypy.HTTPError(status=404)
+        if (machine_id is None) == (count is None):
+            raise cherrypy.HTTPError(status=400, message="Pass one of machine_id or count")
+        if count is not None:
+            try:
+                count = int(count)
+                assert count > 0
+            except (ValueError, AssertionError):
+                raise cherrypy.HTTPError(status=400, message="count must be a positive integer")
+        try:
+            if count is None:
+                self.root.master.pool.claim(template_id, [machine_id])
+                return machine_id
+            return [machine_spec.machine_id for machine_spec in self.root.master.pool.claim(template_id, count=count)]
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+
+
+@cherrypy.popargs("template_id")
+class ZApiTemplates(object):
+    """
+    Endpoint for managing machine templates
+    """
+
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+        self.claim = ZApiTemplateClaim(self.root)
+
+    @cherrypy.tools.json_out()
+    def GET(self, template_id=None):
+        """
+        Get a list of all templates or a specific one if passed
+        :param template_id: template to retrieve
+        """
+        counts = self.root.master.pool.get_counts()
+        templates = {}
+        for _template_id, template in list(self.root.master.pool.templates.items()):
+            templates[_template_id] = {"template_id": _template_id,
+                                       "_warm": counts.get((("template", _template_id), ), 0),
+                                       "spec": template.serialize()}
+        if template_id is not None:
+            try:
+                return [templates[template_id]]
+            except KeyError:
+                raise cherrypy.HTTPError(status=404)
+        else:
+            return list(templates.values())
+
+    @cherrypy.tools.json_out()
+    def PUT(self, template_id, template_spec):
+        """
+        Create a new template or update an existing one
+        :param template_id: id of template to create or modify
+        :param template_spec: json dictionary describing the template, see README.md
+        """
+        template_spec = json.loads(template_spec)
+        try:
+            self.root.master.pool.add_template(template_id, template_spec, write=True)
+        except SpecError as e:
+            raise cherrypy.HTTPError(status=400, message=str(e))
+        return template_id
+
+    def DELETE(self, template_id):
+        """
+        Delete a template and its warm instances. Machines created from the template are not affected.
+        :param template_id: ID of template to remove
+        """
+        if template_id not in self.root.master.pool.templates:
+            raise cherrypy.HTTPError(status=404)
+        self.root.master.pool.remove_template(template_id)
+        return template_id
+
+
+@cherrypy.popargs("job_id")
+class ZApiJobs(object):
+    """
+    Endpoint for background jobs, such as migrations and disk conversions
+    """
+
+    exposed = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @cherrypy.tools.json_out()
+    def GET(self, job_id=None):
+        """
+        Get a list of recent jobs or a specific one if passed
+        :param job_id: job to retrieve
+        """
+        if job_id is not None:
+            try:
+                return [self.root.master.jobs.get(job_id).serialize()]
+            except KeyError:
+                raise cherrypy.HTTPError(status=404)
+        return [job.serialize() for job in self.root.master.jobs.list()]
+
+    @cherrypy.tools.json_out()
+    def DELETE(self, job_id):
+        """
+        Cancel a job. It ends at its next progress report, undoing what it started where possible.
+        :param job_id: ID of job to cancel
+        """
+        try:
+            self.root.master.jobs.cancel(job_id)
+        except KeyError:
+            raise cherrypy.HTTPError(status=404)
+        return job_id
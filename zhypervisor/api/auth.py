@@ -0,0 +1,131 @@
+import os
+import hmac
+import base64
+import hashlib
+import logging
+import cherrypy
+from time import time
+from threading import Lock
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class Authenticator(object):
+    """
+    Checks API credentials against the 'access' list of zd.json. Requests carry either HTTP basic credentials or a
+    bearer token issued by /api/v1/auth/token. Tokens are HMAC signed rather than stored, so the server keeps no state
+    per client. Successful checks are cached by Authorization header, so repeated requests cost one dict lookup.
+    """
+    def __init__(self, access, secret=None, token_ttl=3600, cache_size=1024, basic_ttl=60):
+        """
+        :param access: list of [username, password, level] entries. An empty list disables authentication.
+        :param secret: key tokens are signed with. If unset, a random key is used and tokens do not survive restarts.
+        :param token_ttl: seconds an issued token is valid for
+        :param cache_size: number of successful checks remembered
+        :param basic_ttl: seconds a successful check of basic credentials is remembered for
+        """
+        self.random_secret = os.urandom(32)
+        self.cache = OrderedDict()  # Mapping of Authorization header -> (username, time the entry expires), LRU order
+        self.lock = Lock()
+        self.configure(access, secret, token_ttl, cache_size, basic_ttl)
+
+    def configure(self, access, secret=None, token_ttl=3600, cache_size=1024, basic_ttl=60):
+        """
+        Apply new settings, e.g. after zd.json was reloaded. Takes the arguments of the constructor. Cached checks are
+        forgotten so removed users and changed passwords take effect at once. Tokens signed with the random key stay
+        valid.
+        """
+        with self.lock:
+            self.users = {entry[0]: (entry[1], entry[2] if len(entry) > 2 else 0) for entry in access}
+            self.secret = secret.encode("UTF-8") if secret else self.random_secret
+            self.token_ttl = token_ttl
+            self.cache_size = cache_size
+            self.basic_ttl = basic_ttl
+            self.cache.clear()
+        if not self.users:
+            logger.warning("No users in the access list, the API is open to anyone")
+
+    def check(self, header):
+        """
+        Return the username an Authorization header authenticates, or None
+        """
+        now = time()
+        with self.lock:
+            cached = self.cache.get(header)
+            if cached is not None:
+                if cached[1] > now:
+                    self.cache.move_to_end(header)
+                    return cached[0]
+                del self.cache[header]
+        username, expires = self.verify(header, now)
+        if username is not None:
+            # Only successful checks are cached, so clients sending garbage cannot grow the cache
+            with self.lock:
+                self.cache[header] = (username, expires)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return username
+
+    def verify(self, header, now):
+        """
+        Check an Authorization header without the cache. Return the username and until when the result may be cached,
+        or (None, 0).
+        """
+        scheme, _, credentials = header.partition(" ")
+        scheme = scheme.lower()
+        if scheme == "basic":
+            try:
+                username, _, password = base64.b64decode(credentials).decode("UTF-8").partition(":")
+            except ValueError:
+                return None, 0
+            user = self.users.get(username)
+            if user is None or not hmac.compare_digest(user[0].encode("UTF-8"), password.encode("UTF-8")):
+                return None, 0
+            return username, now + self.basic_ttl
+        elif scheme == "bearer":
+            payload, _, signature = credentials.rpartition(":")
+            username, _, expires = payload.rpartition(":")
+            try:
+                expires = int(expires)
+            except ValueError:
+                return None, 0
+            if expires <= now or username not in self.users or \
+                    not hmac.compare_digest(signature, self.sign(username, payload)):
+                return None, 0
+            return username, expires
+        return None, 0
+
+    def sign(self, username, payload):
+        # The user's password is part of the key so changing it revokes the user's tokens
+        key = self.secret + self.users[username][0].encode("UTF-8")
+        return hmac.new(key, payload.encode("UTF-8"), hashlib.sha256).hexdigest()
+
+    def issue_token(self, username):
+        """
+        Return a new token for the user and the time it expires
+        """
+        expires = int(time()) + self.token_ttl
+        payload = "{}:{}".format(username, expires)
+        return "{}:{}".format(payload, self.sign(username, payload)), expires
+
+
+class AuthTool(cherrypy.Tool):
+    """
+    Rejects requests without valid credentials before their body is read. The authenticated user is stored as
+    request.login.
+    """
+    def __init__(self, authenticator):
+        super().__init__("before_request_body", self.authenticate, priority=10)
+        self.authenticator = authenticator
+
+    def authenticate(self):
+        request = cherrypy.serving.request
+        if not self.authenticator.users:
+            return
+        username = self.authenticator.check(request.headers.get("Authorization", ""))
+        if username is None:
+            cherrypy.serving.response.headers["WWW-Authenticate"] = 'Basic realm="zd"'
+            raise cherrypy.HTTPError(status=401)
+        request.login = username
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import base64
+import argparse
+import http.client
+from time import time, sleep
+from queue import LifoQueue, Empty, Full
+from threading import Lock
+from urllib.parse import urlsplit, urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ZClientError(Exception):
+    """
+    The API answered with an error status
+    """
+    def __init__(self, status, message):
+        super().__init__("{}: {}".format(status, message))
+        self.status = status
+        self.message = message
+
+
+class ZClient(object):
+    """
+    Client for the zd HTTP API. Requests are sent over a small pool of keep-alive connections that is safe to share
+    between threads, so scripts making many calls pay for connection setup once.
+    """
+    def __init__(self, url="http://localhost:3000", username=None, password=None, token=None, timeout=30,
+                 connections=8):
+        """
+        :param url: address of the API, e.g. http://host:3000
+        :param username: API user. With a password, requests authenticate with basic credentials or, after
+                         use_token(), with a bearer token renewed as it expires.
+        :param token: bearer token to authenticate with instead of a password
+        :param timeout: socket timeout of requests in seconds
+        :param connections: most connections kept open, and threads used by the fan-out helpers
+        """
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.prefix = url.path.rstrip("/") + "/api/v1"
+        self.username = username
+        self.password = password
+        self.token = token
+        self.token_expires = None  # Renewal time of a token issued by use_token()
+        self.timeout = timeout
+        self.connections = connections
+        self.pool = LifoQueue(connections)  # Idle connections, most recently used first
+        self.lock = Lock()
+
+    def close(self):
+        """
+        Close idle connections
+        """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Empty:
+                return
+
+    def get_authorization(self):
+        if self.token_expires is not None and time() >= self.token_expires:
+            with self.lock:
+                if time() >= self.token_expires:
+                    self.token_expires = None
+                    self.use_token()
+        if self.token:
+            return "Bearer " + self.token
+        if self.username is not None:
+            credentials = "{}:{}".format(self.username, self.password or "")
+            return "Basic " + base64.b64encode(credentials.encode("UTF-8")).decode()
+        return None
+
+    def use_token(self):
+        """
+        Exchange the password for a bearer token and authenticate with it from now on. The token is renewed shortly
+        before it expires.
+        """
+        self.token = None
+        result = self.request("POST", "/auth/token")
+        self.token = result["token"]
+        self.token_expires = result["expires"] - min(60, (result["expires"] - time()) / 2)
+        return result
+
+    def request(self, method, path, params=None, raw=False):
+        """
+        Send a request and return its decoded json response, or bytes if raw is set. Raises ZClientError if the API
+        answers with an error.
+        :param path: path below /api/v1
+        :param params: dict of parameters, sent in the query string of GET requests and as a form otherwise
+        """
+        headers = {}
+        authorization = self.get_authorization()
+        if authorization:
+            headers["Authorization"] = authorization
+        path = self.prefix + path
+        body = None
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        if params:
+            if method == "GET":
+                path += "?" + urlencode(params)
+            else:
+                body = urlencode(params)
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif method != "GET":
+            body = ""  # cherrypy requires a length for request bodies
+
+        response, data = self.send(method, path, body, headers)
+        if response.status >= 400:
+            raise ZClientError(response.status, self.error_message(data))
+        if raw:
+            return data
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            return json.loads(data.decode("UTF-8"))
+        return data.decode("UTF-8")
+
+    def send(self, method, path, body, headers):
+        """
+        Send a request over a pooled connection. If a pooled connection turns out to have been closed by the server,
+        the idle connections are dropped and the request is sent again over a new one.
+        """
+        for attempt in range(2):
+            try:
+                connection = self.pool.get_nowait()
+                reused = True
+            except Empty:
+                connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+                reused = False
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused and attempt == 0:
+                    self.close()
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            self.release(connection, response)
+            return response, data
+
+    def release(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        try:
+            self.pool.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    @staticmethod
+    def error_message(data):
+        text = data.decode("UTF-8", "replace")
+        match = re.search(r"<p>(.*?)</p>", text, re.S)  # cherrypy's html error page
+        return match.group(1).strip() if match else text.split("\n\n")[0].strip()
+
+    def fan_out(self, func, ids, *args, **kwargs):
+        """
+        Call func(id, *args, **kwargs) for each id in parallel over the connection pool. Returns a dict of id -> result,
+        with the exception raised in place of the result of calls that failed.
+        """
+        def call(item_id):
+            try:
+                return func(item_id, *args, **kwargs)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(min(self.connections, max(len(ids), 1))) as executor:
+            return dict(zip(ids, executor.map(call, ids)))
+
+    # Machines
+
+    def get_machines(self, summary=False):
+        """
+        Return the description of all machines
+        :param summary: leave out the machines' properties
+        """
+        return self.request("GET", "/machine/", {"summary": "true" if summary else None})
+
+    def get_machine(self, machine_id):
+        return self.request("GET", "/machine/{}".format(quote(machine_id)))[0]
+
+    def put_machine(self, machine_id, machine_spec):
+        """
+        Create or update a machine
+        :param machine_spec: dict of the machine's properties
+        """
+        return self.request("PUT", "/machine/{}".format(quote(machine_id)), {"machine_spec": json.dumps(machine_spec)})
+
+    def delete_machine(self, machine_id):
+        return self.request("DELETE", "/machine/{}".format(quote(machine_id)))
+
+    def start_machine(self, machine_id):
+        return self.request("GET", "/machine/{}/start".format(quote(machine_id)))
+
+    def stop_machine(self, machine_id):
+        return self.request("GET", "/machine/{}/stop".format(quote(machine_id)))
+
+    def restart_machine(self, machine_id):
+        return self.request("GET", "/machine/{}/restart".format(quote(machine_id)))
+
+    def get_property(self, machine_id, prop):
+        return self.request("GET", "/machine/{}/property/{}".format(quote(machine_id), quote(prop)))
+
+    def set_property(self, machine_id, prop, value):
+        """
+        Set a property of a stopped machine
+        :param value: any json serializable value
+        """
+        return self.request("PUT", "/machine/{}/property/{}".format(quote(machine_id), quote(prop)),
+                            {"value": json.dumps(value)})
+
+    def delete_property(self, machine_id, prop):
+        return self.request("DELETE", "/machine/{}/property/{}".format(quote(machine_id), quote(prop)))
+
+    def get_machine_metrics(self, machine_id, history=False):
+        return self.request("GET", "/machine/{}/metrics".format(quote(machine_id)),
+                            {"history": "true" if history else None})
+
+    def get_machine_health(self, machine_id):
+        return self.request("GET", "/machine/{}/health".format(quote(machine_id)))
+
+    def get_machine_log(self, machine_id, tail=16384):
+        """
+        Return the last tail bytes of a machine's output
+        """
+        return self.request("GET", "/machine/{}/log".format(quote(machine_id)), {"tail": tail}, raw=True)
+
+    def follow_machine_log(self, machine_id, tail=16384):
+        """
+        Yield a machine's output as it is produced, starting with the last tail bytes. Uses a connection of its own.
+        """
+        connection = self.connection_class(self.host, self.port, timeout=None)
+        headers = {}
+        authorization = self.get_authorization()
+        if authorization:
+            headers["Authorization"] = authorization
+        try:
+            connection.request("GET", "{}/machine/{}/log?{}".format(self.prefix, quote(machine_id),
+                                                                    urlencode({"tail": tail, "follow": "true"})),
+                               headers=headers)
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise ZClientError(response.status, self.error_message(response.read()))
+            while True:
+                data = response.read1(65536)
+                if not data:
+                    return
+                yield data
+        finally:
+            connection.close()
+
+    def migrate_machine(self, machine_id, target, bandwidth=None, downtime=None):
+        """
+        Start a live migration of a running machine to another node and return the job carrying it out
+        :param target: nodename of a peer in the 'migration' key of the node's zd.json
+        :param bandwidth: limit of the migration stream in MiB/s
+        :param downtime: longest pause of the guest at switchover in milliseconds
+        """
+        return self.request("POST", "/machine/{}/migrate".format(quote(machine_id)),
+                            {"target": target, "bandwidth": bandwidth, "downtime": downtime})
+
+    def prepare_incoming(self, machine_id, machine_spec, source=None):
+        """
+        Have the node launch a machine waiting for a migration, see zhypervisor.migration. Returns the address and port
+        to stream it to.
+        """
+        return self.request("POST", "/machine/{}/incoming".format(quote(machine_id)),
+                            {"machine_spec": json.dumps(machine_spec), "source": source})
+
+    def commit_incoming(self, machine_id):
+        return self.request("PUT", "/machine/{}/incoming".format(quote(machine_id)))
+
+    def abort_incoming(self, machine_id):
+        return self.request("DELETE", "/machine/{}/incoming".format(quote(machine_id)))
+
+    def start_machines(self, machine_ids):
+        return self.fan_out(self.start_machine, machine_ids)
+
+    def stop_machines(self, machine_ids):
+        return self.fan_out(self.stop_machine, machine_ids)
+
+    def restart_machines(self, machine_ids):
+        return self.fan_out(self.restart_machine, machine_ids)
+
+    def delete_machines(self, machine_ids):
+        return self.fan_out(self.delete_machine, machine_ids)
+
+    def set_properties(self, machine_ids, prop, value):
+        return self.fan_out(self.set_property, machine_ids, prop, value)
+
+    # Disks
+
+    def get_disks(self):
+        return self.request("GET", "/disk/")
+
+    def get_disk(self, disk_id):
+        return self.request("GET", "/disk/{}".format(quote(disk_id)))[0]
+
+    def put_disk(self, disk_id, disk_spec):
+        """
+        Create or update a disk
+        :param disk_spec: dict of the disk's properties
+        """
+        return self.request("PUT", "/disk/{}".format(quote(disk_id)), {"disk_spec": json.dumps(disk_spec)})
+
+    def delete_disk(self, disk_id):
+        return self.request("DELETE", "/disk/{}".format(quote(disk_id)))
+
+    def convert_disk(self, disk_id, fmt=None, compress=False, sparse=None, preallocation=None):
+        """
+        Start rewriting a disk's image with qemu-img convert and return the job carrying it out
+        :param fmt: format to convert to, defaults to the disk's format
+        :param compress: compress the image, qcow2 only
+        :param sparse: bytes of consecutive zeroes left unallocated in the new image, 0 to allocate everything
+        :param preallocation: preallocation mode of the new image
+        """
+        return self.request("POST", "/disk/{}/convert".format(quote(disk_id)),
+                            {"fmt": fmt, "compress": compress or None, "sparse": sparse,
+                             "preallocation": preallocation})
+
+    def resize_disk(self, disk_id, size, shrink=False, preallocation=None):
+        """
+        Start resizing a disk's image and return the job carrying it out
+        :param size: new size in megabytes
+        :param shrink: allow the disk to become smaller
+        :param preallocation: preallocation mode of the added space
+        """
+        return self.request("POST", "/disk/{}/resize".format(quote(disk_id)),
+                            {"size": size, "shrink": shrink or None, "preallocation": preallocation})
+
+    # Templates
+
+    def get_templates(self):
+        return self.request("GET", "/template/")
+
+    def get_template(self, template_id):
+        return self.request("GET", "/template/{}".format(quote(template_id)))[0]
+
+    def put_template(self, template_id, template_spec):
+        return self.request("PUT", "/template/{}".format(quote(template_id)),
+                            {"template_spec": json.dumps(template_spec)})
+
+    def delete_template(self, template_id):
+        return self.request("DELETE", "/template/{}".format(quote(template_id)))
+
+    def claim(self, template_id, machine_id=None, count=None):
+        """
+        Create and start machines from a template. Pass one of machine_id, or count to create that many machines.
+        """
+        return self.request("POST", "/template/{}/claim".format(quote(template_id)),
+                            {"machine_id": machine_id, "count": count})
+
+    # Jobs
+
+    def get_jobs(self):
+        return self.request("GET", "/job/")
+
+    def get_job(self, job_id):
+        return self.request("GET", "/job/{}".format(quote(job_id)))[0]
+
+    def cancel_job(self, job_id):
+        return self.request("DELETE", "/job/{}".format(quote(job_id)))
+
+    def wait_job(self, job_id, interval=1, callback=None):
+        """
+        Poll a job until it has finished and return it
+        :param callback: called with the job after every poll, e.g. to show progress
+        """
+        while True:
+            job = self.get_job(job_id)
+            if callback is not None:
+                callback(job)
+            if job["finished"] is not None:
+                return job
+            sleep(interval)
+
+    # Daemon
+
+    def get_metrics(self):
+        """
+        Return the daemon's metrics in prometheus text format
+        """
+        return self.request("GET", "/metrics")
+
+    def profile(self, seconds=10, mode="sample", interval=0.01):
+        """
+        Profile the daemon and return the result as bytes
+        """
+        return self.request("GET", "/admin/profile", {"seconds": seconds, "mode": mode, "interval": interval},
+                            raw=True)
+
+
+def load_json_arg(value):
+    """
+    Parse a json argument, reading it from a file if it is given as @path
+    """
+    if value.startswith("@"):
+        with open(value[1:]) as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control a zd hypervisor")
+    parser.add_argument("-u", "--url", default=os.environ.get("ZD_URL", "http://localhost:3000"),
+                        help="API address, or $ZD_URL")
+    parser.add_argument("--user", default=os.environ.get("ZD_USER"), help="API user, or $ZD_USER")
+    parser.add_argument("--password", default=os.environ.get("ZD_PASSWORD"), help="API password, or $ZD_PASSWORD")
+    parser.add_argument("--token", default=os.environ.get("ZD_TOKEN"), help="API bearer token, or $ZD_TOKEN")
+    parser.add_argument("-j", "--parallel", type=int, default=8, help="requests in flight when acting on many ids")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    command = commands.add_parser("list", help="list machines")
+    command.add_argument("-s", "--summary", action="store_true", help="leave out properties")
+    command = commands.add_parser("show", help="describe machines")
+    command.add_argument("machine_ids", nargs="+")
+    command = commands.add_parser("create", help="create or update a machine")
+    command.add_argument("machine_id")
+    command.add_argument("spec", help="machine properties as json, or @file")
+    for name in ("start", "stop", "restart", "delete"):
+        command = commands.add_parser(name, help="{} machines".format(name))
+        command.add_argument("machine_ids", nargs="+")
+    command = commands.add_parser("health", help="show the health of machines")
+    command.add_argument("machine_ids", nargs="+")
+    command = commands.add_parser("get", help="get a machine property")
+    command.add_argument("machine_id")
+    command.add_argument("prop")
+    command = commands.add_parser("set", help="set a property of machines")
+    command.add_argument("prop")
+    command.add_argument("value", help="json value")
+    command.add_argument("machine_ids", nargs="+")
+    command = commands.add_parser("unset", help="remove a machine property")
+    command.add_argument("machine_id")
+    command.add_argument("prop")
+    command = commands.add_parser("log", help="print a machine's output")
+    command.add_argument("machine_id")
+    command.add_argument("-n", "--tail", type=int, default=16384, help="bytes of past output to print")
+    command.add_argument("-f", "--follow", action="store_true", help="keep printing new output")
+    command = commands.add_parser("migrate", help="move a running machine to another node")
+    command.add_argument("machine_id")
+    command.add_argument("target", help="nodename of the node to move it to")
+    command.add_argument("--bandwidth", type=float, help="limit of the migration stream in MiB/s")
+    command.add_argument("--downtime", type=int, help="longest pause of the guest in milliseconds")
+    command.add_argument("-w", "--wait", action="store_true", help="wait for the migration to finish")
+    command = commands.add_parser("jobs", help="list background jobs")
+    command = commands.add_parser("job", help="show a background job")
+    command.add_argument("job_id")
+    command.add_argument("-w", "--wait", action="store_true", help="wait for the job to finish")
+    command = commands.add_parser("cancel-job", help="cancel a background job")
+    command.add_argument("job_id")
+    command = commands.add_parser("disks", help="list disks")
+    command = commands.add_parser("create-disk", help="create or update a disk")
+    command.add_argument("disk_id")
+    command.add_argument("spec", help="disk properties as json, or @file")
+    command = commands.add_parser("delete-disk", help="delete disks")
+    command.add_argument("disk_ids", nargs="+")
+    command = commands.add_parser("convert-disk", help="convert, compress or sparsify a disk's image")
+    command.add_argument("disk_id")
+    command.add_argument("--fmt", help="format to convert to")
+    command.add_argument("--compress", action="store_true", help="compress the image, qcow2 only")
+    command.add_argument("--sparse", type=int, help="bytes of zeroes left unallocated, 0 to allocate everything")
+    command.add_argument("--preallocation", help="preallocation mode of the new image")
+    command.add_argument("-w", "--wait", action="store_true", help="wait for the conversion to finish")
+    command = commands.add_parser("resize-disk", help="resize a disk's image")
+    command.add_argument("disk_id")
+    command.add_argument("size", type=int, help="new size in megabytes")
+    command.add_argument("--shrink", action="store_true", help="allow the disk to become smaller")
+    command.add_argument("--preallocation", help="preallocation mode of the added space")
+    command.add_argument("-w", "--wait", action="store_true", help="wait for the resize to finish")
+    command = commands.add_parser("templates", help="list templates")
+    command = commands.add_parser("create-template", help="create or update a template")
+    command.add_argument("template_id")
+    command.add_argument("spec", help="template properties as json, or @file")
+    command = commands.add_parser("delete-template", help="delete a template")
+    command.add_argument("template_id")
+    command = commands.add_parser("claim", help="create machines from a template")
+    command.add_argument("template_id")
+    group = command.add_mutually_exclusive_group(required=True)
+    group.add_argument("--name", help="id of the machine to create")
+    group.add_argument("--count", type=int, help="number of machines to create")
+    command = commands.add_parser("metrics", help="print the daemon's metrics")
+    command = commands.add_parser("token", help="print a bearer token")
+    args = parser.parse_args()
+
+    client = ZClient(args.url, username=args.user, password=args.password, token=args.token,
+                     connections=args.parallel)
+    many = {"start": client.start_machines, "stop": client.stop_machines, "restart": client.restart_machines,
+            "delete": client.delete_machines, "show": lambda ids: client.fan_out(client.get_machine, ids),
+            "health": lambda ids: client.fan_out(client.get_machine_health, ids),
+            "set": lambda ids: client.set_properties(ids, args.prop, load_json_arg(args.value)),
+            "delete-disk": lambda ids: client.fan_out(client.delete_disk, ids)}
+    try:
+        if args.command in many:
+            ids = args.disk_ids if args.command == "delete-disk" else args.machine_ids
+            results = many[args.command](ids)
+            failed = False
+            for item_id, result in results.items():
+                if isinstance(result, Exception):
+                    failed = True
+                    print("{}: {}".format(item_id, result), file=sys.stderr)
+                elif args.command in ("show", "health"):
+                    print(json.dumps(result, indent=4))
+            return 1 if failed else 0
+        elif args.command == "log":
+            out = sys.stdout.buffer
+            if args.follow:
+                for data in client.follow_machine_log(args.machine_id, tail=args.tail):
+                    out.write(data)
+                    out.flush()
+            else:
+                out.write(client.get_machine_log(args.machine_id, tail=args.tail))
+            return 0
+        elif args.command == "metrics":
+            print(client.get_metrics(), end="")
+            return 0
+        elif args.command in ("migrate", "job", "convert-disk", "resize-disk") and args.wait:
+            if args.command == "migrate":
+                job = client.migrate_machine(args.machine_id, args.target, args.bandwidth, args.downtime)
+            elif args.command == "convert-disk":
+                job = client.convert_disk(args.disk_id, args.fmt, args.compress, args.sparse, args.preallocation)
+            elif args.command == "resize-disk":
+                job = client.resize_disk(args.disk_id, args.size, args.shrink, args.preallocation)
+            else:
+                job = client.get_job(args.job_id)
+            job = client.wait_job(job["job_id"], callback=lambda job: print(
+                "{:>5.1f}% {}".format(job["progress"] * 100, job["message"] or job["status"]), file=sys.stderr))
+            print(json.dumps(job, indent=4))
+            return 0 if job["status"] == "done" else 1
+
+        result = {"list": lambda: client.get_machines(summary=args.summary),
+                  "create": lambda: client.put_machine(args.machine_id, load_json_arg(args.spec)),
+                  "get": lambda: client.get_property(args.machine_id, args.prop),
+                  "unset": lambda: client.delete_property(args.machine_id, args.prop),
+                  "disks": client.get_disks,
+                  "create-disk": lambda: client.put_disk(args.disk_id, load_json_arg(args.spec)),
+                  "convert-disk": lambda: client.convert_disk(args.disk_id, args.fmt, args.compress, args.sparse,
+                                                              args.preallocation),
+                  "resize-disk": lambda: client.resize_disk(args.disk_id, args.size, args.shrink, args.preallocation),
+                  "templates": client.get_templates,
+                  "create-template": lambda: client.put_template(args.template_id, load_json_arg(args.spec)),
+                  "delete-template": lambda: client.delete_template(args.template_id),
+                  "claim": lambda: client.claim(args.template_id, machine_id=args.name, count=args.count),
+                  "migrate": lambda: client.migrate_machine(args.machine_id, args.target, args.bandwidth,
+                                                            args.downtime),
+                  "jobs": client.get_jobs,
+                  "job": lambda: client.get_job(args.job_id),
+                  "cancel-job": lambda: client.cancel_job(args.job_id),
+                  "token": client.use_token}[args.command]()
+        print(json.dumps(result, indent=4))
+        return 0
+    except ZClientError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except (OSError, http.client.HTTPException) as e:
+        print("Could not reach {}: {}".format(args.url, e), file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,73 +1,191 @@
 import os
+import json
+import socket
 import logging
 import subprocess
-from time import sleep
+import http.client
+from time import time, sleep
 from threading import Thread
 from zhypervisor.util import ZDisk
-from zhypervisor.util import Machine
+from zhypervisor.util import Machine, LaunchPlan
+from zhypervisor.schema import SpecError, Field, COMMON_FIELDS, positive, non_negative, disk_exists
 
 
-class DockerMachine(Machine):
-    machine_type = "docker"
+logger = logging.getLogger(__name__)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection that connects to a unix socket instead of a tcp host
+    """
+    def __init__(self, path, timeout=10):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def docker_api(path, socket_path="/var/run/docker.sock"):
+    """
+    Make a GET request to the docker engine api and return the decoded json response
+    """
+    conn = UnixHTTPConnection(socket_path)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise Exception("Docker api returned {} for {}: {}".format(response.status, path, body))
+        return json.loads(body.decode("UTF-8"))
+    finally:
+        conn.close()
+
+
+def port_mapping(master, value, path):
+    if len(value) != 2 or not all(isinstance(port, int) and 0 < port < 65536 for port in value):
+        raise SpecError("{} must be a pair of [host port, container port]".format(path))
 
-    def __init__(self, spec):
-        Machine.__init__(self, spec)
-        self.proc = None
-        self.block_respawns = False
 
-    def get_status(self):
+class DockerMachine(Machine):
+    machine_type = "docker"
+    schema = dict(COMMON_FIELDS,
+                  image=Field(str, required=True),
+                  cmd=Field(str),
+                  hostname=Field(str),
+                  ports=Field(list, items=Field(list, check=port_mapping)),
+                  volumes=Field(list, items=Field(dict, fields={"disk": Field(str, required=True, check=disk_exists),
+                                                                "mountpoint": Field(str, required=True)})),
+                  stopsignal=Field(int, check=positive),
+                  timeout=Field(int, check=non_negative))
+
+    def spawn(self, plan):
         """
-        Return string "stopped" or "running" depending on machine status
+        Launch the container
         """
-        return "stopped" if self.proc is None else "running"
-
-    def start_machine(self):
+        docker_args = list(plan.argv)
+        detached = self.is_detached()
+        if detached:
+            # Decided at each spawn rather than in the plan, as detach can be changed by a reload
+            docker_args.insert(2, "--detach")
+        self.log.info("spawning docker with: {}".format(' '.join(docker_args)))
+        spawned = time()
+        with self.spec.master.stats.timer("zd_lifecycle_seconds", phase="spawn", type=self.machine_type):
+            if detached:
+                # The container is left to docker; we supervise it through a `docker wait` process instead
+                subprocess.check_call(docker_args, stdout=subprocess.DEVNULL)
+                proc = self.spawn_waiter()
+                self.follow_logs(spawned)
+            else:
+                output = self.spec.master.output.open(self.spec)
+                try:
+                    proc = subprocess.Popen(docker_args, preexec_fn=lambda: os.setpgrp(), stdin=subprocess.DEVNULL,
+                                            stdout=output, stderr=output)
+                finally:
+                    os.close(output)
+        self.spec.master.state.write_runinfo(self.spec.machine_id, {"type": self.machine_type,
+                                                                    "container": self.spec.machine_id,
+                                                                    "started": spawned})
+        return proc
+
+    def follow_logs(self, since):
+        """
+        Capture the output of a detached container through `docker logs`. The container does not depend on this
+        process, which exits by itself when the container stops.
+        :param since: unix time to capture output from
+        """
+        output = self.spec.master.output.open_pipe(self.spec)
+        try:
+            subprocess.Popen(["docker", "logs", "--follow", "--since", str(int(since)), self.spec.machine_id],
+                             preexec_fn=lambda: os.setpgrp(), stdin=subprocess.DEVNULL, stdout=output, stderr=output)
+        finally:
+            os.close(output)
+
+    def spawn_waiter(self):
         """
-        If needed, launch the machine.
+        Return a process that exits when the container does
         """
-        if self.proc:
-            raise Exception("Machine already running!")
-        else:
-            docker_args = self.get_args()
-            logging.info("spawning docker with: {}".format(' '.join(docker_args)))
-            sleep(1)  # anti-spin
-            self.proc = subprocess.Popen(docker_args, preexec_fn=lambda: os.setpgrp())
-            # TODO handle stdout/err - stream to logs?
-            Thread(target=self.wait_on_exit, args=[self.proc]).start()
+        return subprocess.Popen(["docker", "wait", self.spec.machine_id], preexec_fn=lambda: os.setpgrp(),
+                                stdout=subprocess.DEVNULL)
 
-    def wait_on_exit(self, proc):
+    def reattach(self):
         """
-        Listener used by above start_machine to restart the machine if the machine exits
+        Resume supervision of the container if a previous daemon launched it and it is still running
         """
-        proc.wait()
-        logging.info("docker process has exited")
-        self.proc = None
-        if not self.block_respawns and self.spec.properties.get("respawn", False):
-            self.start_machine()
+        state = self.spec.master.state
+        info = state.get_runinfo(self.spec.machine_id)
+        if info is None or info.get("type") != self.machine_type:
+            return False
+        try:
+            running = docker_api("/containers/{}/json".format(info["container"]))["State"]["Running"]
+        except Exception as e:
+            self.log.info("Recorded container of %s is gone: %s", self.spec.machine_id, e)
+            running = False
+        if not running:
+            state.remove_runinfo(self.spec.machine_id)
+            return False
+        self.adopt(self.spawn_waiter())
+        self.follow_logs(time())
+        return True
+
+    def cleanup(self):
+        self.spec.master.state.remove_runinfo(self.spec.machine_id)
+
+    def send_powerdown(self, proc):
+        """
+        Begin stopping the container and return immediately. Docker delivers the stop signal and kills the container
+        itself if it is still running after the configured timeout.
+        """
+        Thread(target=self.signal_container, args=[proc, "stop"], daemon=True).start()
 
-    def stop_machine(self):
+    def send_kill(self, proc):
         """
-        Send the powerdown signal to the running machine
+        Kill the container, then the process supervising it
         """
-        if self.proc:
-            logging.info("stopping machine %s", self.spec.machine_id)
-            subprocess.check_call(["docker", "stop", self.spec.machine_id])
-            self.proc.wait()
-            self.proc = None
+        self.signal_container(proc, "kill", timeout=5)
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
 
-    def kill_machine(self):
+    def signal_container(self, proc, command, timeout=None):
+        """
+        Run docker stop or kill on the container. A container whose docker run was just spawned may not exist yet, so
+        the command is retried until it succeeds, the supervised process exits or timeout seconds have passed.
+        """
+        deadline = None if timeout is None else time() + timeout
+        while subprocess.call(["docker", command, self.spec.machine_id], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL) != 0:
+            if proc.poll() is not None or deadline is not None and time() > deadline:
+                return
+            sleep(0.1)
+
+    def get_stats(self):
         """
-        Forcefully kill the running machine
+        Return resource usage of the container as reported by the docker stats api. The docker client process we
+        supervise uses next to no resources itself, so /proc is not consulted.
         """
-        print("Terminating {}".format(self.proc))
-        if self.proc:
-            subprocess.check_call(["docker", "kill", self.spec.machine_id])
-            try:
-                self.proc.wait(5)
-            except subprocess.TimeoutError:
-                self.proc.kill()
-            self.proc.wait()
-            self.proc = None
+        if not self.proc:
+            return {}
+        stats = docker_api("/containers/{}/stats?stream=false&one-shot=true".format(self.spec.machine_id))
+        sample = {"cpu_seconds": stats["cpu_stats"]["cpu_usage"]["total_usage"] / 1e9,
+                  "rss_bytes": stats["memory_stats"].get("usage", 0)}
+
+        blkio = stats.get("blkio_stats", {}).get("io_service_bytes_recursive") or []
+        sample["block_read_bytes"] = sum(i["value"] for i in blkio if i["op"].lower() == "read")
+        sample["block_write_bytes"] = sum(i["value"] for i in blkio if i["op"].lower() == "write")
+
+        networks = (stats.get("networks") or {}).values()
+        sample["net_rx_bytes"] = sum(n["rx_bytes"] for n in networks)
+        sample["net_tx_bytes"] = sum(n["tx_bytes"] for n in networks)
+        return sample
+
+    def compile_plan(self):
+        disks = tuple((volume["disk"], self.spec.master.disks[volume["disk"]].get_path())
+                      for volume in self.spec.properties.get("volumes", []))
+        return LaunchPlan(argv=tuple(self.get_args()), disks=disks, netifaces=())
 
     def get_args(self):
         """
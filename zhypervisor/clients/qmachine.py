@@ -1,141 +1,570 @@
 import os
 import logging
 import subprocess
-from time import sleep
+from time import sleep, time
 from threading import Thread
 
-from zhypervisor.util import TapDevice, Machine
+from zhypervisor.util import TapDevice, Machine, PidHandle, LaunchPlan, read_cmdline, scope_args
+from zhypervisor.schema import SpecError, Field, COMMON_FIELDS, positive, non_negative, disk_exists, datastore_exists, \
+    one_of
 from zhypervisor.util import ZDisk
+from zhypervisor.metrics import read_iface_stats
+from zhypervisor.clients.qmp import QMPClient, QMPError
+from zhypervisor.clients.dockermachine import DockerDisk
+from zhypervisor.clients.virtiofs import find_virtiofsd, virtiofsd_args, start_virtiofsd
+from zhypervisor.jobs import JobCancelled
+
+
+logger = logging.getLogger(__name__)
+
+
+def vnc_display(master, value, path):
+    if value is True or value < 0:
+        raise SpecError("{} must be a VNC display number, or false".format(path))
+
+
+def get_boot_file(master, kernel, key):
+    """
+    Return the path of the kernel or initrd file of a machine's kernel property
+    """
+    return master.datastores[kernel.get("datastore", "default")].get_filepath(kernel[key])
+
+
+def boot_files(master, value, path):
+    for key in ("kernel", "initrd"):
+        if key not in value:
+            continue
+        # Files are named relative to their datastore and may not be outside of it
+        name = os.path.normpath(value[key])
+        if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+            raise SpecError("{}.{} must be a path within the datastore".format(path, key))
+        if not os.path.isfile(get_boot_file(master, value, key)):
+            raise SpecError("{}.{} not found: {}".format(path, key, get_boot_file(master, value, key)))
+
+
+# Keys of a machine's kernel property, for booting a kernel directly rather than through firmware and a bootloader
+KERNEL_FIELDS = {"datastore": Field(str, check=datastore_exists),
+                 "kernel": Field(str, required=True),
+                 "initrd": Field(str),
+                 "append": Field(str)}
+
+# Keys of each of a machine's volumes, directory disks shared with the guest as a filesystem
+VOLUME_FIELDS = {"disk": Field(str, required=True, check=disk_exists),
+                 "tag": Field(str),
+                 "transport": Field(str, check=one_of("virtiofs", "9p")),
+                 "cache": Field(str, check=one_of("never", "metadata", "auto", "always")),
+                 "dax": Field(int, check=positive),
+                 "readonly": Field(bool)}
 
 
 class QMachine(Machine):
     machine_type = "q"
+    probe_types = ("tcp", "http", "qmp", "agent")
+    running_on_spawn = False  # recorded once qemu reports the guest running, see wait_for_qmp()
+    schema = dict(COMMON_FIELDS,
+                  cores=Field(int, check=positive),
+                  mem=Field(int, check=positive),
+                  vnc=Field(int, bool, check=vnc_display),
+                  console=Field(bool),
+                  machine=Field(str),
+                  boot=Field(str),
+                  kernel=Field(dict, fields=KERNEL_FIELDS, check=boot_files),
+                  drives=Field(list, items=Field(dict, fields={"disk": Field(str, required=True, check=disk_exists),
+                                                               "if": Field(str),
+                                                               "index": Field(int, check=non_negative),
+                                                               "media": Field(str)})),
+                  volumes=Field(list, items=Field(dict, fields=VOLUME_FIELDS)),
+                  netifaces=Field(list, items=Field(dict, fields={"type": Field(str, required=True),
+                                                                  "ifname": Field(str)})))
 
     def __init__(self, spec):
         Machine.__init__(self, spec)
-        self.proc = None
-        self.tap = TapDevice()
-        self.block_respawns = False
-        # TODO validate specs
+        self.tap = TapDevice(spec.master.allocators.tap.get(spec.machine_id))
+        self.qmp = QMPClient(self.get_qmp_path())
+        self.agent_path = self.get_agent_path()  # guest agent socket of the running process
+        self.start_paused = False  # launch qemu with its cpus stopped, see zhypervisor.pool
+        self.incoming = None  # port to launch qemu waiting for an incoming migration on, see zhypervisor.migration
+        self.helpers = []  # virtiofsd processes of the running qemu
+
+    @classmethod
+    def validate_spec(cls, master, properties):
+        super().validate_spec(master, properties)
+        if cls.is_microvm(properties):
+            # microvm has no firmware to boot from disks, and only virtio-mmio devices
+            if "kernel" not in properties:
+                raise SpecError("microvm machines must boot a kernel")
+            for i, drive in enumerate(properties.get("drives", [])):
+                if drive.get("media", "disk") != "disk" or drive.get("if", "virtio") != "virtio":
+                    raise SpecError("drives[{}]: microvm machines only support virtio disks".format(i))
+            netifaces = properties.get("netifaces", [])
+            nics = [i for i, iface in enumerate(netifaces) if iface["type"] == "nic"]
+            for i in nics:
+                if netifaces[i].get("model", "virtio-net-device") != "virtio-net-device":
+                    raise SpecError("netifaces[{}]: microvm machines only support virtio-net-device nics".format(i))
+            if len(nics) > len(netifaces) - len(nics):
+                raise SpecError("netifaces[{}]: microvm nics are each attached to a backend, such as a tap, and this "
+                                "one has none".format(nics[len(netifaces) - len(nics)]))
+        if "kernel" in properties and "boot" in properties:
+            raise SpecError("boot cannot be set for machines booting a kernel")
+        tags = set()
+        for i, volume in enumerate(properties.get("volumes", [])):
+            if not isinstance(master.disks[volume["disk"]], DockerDisk):
+                raise SpecError("volumes[{}].disk must be a directory disk, of type dockerdisk".format(i))
+            tag = volume.get("tag", volume["disk"])
+            if tag in tags or len(tag.encode("UTF-8")) > 36:
+                raise SpecError("volumes[{}].tag must be unique and at most 36 bytes long".format(i))
+            tags.add(tag)
+            if "dax" in volume and (volume.get("transport") == "9p" or cls.is_microvm(properties)):
+                raise SpecError("volumes[{}].dax needs virtiofs on a machine with pci".format(i))
+            if "cache" in volume and volume.get("transport") == "9p":
+                raise SpecError("volumes[{}].cache only applies to virtiofs, 9p caching is set by the guest's mount "
+                                "options".format(i))
+
+    @staticmethod
+    def is_microvm(properties):
+        return properties.get("machine", "").split(",")[0] == "microvm"
 
-    def get_status(self):
+    def get_qmp_path(self):
         """
-        Return string "stopped" or "running" depending on machine status
-        @TODO machine status consts
+        Return the path of the unix socket qemu listens for QMP connections on
         """
-        return "stopped" if self.proc is None else "running"
+        return self.spec.master.state.get_runpath("{}.qmp".format(self.spec.machine_id))
 
-    def start_machine(self):
+    def get_agent_path(self):
         """
-        If needed, launch the machine.
+        Return the path of the unix socket qemu connects the guest agent channel to
         """
-        if self.proc:
-            raise Exception("Machine already running!")
-        else:
-            qemu_args = self.get_args(tap=str(self.tap))
-            logging.info("spawning qemu with: {}".format(' '.join(qemu_args)))
-            sleep(1)  # anti-spin
-            self.proc = subprocess.Popen(qemu_args, preexec_fn=lambda: os.setpgrp(), stdin=subprocess.PIPE)
-            # TODO handle stdout/err - stream to logs?
-            Thread(target=self.wait_on_exit, args=[self.proc]).start()
+        return self.spec.master.state.get_runpath("{}.qga".format(self.spec.machine_id))
 
-    def wait_on_exit(self, proc):
+    def has_agent(self):
         """
-        Listener used by above start_machine to restart the machine if the machine exits
+        Return True if the guest agent channel is needed, i.e. the machine has a guest agent probe
         """
-        proc.wait()
-        logging.info("qemu process has exited")
-        self.proc = None
-        if not self.block_respawns and self.spec.properties.get("respawn", False):
-            self.start_machine()
+        return any(probe["type"] == "agent" for probe in self.spec.properties.get("probes", []))
 
-    def stop_machine(self):
+    def get_volume_socket(self, index):
         """
-        Send the powerdown signal to the running machine
+        Return the path of the vhost-user socket the virtiofsd of a volume listens on
         """
-        if self.proc:
-            logging.info("stopping machine %s", self.spec.machine_id)
-            self.proc.stdin.write(b"system_powerdown\n")
-            self.proc.stdin.flush()
-            self.proc.wait()
-            self.proc = None
+        return self.spec.master.state.get_runpath("{}.fs{}.sock".format(self.spec.machine_id, index))
 
-    def kill_machine(self):
+    def get_volumes(self):
         """
-        Forcefully kill the running machine
+        Return (volume, transport) for each of the machine's volumes. Volumes that don't set their transport use
+        virtiofs if virtiofsd is installed, 9p otherwise.
         """
-        print("Terminating {}".format(self.proc))
-        if self.proc:
-            self.proc.terminate()
-            self.proc.wait()
-            self.proc = None
-
-    def get_args(self, tap):
+        virtiofsd = find_virtiofsd(self.spec.master.config.get("virtiofs", {}))
+        volumes = []
+        for i, volume in enumerate(self.spec.properties.get("volumes", [])):
+            transport = volume.get("transport") or ("virtiofs" if virtiofsd else "9p")
+            if transport == "virtiofs" and not virtiofsd:
+                raise SpecError("volumes[{}]: virtiofsd is not installed, or set virtiofs.virtiofsd in zd.json"
+                                .format(i))
+            if transport == "9p" and "dax" in volume:
+                raise SpecError("volumes[{}]: dax needs virtiofs, but virtiofsd is not installed".format(i))
+            if transport == "9p" and "transport" not in volume:
+                self.log.warning("virtiofsd is not installed, sharing volume %s of %s over 9p", volume["disk"],
+                                 self.spec.machine_id)
+            volumes.append((volume, transport))
+        return volumes
+
+    def start_helpers(self, plan):
+        """
+        Launch the virtiofsd of each virtiofs volume and return their processes once they all listen
+        """
+        timeout = self.spec.master.config.get("virtiofs", {}).get("timeout", 10)
+        helpers = []
+        try:
+            for i, (socket_path, argv) in enumerate(plan.helpers):
+                argv = list(argv)
+                self.log.info("starting virtiofsd with: {}".format(" ".join(argv)))
+                if self.is_detached():
+                    argv = scope_args("zd-{}-fs{}-{}".format(self.spec.machine_id, i, int(time()))) + argv
+                output = self.spec.master.output.open(self.spec)
+                try:
+                    helpers.append(start_virtiofsd(argv, socket_path, output, timeout))
+                finally:
+                    os.close(output)
+        except Exception:
+            self.stop_helpers(helpers)
+            raise
+        return helpers
+
+    def stop_helpers(self, helpers):
+        for helper in helpers:
+            if helper.poll() is None:
+                helper.terminate()
+
+    def watch_helper(self, helper, proc):
+        """
+        Stop qemu if one of its virtiofsd exits while it runs, as the guest's filesystem would hang and virtiofs can't
+        reconnect. The machine is then respawned or stopped like after any unexpected exit.
+        """
+        helper.wait()
+        # virtiofsd also exits when qemu does, give the exit listener a moment to notice
+        deadline = time() + 1
+        while proc.poll() is None and time() < deadline:
+            sleep(0.1)
+        if proc.poll() is None and self.proc is proc and self.get_status() == "running":
+            self.log.error("virtiofsd of %s exited, stopping qemu", self.spec.machine_id)
+            self.send_kill(proc)
+
+    def launch(self, kind="start"):
+        # Machines migrated in are timed from the launch of the qemu receiving them to the end of their migration, see
+        # MigrationManager.commit_incoming()
+        Machine.launch(self, "migrate" if self.incoming is not None else kind)
+
+    def spawn(self, plan):
+        """
+        Launch qemu, and the virtiofsd of its volumes first
+        """
+        self.spec.master.disk_jobs.check_free(disk_id for disk_id, _ in plan.disks)
+        qemu_args = list(plan.argv)
+        self.log.info("spawning qemu with: {}".format(' '.join(qemu_args)))
+        for path in (self.get_qmp_path(), self.get_agent_path()):
+            if os.path.exists(path):
+                os.unlink(path)
+        if self.is_detached():
+            qemu_args = scope_args("zd-{}-{}".format(self.spec.machine_id, int(time()))) + qemu_args
+        self.qmp.close()
+        self.qmp = QMPClient(self.get_qmp_path())
+        self.agent_path = self.get_agent_path()
+        spawned = time()
+        helpers = self.start_helpers(plan)
+        output = self.spec.master.output.open(self.spec)
+        try:
+            proc = subprocess.Popen(qemu_args, preexec_fn=lambda: os.setpgrp(), stdin=subprocess.DEVNULL,
+                                    stdout=output, stderr=output)
+        except Exception:
+            self.stop_helpers(helpers)
+            raise
+        finally:
+            os.close(output)
+        self.spec.master.stats.observe("zd_lifecycle_seconds", time() - spawned, phase="spawn",
+                                       type=self.machine_type)
+        self.helpers = helpers
+        self.write_runinfo(proc, spawned)
+        Thread(target=self.wait_for_qmp, args=[proc, spawned], daemon=True).start()
+        for helper in helpers:
+            Thread(target=self.watch_helper, args=[helper, proc], daemon=True).start()
+        return proc
+
+    def write_runinfo(self, proc, started):
+        """
+        Record the pid, QMP socket, tap device and virtiofsd processes of a qemu process so a later daemon can reattach
+        to it
+        """
+        self.spec.master.state.write_runinfo(self.spec.machine_id, {"type": self.machine_type,
+                                                                    "pid": proc.pid,
+                                                                    "qmp": self.qmp.path,
+                                                                    "agent": self.agent_path,
+                                                                    "tap": self.tap.num,
+                                                                    "helpers": [helper.pid for helper in self.helpers],
+                                                                    "started": started})
+
+    def take_over(self, other):
+        """
+        Take over the running qemu process of another QMachine, such as a warm pool instance, along with its QMP socket
+        and tap device. The other machine is left stopped.
+        """
+        proc = other.release()
+        other.qmp.close()
+        self.spec.master.output.transfer(other.spec, self.spec)
+        other.spec.master.state.remove_runinfo(other.spec.machine_id)
+        self.qmp.close()
+        self.qmp = QMPClient(other.qmp.path)
+        self.agent_path = other.agent_path
+        self.tap = other.tap
+        self.write_runinfo(proc, time())
+        self.begin_boot("warm")
+        self.adopt(proc)
+
+    def reattach(self):
+        """
+        Take over a qemu process recorded in the machine's runtime info if it is still running. The process's argv
+        must reference this machine's QMP socket, guarding against the pid having been reused.
+        """
+        state = self.spec.master.state
+        info = state.get_runinfo(self.spec.machine_id)
+        if info is None or info.get("type") != self.machine_type:
+            return False
+        cmdline = read_cmdline(info["pid"])
+        if cmdline is None or not any(info["qmp"] in arg for arg in cmdline):
+            self.log.info("Recorded qemu process of %s is gone", self.spec.machine_id)
+            state.remove_runinfo(self.spec.machine_id)
+            return False
+        self.tap = TapDevice(info["tap"])
+        self.qmp = QMPClient(info["qmp"])  # not our own socket if the process was taken over from a pool instance
+        self.agent_path = info.get("agent", self.get_agent_path())
+        self.spec.master.output.get_log(self.spec).direct = True  # detached qemu writes its log file itself
+        self.invalidate_plan()
+        # virtiofsd processes are recognized by their socket, which is named after the machine
+        socket_prefix = self.spec.master.state.get_runpath("{}.fs".format(self.spec.machine_id))
+        self.helpers = [PidHandle(pid) for pid in info.get("helpers", [])
+                        if any(arg.startswith(socket_prefix) for arg in read_cmdline(pid) or [])]
+        proc = PidHandle(info["pid"])
+        self.adopt(proc)
+        for helper in self.helpers:
+            Thread(target=self.watch_helper, args=[helper, proc], daemon=True).start()
+        return True
+
+    def wait_for_qmp(self, proc, spawned, timeout=60):
+        """
+        Record how long after spawning the qemu process it first answers on QMP, and when its guest starts running.
+        Guests started paused are recorded running by whoever resumes them.
+        """
+        answered = False
+        while proc.poll() is None and time() - spawned < timeout:
+            try:
+                status = self.qmp.execute("query-status")
+            except (OSError, ValueError):
+                sleep(0.05)
+                continue
+            if not answered:
+                answered = True
+                self.spec.master.stats.observe("zd_lifecycle_seconds", time() - spawned, phase="first_qmp",
+                                               type=self.machine_type)
+            if self.start_paused or self.incoming is not None:
+                return
+            if status.get("status") == "running":
+                self.record_boot("running")
+                return
+            sleep(0.05)
+
+    def cleanup(self):
+        self.qmp.close()
+        self.stop_helpers(self.helpers)
+        self.helpers = []
+        for i in range(len(self.spec.properties.get("volumes", []))):
+            if os.path.exists(self.get_volume_socket(i)):
+                os.unlink(self.get_volume_socket(i))
+        self.spec.master.state.remove_runinfo(self.spec.machine_id)
+
+    def send_powerdown(self, proc):
+        """
+        Send the powerdown signal to qemu over QMP
+        """
+        deadline = time() + 10
+        while True:
+            try:
+                self.qmp.execute("system_powerdown")
+                return
+            except (OSError, ValueError) as e:
+                # A freshly spawned qemu may not be listening yet
+                if isinstance(e, (FileNotFoundError, ConnectionRefusedError)) and \
+                        proc.poll() is None and time() < deadline:
+                    sleep(0.1)
+                    continue
+                self.log.warning("Could not send powerdown to %s: %s", self.spec.machine_id, e)
+                return
+
+    def send_kill(self, proc):
+        proc.terminate()
+
+    def migrate(self, uri, job, bandwidth=None, downtime=None, poll_interval=0.5):
+        """
+        Stream the running machine to a qemu waiting for it with -incoming, reporting progress on a job. Returns once
+        the migration completed, which leaves this qemu paused. If the job is cancelled the migration is cancelled too
+        and the machine keeps running here.
+        :param uri: where the other qemu listens, e.g. tcp:host:port
+        :param bandwidth: most bytes per second to send
+        :param downtime: longest pause of the guest at switchover in milliseconds
+        """
+        parameters = {}
+        if bandwidth is not None:
+            parameters["max-bandwidth"] = int(bandwidth)
+        if downtime is not None:
+            parameters["downtime-limit"] = int(downtime)
+        if parameters:
+            self.qmp.execute("migrate-set-parameters", **parameters)
+        self.qmp.execute("migrate", uri=uri)
+        while True:
+            info = self.qmp.execute("query-migrate")
+            status = info.get("status")
+            if status == "completed":
+                return info
+            elif status in ("failed", "cancelled"):
+                raise QMPError("Migration {}: {}".format(status, info.get("error-desc", "")))
+            ram = info.get("ram", {})
+            total = ram.get("total", 0)
+            try:
+                job.update(progress=(total - ram.get("remaining", total)) / total if total else None,
+                           message="{}: {} of {} MiB remaining".format(status, ram.get("remaining", 0) >> 20,
+                                                                       total >> 20))
+            except JobCancelled:
+                self.qmp.execute("migrate_cancel")
+                raise
+            sleep(poll_interval)
+
+    def compile_plan(self):
+        tap = str(self.tap)
+        volumes = self.get_volumes()
+        disks = tuple((attached["disk"], self.spec.master.disks[attached["disk"]].get_path())
+                      for attached in self.spec.properties.get("drives", []) + self.spec.properties.get("volumes", []))
+        netifaces = tuple((iface.get("type"), ifname, tuple(args)) for iface, ifname, args in self.get_netifaces(tap))
+        virtiofs = self.spec.master.config.get("virtiofs", {})
+        helpers = tuple((self.get_volume_socket(i),
+                         tuple(virtiofsd_args(find_virtiofsd(virtiofs), self.get_volume_socket(i),
+                                              self.spec.master.disks[volume["disk"]].get_path(),
+                                              cache=volume.get("cache", "auto"), readonly=volume.get("readonly", False),
+                                              extra_args=virtiofs.get("args", ()))))
+                        for i, (volume, transport) in enumerate(volumes) if transport == "virtiofs")
+        return LaunchPlan(argv=tuple(self.get_args(tap, volumes)), disks=disks, netifaces=netifaces, helpers=helpers)
+
+    def get_args(self, tap, volumes=()):
         """
         Assemble the full argv array that will be executed for this machine
+        :param volumes: the machine's volumes and their transports, see get_volumes()
         """
         argv = ['qemu-system-x86_64']
-        argv += self.get_args_system()
+        argv += self.get_args_system(shared_memory=any(transport == "virtiofs" for _, transport in volumes))
         argv += self.get_args_drives()
+        argv += self.get_args_volumes(volumes)
         argv += self.get_args_network(tap)
+        argv += self.get_args_agent()
         return argv
 
-    def get_args_system(self):
+    def get_args_system(self, shared_memory=False):
         """
         Return system-related args:
         - Qemu meta args
+        - Whether to start paused
+        - Machine type
         - CPU core settings
         - Mem amnt
-        - Boot device
+        - Kernel or boot device
+        :param shared_memory: back guest memory with shared memory other processes can map, needed by virtiofs
         """
-        args = ["-monitor", "stdio", "-machine", "accel=kvm", "-smp"]
+        args = ["-qmp", "unix:{},server,nowait".format(self.get_qmp_path())]
+        if self.start_paused:
+            args.append("-S")
+        if self.incoming is not None:
+            args += ["-incoming", "tcp:0.0.0.0:{}".format(self.incoming)]
+        machine = self.spec.properties.get("machine")
+        machine = "{},accel=kvm".format(machine) if machine else "accel=kvm"
+        if shared_memory:
+            args += ["-object", "memory-backend-memfd,id=mem,size={}M,share=on".format(
+                self.spec.properties.get("mem", 256))]
+            machine += ",memory-backend=mem"
+        args += ["-machine", machine, "-smp"]
         args.append("cpus={}".format(self.spec.properties.get("cores", 1)))  # why doesn't this work: ,cores={}
         args.append("-m")
         args.append(str(self.spec.properties.get("mem", 256)))
-        args.append("-boot")
-        args.append("cd")
+        if self.is_microvm(self.spec.properties):
+            # Only the devices asked for, none of the defaults of a pc
+            args += ["-nodefaults", "-no-user-config"]
+        kernel = self.spec.properties.get("kernel")
+        if kernel:
+            # Boot the kernel directly, skipping the firmware and bootloader
+            args += ["-kernel", get_boot_file(self.spec.master, kernel, "kernel")]
+            if "initrd" in kernel:
+                args += ["-initrd", get_boot_file(self.spec.master, kernel, "initrd")]
+            if "append" in kernel:
+                args += ["-append", kernel["append"]]
+        else:
+            args += ["-boot", self.spec.properties.get("boot", "cd")]
         if self.spec.properties.get("vnc", False):
             args.append("-vnc")
-            assert type(self.spec.properties.get("vnc")) == int, "VNC port should be an integer"
             args.append(":{}".format(self.spec.properties.get("vnc")))
+        if self.spec.properties.get("console", False):
+            # Guest serial console goes to stdout, and so to the machine's log
+            args += ["-serial", "stdio"]
         return args
 
+    def get_args_agent(self):
+        """
+        Return args adding a virtio serial channel for the qemu guest agent, if needed
+        """
+        if not self.has_agent():
+            return []
+        return ["-chardev", "socket,path={},server,nowait,id=qga0".format(self.get_agent_path()),
+                "-device", "virtio-serial-device" if self.is_microvm(self.spec.properties) else "virtio-serial",
+                "-device", "virtserialport,chardev=qga0,name=org.qemu.guest_agent.0"]
+
+    def get_ifnames(self, tap_name):
+        """
+        Return the host interface name of each netiface. Tap netifaces without an ifname use the machine's allocated tap
+        device, numbered after it from the second one on.
+        """
+        names = []
+        taps = 0
+        for iface in self.spec.properties.get("netifaces", []):
+            if iface.get("type") == "tap" and "ifname" not in iface:
+                names.append(tap_name if taps == 0 else "{}-{}".format(tap_name, taps))
+                taps += 1
+            else:
+                names.append(iface.get("ifname"))
+        return names
+
     def get_args_network(self, tap_name):
         """
         Return network related qemu args
+        :param tap_name: the machine's allocated tap device, see get_ifnames()
         """
-        args = []
-        for iface in self.spec.properties.get("netifaces"):
+        return [arg for _, _, args in self.get_netifaces(tap_name) for arg in args]
+
+    def get_netifaces(self, tap_name):
+        """
+        Return the properties, host interface name and qemu args of each netiface. Machines with a pci bus put nics and
+        backends such as taps on one hub with -net. microvm has no hub: each backend is a -netdev attached to a
+        virtio-net-device of its own, which takes the options of the nic of the same rank, e.g. its macaddr.
+        :param tap_name: the machine's allocated tap device, see get_ifnames()
+        """
+        netifaces = self.spec.properties.get("netifaces", [])
+        microvm = self.is_microvm(self.spec.properties)
+        nics = [iface for iface in netifaces if iface.get("type") == "nic"]
+        backends = 0
+        result = []
+        for iface, ifname in zip(netifaces, self.get_ifnames(tap_name)):
             iface_type = iface.get("type")
             iface_args = {"type": iface_type}
 
             if iface_type == "tap":
-                if "ifname" in iface:
-                    iface_args["ifname"] = iface.get("ifname")
+                iface_args["ifname"] = ifname
                 iface_args["script"] = "/root/zhypervisor/testenv/bin/zd_ifup"  # TODO don't hard code
                 iface_args["downscript"] = "no"
             else:
                 iface_args.update(iface)
 
-            args.append("-net")
-            args.append(QMachine.format_args(iface_args))
-        return args
-
-        # return ['-net', 'nic,vlan=0,model=e1000,macaddr=82:25:60:41:D5:97',
-        #        '-net', 'tap,ifname={},script=if_up.sh,downscript=no'.format(tap_name)]
+            if not microvm:
+                args = ["-net", QMachine.format_args(iface_args)]
+            elif iface_type == "nic":
+                args = []  # set on the device of a backend
+            else:
+                netdev = "net{}".format(backends)
+                iface_args.pop("vlan", None)
+                iface_args["id"] = netdev
+                device = {"type": "virtio-net-device", "netdev": netdev}
+                if backends < len(nics):
+                    nic = nics[backends]
+                    device.update({key: value for key, value in nic.items()
+                                   if key not in ("type", "model", "vlan", "macaddr")})
+                    if "macaddr" in nic:
+                        device["mac"] = nic["macaddr"]
+                args = ["-netdev", QMachine.format_args(iface_args), "-device", QMachine.format_args(device)]
+                backends += 1
+            result.append((iface, ifname, args))
+        return result
 
     def get_args_drives(self):
         """
         Inspect props.drives expecting a format like:  {"file": "/tmp/ubuntu.qcow2", "index": 0, "if": "virtio"}
         """
         args = []
-        for attached_drive in self.spec.properties.get("drives", []):
+        microvm = self.is_microvm(self.spec.properties)
+        for i, attached_drive in enumerate(self.spec.properties.get("drives", [])):
             args.append("-drive")
 
             disk_ob = self.spec.master.disks[attached_drive["disk"]]
 
             drive_args = {"file": disk_ob.get_path()}
 
+            if microvm:
+                # Attached as virtio-mmio devices, microvm has no pci bus for if=virtio
+                drive_args.update({"if": "none", "id": "drive{}".format(i)})
+                args += [QMachine.format_args(drive_args), "-device", "virtio-blk-device,drive=drive{}".format(i)]
+                continue
+
             for option in ["if", "index", "media"]:
                 if option in attached_drive:
                     drive_args[option] = attached_drive[option]
@@ -144,6 +573,55 @@ class QMachine(Machine):
 
         return args
 
+    def get_args_volumes(self, volumes):
+        """
+        Return args sharing volumes with the guest, which mounts them by their tag, e.g. with mount -t virtiofs <tag>
+        <mountpoint>, or mount -t 9p -o trans=virtio <tag> <mountpoint>
+        """
+        args = []
+        microvm = self.is_microvm(self.spec.properties)
+        for i, (volume, transport) in enumerate(volumes):
+            tag = volume.get("tag", volume["disk"])
+            if transport == "virtiofs":
+                device = {"type": "vhost-user-fs-device" if microvm else "vhost-user-fs-pci",
+                          "chardev": "fs{}".format(i), "tag": tag}
+                if "dax" in volume:
+                    # Window of host page cache mapped into the guest, sparing reads and writes a copy
+                    device["cache-size"] = "{}M".format(volume["dax"])
+                args += ["-chardev", "socket,id=fs{},path={}".format(i, self.get_volume_socket(i)),
+                         "-device", QMachine.format_args(device)]
+            else:
+                fsdev = {"type": "local", "id": "fs{}".format(i),
+                         "path": self.spec.master.disks[volume["disk"]].get_path(), "security_model": "none"}
+                if volume.get("readonly", False):
+                    fsdev["readonly"] = "on"
+                args += ["-fsdev", QMachine.format_args(fsdev),
+                         "-device", QMachine.format_args({"type": "virtio-9p-device" if microvm else "virtio-9p-pci",
+                                                          "fsdev": "fs{}".format(i), "mount_tag": tag})]
+        return args
+
+    def get_stats(self):
+        """
+        Return process stats plus disk counters from QMP and traffic counters of tap devices
+        """
+        stats = Machine.get_stats(self)
+        if not stats:
+            return stats
+
+        blockstats = self.qmp.execute("query-blockstats")
+        for stat_field, qmp_field in [("block_read_bytes", "rd_bytes"), ("block_write_bytes", "wr_bytes"),
+                                      ("block_read_ops", "rd_operations"), ("block_write_ops", "wr_operations")]:
+            stats[stat_field] = sum(device["stats"][qmp_field] for device in blockstats)
+
+        for iface_type, ifname, _ in self.get_plan().netifaces:
+            if iface_type == "tap" and ifname:
+                try:
+                    for field, value in read_iface_stats(ifname).items():
+                        stats[field] = stats.get(field, 0) + value
+                except FileNotFoundError:
+                    pass
+        return stats
+
     @staticmethod
     def format_args(d):
         """
@@ -161,6 +639,11 @@ class QMachine(Machine):
         return ','.join(args)
 
 
+# Preallocation modes qemu-img supports per image format
+PREALLOCATION = {"raw": ("off", "falloc", "full"),
+                 "qcow2": ("off", "metadata", "falloc", "full")}
+
+
 class QDisk(ZDisk):
 
     def init(self):
@@ -169,12 +652,28 @@ class QDisk(ZDisk):
         """
         disk_path = self.get_path()
         assert not os.path.exists(disk_path), "Disk already exists!"
-        img_args = ["qemu-img", "create", "-f", self.properties["fmt"], disk_path, "{}M".format(int(self.properties["size"]))]
-        logging.info("Creating disk with: %s", str(img_args))
+        if "backing" in self.properties:
+            # A linked overlay: only blocks written through this disk are stored in it, the rest are read from the
+            # backing disk, which must be in the same datastore
+            assert self.properties["fmt"] == "qcow2", "Only qcow2 disks can have a backing disk"
+            img_args = ["qemu-img", "create", "-f", "qcow2",
+                        "-b", self.datastore.get_filepath("disks", self.properties["backing"]),
+                        "-F", self.properties.get("backing_fmt", "qcow2"), disk_path]
+        else:
+            img_args = ["qemu-img", "create", "-f", self.properties["fmt"], disk_path,
+                        "{}M".format(int(self.properties["size"]))]
+        if "preallocation" in self.properties:
+            # metadata lays out qcow2's tables up front, falloc reserves the blocks, full writes them
+            img_args[4:4] = ["-o", "preallocation={}".format(self.properties["preallocation"])]
+        logger.info("Creating disk with: %s", str(img_args), extra={"disk_id": self.disk_id})
         subprocess.check_call(img_args)
 
     def validate(self):
         assert self.disk_id.endswith(".bin"), "QDisks names must end with '.bin'"
+        if "preallocation" in self.properties:
+            modes = PREALLOCATION.get(self.properties["fmt"], ())
+            assert self.properties["preallocation"] in modes, \
+                "preallocation of {} disks must be one of: {}".format(self.properties["fmt"], ", ".join(modes))
 
     def delete(self):
         os.unlink(self.get_path())
@@ -0,0 +1,96 @@
+import json
+import socket
+import logging
+from threading import Lock
+
+
+logger = logging.getLogger(__name__)
+
+
+class QMPError(Exception):
+    pass
+
+
+class QMPClient(object):
+    """
+    Minimal client for qemu's json machine protocol (QMP), spoken over the unix socket passed to qemu with -qmp. Safe
+    to share between threads; commands are serialized over the single connection.
+    """
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = Lock()
+
+    def connect(self):
+        """
+        Open the socket, consume qemu's greeting and leave capabilities negotiation mode
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.path)
+            self.reader = self.sock.makefile("rb")
+            greeting = self._read_message()
+            assert "QMP" in greeting, "Unexpected QMP greeting: {}".format(greeting)
+            self._command("qmp_capabilities")
+        except:
+            self.close()
+            raise
+
+    def execute(self, command, **arguments):
+        """
+        Run a QMP command and return the contents of its "return" key
+        :param command: name of the QMP command e.g. query-status
+        :param arguments: arguments to pass to the command
+        """
+        with self.lock:
+            for attempt in range(2):
+                fresh = self.sock is None
+                if fresh:
+                    self.connect()
+                try:
+                    return self._command(command, **arguments)
+                except (OSError, ValueError):
+                    self.close()
+                    # An existing connection may belong to a qemu that has since been restarted, retry once
+                    if fresh or attempt:
+                        raise
+
+    def _command(self, command, **arguments):
+        message = {"execute": command}
+        if arguments:
+            message["arguments"] = arguments
+        sock = self.sock
+        if sock is None:
+            raise ConnectionResetError("QMP socket closed: {}".format(self.path))
+        sock.sendall(json.dumps(message).encode("UTF-8") + b"\n")
+        while True:
+            response = self._read_message()
+            if "return" in response:
+                return response["return"]
+            elif "error" in response:
+                raise QMPError("{} failed: {}".format(command, response["error"].get("desc")))
+            # Anything else is an asynchronous event
+            logger.debug("QMP event on %s: %s", self.path, response.get("event"))
+
+    def _read_message(self):
+        # close() may be called from another thread, e.g. when qemu exits
+        reader = self.reader
+        if reader is None:
+            raise ConnectionResetError("QMP socket closed: {}".format(self.path))
+        line = reader.readline()
+        if not line:
+            raise ConnectionResetError("QMP socket closed: {}".format(self.path))
+        return json.loads(line.decode("UTF-8"))
+
+    def close(self):
+        for item in (self.reader, self.sock):
+            if item is not None:
+                try:
+                    item.close()
+                except OSError:
+                    pass
+        self.reader = None
+        self.sock = None
@@ -0,0 +1,63 @@
+import os
+import shutil
+import logging
+import subprocess
+from time import sleep, time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Where distributions install virtiofsd, which is usually not on the PATH
+VIRTIOFSD_PATHS = ("/usr/libexec/virtiofsd", "/usr/lib/qemu/virtiofsd", "/usr/lib/virtiofsd")
+
+
+def find_virtiofsd(config):
+    """
+    Return the path of the virtiofsd binary, or None if it is not installed
+    :param config: the 'virtiofs' key of zd.json
+    """
+    if config.get("virtiofsd"):
+        return config["virtiofsd"]
+    found = shutil.which("virtiofsd")
+    if found:
+        return found
+    for path in VIRTIOFSD_PATHS:
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def virtiofsd_args(binary, socket_path, shared_dir, cache="auto", readonly=False, extra_args=()):
+    """
+    Return the argv of a virtiofsd serving a directory on a vhost-user socket
+    :param cache: guest caching of file data and metadata: never, metadata, auto or always
+    :param extra_args: additional virtiofsd arguments from zd.json, e.g. ["--sandbox", "none"]
+    """
+    args = [binary, "--socket-path", socket_path, "--shared-dir", shared_dir, "--cache", cache]
+    if readonly:
+        args.append("--readonly")
+    return args + list(extra_args)
+
+
+def start_virtiofsd(argv, socket_path, output, timeout=10):
+    """
+    Launch a virtiofsd and wait for it to listen on its socket, which must happen before qemu connects to it. Returns
+    the Popen of the process.
+    :param output: file descriptor the process's output is written to
+    :raises OSError: if virtiofsd exits or does not listen within the timeout
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    proc = subprocess.Popen(argv, preexec_fn=lambda: os.setpgrp(), stdin=subprocess.DEVNULL, stdout=output,
+                            stderr=output)
+    deadline = time() + timeout
+    while not os.path.exists(socket_path):
+        if proc.poll() is not None:
+            raise OSError("virtiofsd exited with status {}".format(proc.returncode))
+        if time() > deadline:
+            proc.kill()
+            proc.wait()
+            raise OSError("virtiofsd did not listen on {} within {}s".format(socket_path, timeout))
+        sleep(0.01)
+    return proc
@@ -0,0 +1,380 @@
+import os
+import logging
+import selectors
+from time import sleep
+from collections import deque
+from threading import Thread, Lock, RLock, Condition
+
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer(object):
+    """
+    Fixed size buffer holding the most recent bytes written to it. Positions are counted in bytes written since the
+    buffer was created, so readers can tell what they missed.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray(size)
+        self.end = 0  # position after the last byte written
+
+    def write(self, chunk):
+        length = len(chunk)
+        if length > self.size:
+            chunk = chunk[-self.size:]
+        start = (self.end + length - len(chunk)) % self.size
+        first = min(len(chunk), self.size - start)
+        self.data[start:start + first] = chunk[:first]
+        self.data[:len(chunk) - first] = chunk[first:]
+        self.end += length
+
+    def read(self, position):
+        """
+        Return the bytes from position up to the end of the buffer, and the position they start at. Data that has
+        already been overwritten is skipped.
+        """
+        position = max(position, self.end - self.size, 0)
+        start = position % self.size
+        length = self.end - position
+        if start + length <= self.size:
+            return bytes(self.data[start:start + length]), position
+        return bytes(self.data[start:] + self.data[:length - (self.size - start)]), position
+
+
+class MachineLog(object):
+    """
+    Output of a machine. Output read from the machine's pipe is kept in memory for the tail API and queued for a writer
+    thread of its own, which appends it to a size-rotated log file, so a log on slow storage only holds up itself.
+    Detached processes, which must outlive the daemon, write the log file directly instead; it is then only rotated when
+    they are launched.
+    """
+    def __init__(self, path, max_bytes=1048576, backups=3, buffer_size=65536, queue_size=1048576):
+        """
+        :param path: path of the log file. Rotated files get a .1, .2... suffix.
+        :param max_bytes: size at which the log file is rotated
+        :param backups: number of rotated log files kept
+        :param buffer_size: bytes of output kept in memory
+        :param queue_size: bytes of output waiting to be written to the file, past which output is left out of it
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer = RingBuffer(buffer_size)
+        self.changed = Condition()  # Notified when output is added to the buffer
+        self.file = None
+        self.file_lock = RLock()  # Held while the log file is written, rotated or closed
+        self.direct = False  # True if the process writes the log file itself
+        self.deleted = False
+        self.queue_size = queue_size
+        self.queue = deque()  # Output waiting to be written, and counts of bytes left out where the queue was full
+        self.queued = 0  # bytes of output in the queue
+        self.writing = Condition()  # Guards the queue, notified when the writer thread exits
+        self.writer = None
+
+    def write(self, data):
+        """
+        Add output read from the machine's pipe. Never waits on the log file.
+        """
+        with self.writing:
+            if self.queued + len(data) <= self.queue_size:
+                self.queue.append(data)
+                self.queued += len(data)
+            elif self.queue and isinstance(self.queue[-1], int):
+                self.queue[-1] += len(data)
+            else:
+                self.queue.append(len(data))
+            if self.writer is None:
+                self.writer = Thread(target=self.write_queue, name="log-writer", daemon=True)
+                self.writer.start()
+        with self.changed:
+            self.buffer.write(data)
+            self.changed.notify_all()
+
+    def write_queue(self):
+        """
+        Writer thread, started when output is queued and exiting once the queue is empty
+        """
+        while True:
+            with self.writing:
+                if not self.queue:
+                    self.writer = None
+                    self.writing.notify_all()
+                    return
+                chunks = list(self.queue)
+                self.queue.clear()
+                self.queued = 0
+            data = b"".join(chunk if isinstance(chunk, bytes) else
+                            "\n[zd: {} bytes of output left out, the log file fell behind]\n".format(chunk).encode()
+                            for chunk in chunks)
+            self.write_file(data)
+
+    def write_file(self, data):
+        with self.file_lock:
+            if self.deleted:
+                return
+            try:
+                if self.file is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self.file = open(self.path, "ab")
+                if self.file.tell() and self.file.tell() + len(data) > self.max_bytes:
+                    self.rotate()
+                    self.file = open(self.path, "ab")
+                self.file.write(data)
+                self.file.flush()
+            except OSError:
+                logger.exception("Could not write log %s", self.path)
+
+    def flush(self, timeout=10):
+        """
+        Wait up to timeout seconds for the queued output to be written
+        """
+        with self.writing:
+            self.writing.wait_for(lambda: self.writer is None, timeout)
+
+    def rotate(self):
+        self.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, i)):
+                os.rename("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+
+    def open_direct(self):
+        """
+        Return a file descriptor for a detached process to write its output to, rotating the log first if needed
+        """
+        self.flush()
+        with self.file_lock:
+            self.close()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                self.rotate()
+            self.direct = True
+            return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def close(self):
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def delete(self):
+        """
+        Remove the log file and its rotated copies. Output still queued is discarded.
+        """
+        with self.file_lock:
+            self.deleted = True
+            self.close()
+        for path in [self.path] + ["{}.{}".format(self.path, i) for i in range(1, self.backups + 1)]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def read_file(self, position, from_end=False):
+        """
+        Return the log file's contents from position to its end, and the position they start at
+        :param from_end: count position backwards from the end of the file
+        """
+        try:
+            with open(self.path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                if from_end:
+                    position = max(0, size - position)
+                elif position > size:
+                    position = 0  # rotated meanwhile
+                f.seek(position)
+                return f.read(), position
+        except FileNotFoundError:
+            return b"", 0
+
+    def tail(self, nbytes):
+        """
+        Return the last nbytes of output, and the position to follow it from
+        """
+        if self.direct:
+            data, position = self.read_file(nbytes, from_end=True)
+        else:
+            with self.changed:
+                data, position = self.buffer.read(self.buffer.end - nbytes)
+        return data, position + len(data)
+
+    def wait(self, position, timeout=1):
+        """
+        Wait up to timeout seconds for output past position. Return the new output and the position after it.
+        Output a slow reader has missed is skipped.
+        """
+        if self.direct:
+            data, position = self.read_file(position)
+            if not data:
+                sleep(timeout)
+            return data, position + len(data)
+        with self.changed:
+            if self.buffer.end <= position:
+                self.changed.wait(timeout)
+            data, position = self.buffer.read(position)
+        return data, position + len(data)
+
+
+class OutputCollector(object):
+    """
+    Captures the stdout and stderr of machine processes. All pipes are read by one thread that never waits on anything
+    but the pipes, so a machine is never blocked by readers of its log, however slow. Log files are written by a thread
+    per machine, see MachineLog.
+    """
+    def __init__(self, master, max_bytes=1048576, backups=3, buffer_size=65536, queue_size=1048576):
+        """
+        :param master: ZHypervisorDaemon reference
+        :param max_bytes: size at which machine log files are rotated
+        :param backups: number of rotated log files kept per machine
+        :param buffer_size: bytes of recent output kept in memory per machine
+        :param queue_size: bytes of output per machine waiting to be written to its log file, past which output is
+                           left out of the file
+        """
+        self.master = master
+        self.options = {"max_bytes": max_bytes, "backups": backups, "buffer_size": buffer_size,
+                        "queue_size": queue_size}
+        self.logs = {}  # Mapping of machine name -> MachineLog
+        self.pipes = {}  # Mapping of pipe read fd -> machine name
+        self.lock = Lock()
+        self.pending = deque()  # read fds to be registered with the selector
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.stopped = False
+        self.thread = Thread(target=self.run, name="output", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        os.write(self.wakeup_w, b"\0")
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            log.flush()
+            log.close()
+
+    def get_path(self, machine_spec):
+        datastore = self.master.datastores[machine_spec.properties.get("log_datastore", "default")]
+        return datastore.get_filepath("logs", "{}.log".format(machine_spec.machine_id))
+
+    def get_log(self, machine_spec):
+        """
+        Return the MachineLog of a machine
+        """
+        path = self.get_path(machine_spec)
+        with self.lock:
+            log = self.logs.get(machine_spec.machine_id)
+            if log is None or log.path != path:
+                if log is not None:
+                    log.close()
+                log = self.logs[machine_spec.machine_id] = MachineLog(path, **self.options)
+            return log
+
+    def open(self, machine_spec):
+        """
+        Return a file descriptor for the machine's process to write its output to. The caller passes it as the
+        process's stdout and stderr, then closes it.
+        """
+        if machine_spec.machine.is_detached():
+            return self.get_log(machine_spec).open_direct()
+        return self.open_pipe(machine_spec)
+
+    def open_pipe(self, machine_spec):
+        """
+        Return the write end of a pipe captured into the machine's log, for processes that need not outlive the daemon
+        """
+        self.get_log(machine_spec).direct = False
+        read_fd, write_fd = os.pipe2(os.O_CLOEXEC)
+        os.set_blocking(read_fd, False)
+        with self.lock:
+            self.pipes[read_fd] = machine_spec.machine_id
+            self.pending.append(read_fd)
+        os.write(self.wakeup_w, b"\0")
+        return write_fd
+
+    def transfer(self, old_spec, new_spec):
+        """
+        Send the output of a process taken over from another machine, such as a warm pool instance, to the new
+        machine's log. The other machine's log is removed.
+        """
+        old_log = self.get_log(old_spec)
+        new_log = self.get_log(new_spec)
+        with self.lock:
+            for fd, machine_id in self.pipes.items():
+                if machine_id == old_spec.machine_id:
+                    self.pipes[fd] = new_spec.machine_id
+            del self.logs[old_spec.machine_id]
+        new_log.direct = old_log.direct
+        old_log.flush()
+        if old_log.direct and os.path.exists(old_log.path):
+            # The process keeps writing to the file it was given, which becomes the new machine's log
+            new_log.close()
+            try:
+                if os.path.exists(new_log.path):
+                    new_log.rotate()
+                os.makedirs(os.path.dirname(new_log.path), exist_ok=True)
+                os.rename(old_log.path, new_log.path)
+            except OSError:
+                logger.exception("Could not move log %s to %s", old_log.path, new_log.path)
+                return
+        old_log.delete()
+
+    def remove(self, machine_spec):
+        """
+        Delete the logs of a machine that is being deleted
+        """
+        log = self.get_log(machine_spec)
+        with self.lock:
+            del self.logs[machine_spec.machine_id]
+        log.delete()
+
+    def run(self):
+        while not self.stopped:
+            for key, _ in self.selector.select():
+                if key.fd == self.wakeup_r:
+                    self.register_pending()
+                else:
+                    self.drain(key.fd)
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+        os.close(self.wakeup_w)
+
+    def register_pending(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            while self.pending:
+                self.selector.register(self.pending.popleft(), selectors.EVENT_READ)
+
+    def drain(self, fd):
+        """
+        Read what is available from a pipe into its machine's log. Pipes are closed once every process holding their
+        write end has exited.
+        """
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        with self.lock:
+            machine_id = self.pipes[fd]
+            log = self.logs.get(machine_id)
+            if not data:
+                del self.pipes[fd]
+        if not data:
+            self.selector.unregister(fd)
+            os.close(fd)
+            return
+        if log is not None:
+            log.write(data)
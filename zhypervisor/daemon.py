@@ -4,27 +4,45 @@ import json
 import signal
 import logging
 import argparse
+import threading
+from time import time
 from glob import iglob
-from threading import Thread
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 
 
 from zhypervisor.logging import setup_logging
 from zhypervisor.machine import MachineSpec
+from zhypervisor.schema import SpecError
 from zhypervisor.clients.qmachine import QDisk, IsoDisk
 from zhypervisor.clients.dockermachine import DockerDisk
 from zhypervisor.util import ZDisk
+from zhypervisor.metrics import MetricsCollector, Instrumentation
+from zhypervisor.profiling import DaemonProfiler
+from zhypervisor.pool import WarmPool
+from zhypervisor.allocators import MachineAllocators
+from zhypervisor.health import HealthMonitor
+from zhypervisor.console import OutputCollector
 from zhypervisor.api.api import ZApi
+from zhypervisor.api.aioserver import AsyncApiServer
+from zhypervisor.reload import ConfigReloader
+from zhypervisor.jobs import JobManager
+from zhypervisor.migration import MigrationManager
+from zhypervisor.diskjobs import DiskJobs
+
+
+logger = logging.getLogger(__name__)
 
 
 class ZHypervisorDaemon(object):
-    def __init__(self, config):
+    def __init__(self, config, config_path=None):
         """
         Z Hypervisor main thread. Roles:
         - Load and start machines and API on init
         - Cleanup on shutdown
         - Committing changes to machines to disk
         - Primary interface to modify machines
+        :param config_path: file the config was read from, read again on SIGHUP
         """
         self.config = config  # JSON config listing, mainly, datastore paths
         self.datastores = {}  # Mapping of datastore name -> objects
@@ -35,23 +53,72 @@ class ZHypervisorDaemon(object):
         # Set up datastores and use the default datastore for "State" storage
         self.init_datastores()
         self.state = ZConfig(self.datastores["default"])
+        self.allocators = MachineAllocators(self.state, **self.config.get("allocators", {}))
 
         # Set up disks
         self.init_disks()
 
+        # Set up resource usage collection and self-instrumentation
+        self.metrics = MetricsCollector(self, **self.config.get("metrics", {}))
+        self.stats = Instrumentation()
+        self.stats.describe("zd_api_request_seconds", "Time spent handling API requests")
+        self.stats.describe("zd_lifecycle_seconds", "Time spent in each phase of machine lifecycle operations")
+        self.stats.describe("zd_boot_seconds", "Time from launching a machine to its guest running and to its first "
+                                               "successful health probe")
+        self.stats.register_gauge("zd_threads", "Number of live threads in the daemon", threading.active_count)
+        self.stats.register_gauge("zd_executor_queue_length", "Tasks waiting for a worker, per executor",
+                                  lambda: {(("executor", "metrics"), ): self.metrics.queue_size(),
+                                           (("executor", "health"), ): self.health.pool.queue_length()})
+        self.profiler = DaemonProfiler()
+
+        # Set up capture of machine output
+        self.output = OutputCollector(self, **self.config.get("logs", {}))
+
+        # Set up guest health probes
+        self.health = HealthMonitor(self, **self.config.get("health", {}))
+        self.stats.register_gauge("zd_machine_healthy", "1 if a probed machine is healthy, 0 if not",
+                                  self.health.get_gauge)
+
+        # Set up pools of pre-booted machines
+        self.pool = WarmPool(self, **self.config.get("pool", {}))
+        self.init_templates()
+        self.stats.register_gauge("zd_pool_instances", "Warm instances ready to be claimed, per template",
+                                  self.pool.get_counts)
+
+        # Set up background jobs, live migration and disk maintenance
+        self.jobs = JobManager(self, **self.config.get("jobs", {}))
+        self.migration = MigrationManager(self, **self.config.get("migration", {}))
+        self.disk_jobs = DiskJobs(self, **self.config.get("disk_jobs", {}))
+
         # start API
-        self.api = ZApi(self)
+        server = dict(self.config.get("apiserver", {}))
+        follow_timeout = server.pop("follow_timeout", 300)
+        if server.pop("type", "cherrypy") == "asyncio":
+            # Followed logs cost the asyncio server no thread, so they aren't bounded
+            self.api = AsyncApiServer(ZApi(self), port=self.config.get("apiport", 3000), **server)
+        else:
+            self.api = ZApi(self, follow_timeout=follow_timeout)
+
+        # Set up reloading of the config and on-disk state
+        self.reloader = ConfigReloader(self, config_path, **self.config.get("reload", {}))
 
         # Set up shutdown signal handlers
         signal.signal(signal.SIGINT, self.signal_handler)   # ctrl-c
         signal.signal(signal.SIGTERM, self.signal_handler)  # sigterm
+        signal.signal(signal.SIGHUP, self.reload_handler)
 
     def init_datastores(self):
         """
         Per datastore in the config, create a ZDataStore object
         """
         for name, info in self.config["datastores"].items():
-            self.datastores[name] = ZDataStore(name, info["path"], info.get("init", False))
+            self.add_datastore(name, info)
+
+    def add_datastore(self, name, info):
+        """
+        Create a ZDataStore object for a datastore entry of the config
+        """
+        self.datastores[name] = ZDataStore(name, info["path"], info.get("init", False))
 
     def init_disks(self):
         """
@@ -60,6 +127,13 @@ class ZHypervisorDaemon(object):
         for disk in self.state.get_disks():
             self.add_disk(disk["disk_id"], disk["properties"])
 
+    def init_templates(self):
+        """
+        Load all machine templates
+        """
+        for template_info in self.state.get_templates():
+            self.pool.add_template(template_info["template_id"], template_info["spec"])
+
     def init_machines(self):
         """
         Per machine in the on-disk state, create a machine object
@@ -67,24 +141,44 @@ class ZHypervisorDaemon(object):
         for machine_info in self.state.get_machines():
             machine_id = machine_info["machine_id"]
             self.add_machine(machine_id, machine_info["properties"])
-
-            # Launch if machine is an autostarted machine
-            machine = self.machines[machine_id]
-            if machine.properties.get("autostart", False) and machine.machine.get_status() == "stopped":
+            try:
+                self.allocators.reserve(machine_id, machine_info["properties"])
+            except SpecError as e:
+                logger.warning("%s: %s", machine_id, e, extra={"machine_id": machine_id})
+        self.allocators.prune(self.machines)
+        self.allocators.save()
+
+        for machine_id, machine in self.machines.items():
+            # Take over machines left running by a previous daemon, otherwise launch autostarted machines
+            if machine.machine.reattach():
+                logger.info("Reattached to running machine %s", machine_id, extra={"machine_id": machine_id})
+            elif machine.properties.get("autostart", False) and machine.machine.get_status() == "stopped":
                 machine.start()
 
     def signal_handler(self, signum, frame):
         """
         Handle signals sent to the daemon. On any, exit.
         """
-        logging.critical("Got signal {}".format(signum))
+        logger.critical("Got signal {}".format(signum))
         self.stop()
 
+    def reload_handler(self, signum, frame):
+        """
+        Handle SIGHUP by reloading the config and on-disk state, see ConfigReloader
+        """
+        logger.info("Got signal %s, reloading", signum)
+        self.reloader.request()
+
     def run(self):
         """
         Main loop of the daemon. Sets up & starts machines, runs api, and waits.
         """
+        self.output.start()
+        self.health.start()
         self.init_machines()
+        self.reloader.start()
+        self.pool.start()
+        self.metrics.start()
         self.api.run()
 
     def stop(self):
@@ -92,13 +186,58 @@ class ZHypervisorDaemon(object):
         SHut down the hypervisor. Stop the API then shut down machines
         """
         self.running = False
+        self.reloader.stop()
         self.api.stop()
-        with ThreadPoolExecutor(10) as pool:
-            for machine_id in self.machines.keys():
-                pool.submit(self.forceful_stop, machine_id)
-        # Sequential shutdown code below is easier to debug
-        # for machine_id in self.machines.keys():
-        #     self.forceful_stop(machine_id)
+        self.jobs.stop()
+        self.health.stop()
+        self.pool.stop()
+        self.metrics.stop()
+        if self.config.get("detach", False):
+            logger.warning("Detached mode, leaving machines running")
+        else:
+            self.stop_machines()
+        self.output.stop()
+
+    def stop_machines(self):
+        """
+        Stop all machines against one global deadline. Machines are stopped in groups by their "shutdown_order"
+        property, lowest first, so e.g. databases can be given a higher order than the apps that use them. Within a
+        group every machine is asked to power down at once, then waited on until its own timeout or the global
+        deadline, whichever comes first. Stragglers are killed in parallel before the next group is stopped.
+        """
+        settings = self.config.get("shutdown", {})
+        machine_timeout = settings.get("machine_timeout", 30)
+        deadline = time() + settings.get("timeout", 120)
+
+        groups = defaultdict(list)
+        for machine_spec in self.machines.values():
+            if machine_spec.machine.get_status() != "stopped":
+                groups[int(machine_spec.properties.get("shutdown_order", 0))].append(machine_spec)
+
+        for order in sorted(groups):
+            group = groups[order]
+            logger.info("Stopping %s machines with shutdown order %s", len(group), order)
+            started = time()
+            for machine_spec in group:
+                try:
+                    machine_spec.powerdown()
+                except Exception:
+                    logger.exception("Could not power down %s", machine_spec.machine_id,
+                                     extra={"machine_id": machine_spec.machine_id})
+
+            stragglers = []
+            for machine_spec in group:
+                timeout = machine_spec.properties.get("shutdown_timeout", machine_timeout)
+                remaining = min(started + timeout, deadline) - time()
+                if not machine_spec.machine.wait_stopped(max(0, remaining)):
+                    stragglers.append(machine_spec)
+
+            if stragglers:
+                logger.error("Killing machines that did not stop in time: %s",
+                              ", ".join(m.machine_id for m in stragglers))
+                with ThreadPoolExecutor(len(stragglers)) as pool:
+                    for machine_spec in stragglers:
+                        pool.submit(machine_spec.machine.kill_machine)
 
     # Below here are methods external forces may use to manipulate disks
 
@@ -126,13 +265,47 @@ class ZHypervisorDaemon(object):
         if write:
             self.state.write_disk(disk_id, disk_spec)
 
-    def remove_disk(self, disk_id):
+    def remove_disk(self, disk_id, write=True, delete=True):
         """
         Remove a disk from the system
+        :param write: also remove the disk from on-disk state
+        :param delete: also delete the disk's image
         """
-        self.disks[disk_id].delete()
+        assert not any(disk.properties.get("backing") == disk_id for disk in self.disks.values()), \
+            "Disk is the backing disk of other disks"
+        if delete:
+            self.disks[disk_id].delete()
         del self.disks[disk_id]
-        self.state.remove_disk(disk_id)
+        for machine_spec in self.machines.values():
+            machine_spec.machine.invalidate_plan()
+        if write:
+            self.state.remove_disk(disk_id)
+
+    def disk_chain(self, disk_id):
+        """
+        Return the ids of a disk and of the disks it reads through, i.e. its backing disk and the backing disk's own
+        """
+        chain = [disk_id]
+        while disk_id in self.disks and "backing" in self.disks[disk_id].properties:
+            disk_id = self.disks[disk_id].properties["backing"]
+            chain.append(disk_id)
+        return chain
+
+    def disk_users(self, disk_id):
+        """
+        Return the ids of machines and warm instances that are not stopped and attach a disk, or an overlay of it
+        """
+        specs = list(self.machines.values())
+        specs += [instance.machine_spec for template in list(self.pool.templates.values())
+                  for instance in list(template.instances)]
+        users = []
+        for machine_spec in specs:
+            properties = machine_spec.properties
+            attached = properties.get("drives", []) + properties.get("volumes", [])
+            if machine_spec.machine.get_status() != "stopped" and \
+                    any(disk_id in self.disk_chain(a.get("disk")) for a in attached):
+                users.append(machine_spec.machine_id)
+        return users
 
     # Below here are methods external forces may use to manipulate machines
 
@@ -141,8 +314,19 @@ class ZHypervisorDaemon(object):
         Create or update a machine.
         :param machine_id: alphanumeric id of machine to modify/create
         :param machine_spec: dictionary of machine properties - see example/ubuntu.json
-        :param write: commit machinge changes to on-disk state
+        :param write: commit machinge changes to on-disk state. Specs being written are validated first and SpecError is
+                      raised if they are invalid. Specs loaded from disk are validated when the machine is started.
+                      Vnc displays and mac addresses are allocated for specs being written, see MachineAllocators.assign
         """
+        if write:
+            previous = self.machines[machine_id].properties if machine_id in self.machines else {}
+            machine_spec = self.allocators.assign(machine_id, machine_spec)
+            try:
+                MachineSpec.validate(self, machine_id, machine_spec)
+            except SpecError:
+                self.allocators.reserve(machine_id, previous)
+                raise
+
         # Find / create the machine
         if machine_id in self.machines:
             machine = self.machines[machine_id]
@@ -154,27 +338,41 @@ class ZHypervisorDaemon(object):
         # Update if necessary
         if write:
             self.state.write_machine(machine_id, machine_spec)
+            self.allocators.save()
+        return machine
 
-    def forceful_stop(self, machine_id, timeout=30):  # make this timeout longer?
+    def forceful_stop(self, machine_id, timeout=None):
         """
         Gracefully stop a machine by asking it nicely, waiting some time, then forcefully killing it.
+        :param timeout: seconds to wait before killing. Defaults to the machine's shutdown_timeout property or the
+                        configured shutdown.machine_timeout
         """
         machine_spec = self.machines[machine_id]
-        nice_stop = Thread(target=machine_spec.stop)
-        nice_stop.start()
-        nice_stop.join(timeout)
+        if timeout is None:
+            timeout = machine_spec.properties.get("shutdown_timeout",
+                                                  self.config.get("shutdown", {}).get("machine_timeout", 30))
+        with machine_spec.machine.lock:
+            machine_spec.powerdown()
 
-        if nice_stop.is_alive():
-            logging.error("%s did not respond in %s seconds, killing", machine_id, timeout)
-            machine_spec.machine.kill_machine()
+            if not machine_spec.machine.wait_stopped(timeout):
+                logger.error("%s did not respond in %s seconds, killing", machine_id, timeout,
+                             extra={"machine_id": machine_id})
+                machine_spec.machine.kill_machine()
 
-    def remove_machine(self, machine_id):
+    def remove_machine(self, machine_id, write=True):
         """
         Remove a stopped machine from the system. The machine should already be stopped.
+        :param write: also remove the machine from on-disk state
         """
-        assert self.machines[machine_id].machine.get_status() == "stopped"
-        self.state.remove_machine(machine_id)
+        machine_spec = self.machines[machine_id]
+        assert machine_spec.machine.get_status() == "stopped"
+        # Dropped from memory before its file, so a reload seeing the file gone finds nothing left to remove
         del self.machines[machine_id]
+        if write:
+            self.state.remove_machine(machine_id)
+        self.output.remove(machine_spec)
+        self.allocators.release(machine_id)
+        self.allocators.save()
 
 
 class ZDataStore(object):
@@ -195,7 +393,7 @@ class ZDataStore(object):
                     json.dump({}, f, sort_keys=True, indent=4)
             else:
                 raise
-        logging.info("Initialized datastore %s at %s", name, self.root_path)
+        logger.info("Initialized datastore %s at %s", name, self.root_path)
 
     def get_filepath(self, *paths):
         return os.path.join(self.root_path, *paths)
@@ -210,16 +408,49 @@ class ZConfig(object):
 
         self.machine_data_dir = self.datastore.get_filepath("machines")
         self.disk_data_dir = self.datastore.get_filepath("disks")
+        self.template_data_dir = self.datastore.get_filepath("templates")
+        self.run_dir = self.datastore.get_filepath("run")
 
-        for d in [self.machine_data_dir, self.disk_data_dir]:
+        for d in [self.machine_data_dir, self.disk_data_dir, self.template_data_dir, self.run_dir]:
             os.makedirs(d, exist_ok=True)
 
+    def get_runpath(self, *paths):
+        """
+        Return a path within the directory used for runtime files such as monitor sockets
+        """
+        return os.path.join(self.run_dir, *paths)
+
+    def get_runinfo(self, machine_id):
+        """
+        Return the runtime info recorded when a machine was launched, or None if there is none
+        """
+        try:
+            with open(self.get_runpath("{}.json".format(machine_id))) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_runinfo(self, machine_id, info):
+        """
+        Record runtime info (pid, sockets, devices) of a launched machine, so a later daemon can find it again
+        """
+        path = self.get_runpath("{}.json".format(machine_id))
+        with open(path + ".tmp", "w") as f:
+            json.dump(info, f, indent=4, sort_keys=True)
+        os.rename(path + ".tmp", path)
+
+    def remove_runinfo(self, machine_id):
+        try:
+            os.unlink(self.get_runpath("{}.json".format(machine_id)))
+        except FileNotFoundError:
+            pass
+
     def get_machines(self):
         """
         Return list of all machines on hypervisor
         """
         machines = []
-        logging.info("Looking for machine configs in {}".format(self.machine_data_dir))
+        logger.info("Looking for machine configs in {}".format(self.machine_data_dir))
         for f_name in iglob(self.machine_data_dir + '/*.json'):
             with open(f_name, "r") as f:
                 machines.append(json.load(f))
@@ -251,7 +482,7 @@ class ZConfig(object):
         Return list of all disks on the hypervisor
         """
         disks = []
-        logging.info("Looking for disk configs in {}".format(self.disk_data_dir))
+        logger.info("Looking for disk configs in {}".format(self.disk_data_dir))
         for f_name in iglob(self.disk_data_dir + '/*.json'):
             with open(f_name, "r") as f:
                 disks.append(json.load(f))
@@ -266,16 +497,50 @@ class ZConfig(object):
     def remove_disk(self, disk_id):
         os.unlink(os.path.join(self.disk_data_dir, "{}.json".format(disk_id)))
 
+    def get_allocators(self):
+        """
+        Return the saved state of the allocators, see zhypervisor.allocators
+        """
+        try:
+            with open(self.datastore.get_filepath("allocators.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
 
-def main():
-    setup_logging()
+    def write_allocators(self, allocators):
+        path = self.datastore.get_filepath("allocators.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(allocators, f, indent=4, sort_keys=True)
+        os.rename(path + ".tmp", path)
 
+    def get_templates(self):
+        """
+        Return list of all machine templates
+        """
+        templates = []
+        logger.info("Looking for template configs in {}".format(self.template_data_dir))
+        for f_name in iglob(self.template_data_dir + '/*.json'):
+            with open(f_name, "r") as f:
+                templates.append(json.load(f))
+        return templates
+
+    def write_template(self, template_id, template_spec):
+        with open(os.path.join(self.template_data_dir, "{}.json".format(template_id)), "w") as f:
+            json.dump({"template_id": template_id,
+                       "spec": template_spec}, f, indent=4, sort_keys=True)
+
+    def remove_template(self, template_id):
+        os.unlink(os.path.join(self.template_data_dir, "{}.json".format(template_id)))
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default="/etc/zd.json", help="Config file path")
     args = parser.parse_args()
 
     if not os.path.exists(args.config):
-        logging.warning("Config does not exist, attempting to write default config")
+        setup_logging()
+        logger.warning("Config does not exist, attempting to write default config")
         with open(args.config, "w") as f:
             json.dump({"nodename": "examplenode",
                        "access": [("root", "toor", 0)],
@@ -289,7 +554,10 @@ def main():
 
     with open(args.config) as f:
         config = json.load(f)
+    log_handler = setup_logging(**config.get("logging", {}))
 
-    z = ZHypervisorDaemon(config)
+    z = ZHypervisorDaemon(config, args.config)
+    z.stats.register_gauge("zd_log_records_dropped", "Log records dropped because the log writer fell behind",
+                           lambda: log_handler.dropped)
     z.run()
-    print("Z has been shut down")
+    logger.info("Z has been shut down")
@@ -0,0 +1,266 @@
+import os
+import re
+import json
+import shutil
+import select
+import logging
+import subprocess
+
+from zhypervisor.schema import SpecError
+from zhypervisor.util import InvalidTransition
+from zhypervisor.jobs import JobCancelled
+from zhypervisor.clients.qmachine import QDisk, PREALLOCATION
+
+
+logger = logging.getLogger(__name__)
+
+
+# Progress qemu-img -p prints, e.g. "    (42.00/100%)"
+PROGRESS_RE = re.compile(rb"\((\d+(?:\.\d+)?)/100%\)")
+
+# ionice scheduling classes by name
+IO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+
+class DiskJobError(Exception):
+    pass
+
+
+class DiskJobs(object):
+    """
+    Maintenance of qemu disk images run as background jobs: converting them to another format, compressing or
+    sparsifying them with qemu-img convert, and resizing them. Images are rewritten in place, so disks are only worked
+    on while no machine or warm instance attaches them or an overlay of them, and qemu refuses to start on disks a job
+    is working on.
+
+    Jobs run on their own pool of workers so they can't hold up migrations, and qemu-img is run at a low cpu and io
+    priority so it doesn't starve running guests.
+    """
+    def __init__(self, master, workers=2, nice=10, ionice="best-effort", ionice_level=7, poll_interval=0.5):
+        """
+        :param workers: disk jobs run at once, others wait in the queue
+        :param nice: cpu niceness of qemu-img
+        :param ionice: io scheduling class of qemu-img, one of realtime, best-effort or idle. None leaves it unchanged
+        :param ionice_level: priority within the io scheduling class, 0 (highest) to 7
+        :param poll_interval: seconds between checks for cancellation while qemu-img runs
+        """
+        self.master = master
+        self.nice = nice
+        self.ionice = ionice
+        self.ionice_level = ionice_level
+        self.poll_interval = poll_interval
+        self.master.jobs.add_pool("disk", workers)
+
+    def get_prefix(self):
+        """
+        Return the argv prefix running qemu-img at the configured priorities
+        """
+        prefix = []
+        if self.ionice is not None and shutil.which("ionice"):
+            prefix += ["ionice", "-c", str(IO_CLASSES[self.ionice])]
+            if self.ionice != "idle":
+                prefix += ["-n", str(self.ionice_level)]
+        if self.nice:
+            prefix += ["nice", "-n", str(self.nice)]
+        return prefix
+
+    def get_disk(self, disk_id):
+        """
+        :raises KeyError: if there is no such disk
+        """
+        disk = self.master.disks[disk_id]
+        if not isinstance(disk, QDisk):
+            raise SpecError("Only qemu disks can be converted or resized")
+        return disk
+
+    def check_idle(self, disk_id):
+        """
+        :raises InvalidTransition: if a machine or warm instance uses the disk
+        """
+        users = self.master.disk_users(disk_id)
+        if users:
+            raise InvalidTransition("Disk {} is in use by {}".format(disk_id, ", ".join(users)))
+
+    def check_free(self, disk_ids):
+        """
+        Called before qemu is launched on disks
+        :raises InvalidTransition: if a job is working on one of the disks or on a disk they read through
+        """
+        for disk_id in disk_ids:
+            for chained_id in self.master.disk_chain(disk_id):
+                job = self.master.jobs.active("disk", chained_id)
+                if job is not None:
+                    raise InvalidTransition("Disk {} is busy with {} job {}".format(chained_id, job.kind, job.job_id))
+
+    def get_size(self, disk):
+        """
+        Return the virtual size of a disk's image in megabytes. It is read from the image, as overlays and cloned disks
+        don't record it.
+        :raises DiskJobError: if the size can't be read
+        """
+        try:
+            output = subprocess.check_output(["qemu-img", "info", "--output=json", "-f", disk.properties["fmt"],
+                                              disk.get_path()], stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+            return json.loads(output.decode("UTF-8"))["virtual-size"] / 1048576
+        except subprocess.CalledProcessError as e:
+            raise DiskJobError("Could not read the size of disk {}: {}".format(
+                disk.disk_id, e.output.decode("UTF-8", errors="replace").strip()))
+        except (OSError, ValueError, KeyError) as e:
+            raise DiskJobError("Could not read the size of disk {}: {}".format(disk.disk_id, e))
+
+    def check_shrink(self, disk, size, shrink):
+        """
+        :raises SpecError: if the disk would become smaller without shrink being allowed
+        :raises DiskJobError: if the disk's current size can't be read
+        """
+        if shrink:
+            return
+        current = self.get_size(disk)
+        if size < current:
+            raise SpecError("Disk would shrink from {:g}M to {}M, pass shrink to allow it".format(current, size))
+
+    def convert(self, disk_id, fmt=None, compress=False, sparse=None, preallocation=None):
+        """
+        Start rewriting a disk's image with qemu-img convert and return the job doing it. Overlays are flattened: the
+        new image holds the data read through the backing disk and has no backing disk.
+        :param fmt: format to convert to, the disk's current format if None
+        :param compress: compress the image's clusters, qcow2 only
+        :param sparse: bytes of consecutive zeroes that are left unallocated in the new image, 0 to allocate everything.
+                       qemu-img's default of 4k if None
+        :param preallocation: preallocation mode of the new image, see PREALLOCATION
+        """
+        disk = self.get_disk(disk_id)
+        fmt = fmt or disk.properties["fmt"]
+        if fmt not in PREALLOCATION:
+            raise SpecError("Disks can only be converted to: {}".format(", ".join(sorted(PREALLOCATION))))
+        if compress and fmt != "qcow2":
+            raise SpecError("Only qcow2 disks can be compressed")
+        if preallocation is not None:
+            if preallocation not in PREALLOCATION[fmt]:
+                raise SpecError("preallocation of {} disks must be one of: {}".format(fmt,
+                                                                                     ", ".join(PREALLOCATION[fmt])))
+            if compress and preallocation != "off":
+                raise SpecError("Compressed disks can't be preallocated")
+        sparse = None if sparse is None else int(sparse)
+        if sparse is not None and sparse < 0:
+            raise SpecError("sparse must not be negative")
+        overlays = [other_id for other_id, other in list(self.master.disks.items())
+                    if other.properties.get("backing") == disk_id]
+        if overlays and fmt != disk.properties["fmt"]:
+            raise SpecError("Disk is the backing disk of {}, its format can't change".format(", ".join(overlays)))
+        self.check_idle(disk_id)
+        return self.master.jobs.submit("convert", "disk", disk_id, self.run_convert, disk_id, fmt, bool(compress),
+                                       sparse, preallocation, pool="disk")
+
+    def resize(self, disk_id, size, shrink=False, preallocation=None):
+        """
+        Start resizing a disk's image and return the job doing it
+        :param size: new size in megabytes
+        :param shrink: allow the disk to become smaller, which loses the data past the new end
+        :param preallocation: preallocation mode of the added space, see PREALLOCATION
+        """
+        disk = self.get_disk(disk_id)
+        size = int(size)
+        if size <= 0:
+            raise SpecError("size must be positive")
+        if preallocation is not None and preallocation not in PREALLOCATION.get(disk.properties["fmt"], ()):
+            raise SpecError("preallocation of {} disks must be one of: {}".format(
+                disk.properties["fmt"], ", ".join(PREALLOCATION.get(disk.properties["fmt"], ()))))
+        self.check_idle(disk_id)
+        self.check_shrink(disk, size, shrink)
+        return self.master.jobs.submit("resize", "disk", disk_id, self.run_resize, disk_id, size, bool(shrink),
+                                       preallocation, pool="disk")
+
+    def run_convert(self, job, disk_id, fmt, compress, sparse, preallocation):
+        disk = self.master.disks[disk_id]
+        self.check_idle(disk_id)
+        path = disk.get_path()
+        temp_path = path + ".convert"
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)  # left behind by a job that was interrupted
+        img_args = ["qemu-img", "convert", "-p", "-f", disk.properties["fmt"], "-O", fmt]
+        if compress:
+            img_args.append("-c")
+        if sparse is not None:
+            img_args += ["-S", str(sparse)]
+        if preallocation is not None:
+            img_args += ["-o", "preallocation={}".format(preallocation)]
+        img_args += [path, temp_path]
+        job.update(message="converting to {}".format(fmt))
+        try:
+            self.run_img(job, img_args, disk_id)
+            # Guests can't have started on the disk meanwhile, but the job may have been cancelled at the last moment
+            job.update()
+            before = os.path.getsize(path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        properties = dict(disk.properties, fmt=fmt)
+        for key in ("backing", "backing_fmt"):
+            properties.pop(key, None)
+        if preallocation is not None:
+            properties["preallocation"] = preallocation
+        self.update_disk(disk, properties)
+        after = os.path.getsize(path)
+        logger.info("Converted disk %s to %s, %s bytes before and %s after", disk_id, fmt, before, after,
+                    extra={"disk_id": disk_id})
+        job.message = "converted to {}".format(fmt)
+        return {"fmt": fmt, "bytes_before": before, "bytes_after": after}
+
+    def run_resize(self, job, disk_id, size, shrink, preallocation):
+        disk = self.master.disks[disk_id]
+        self.check_idle(disk_id)
+        self.check_shrink(disk, size, shrink)  # the image may have changed while the job was queued
+        img_args = ["qemu-img", "resize", "-f", disk.properties["fmt"]]
+        if preallocation is not None:
+            img_args.append("--preallocation={}".format(preallocation))
+        if shrink:
+            img_args.append("--shrink")
+        img_args += [disk.get_path(), "{}M".format(size)]
+        job.update(message="resizing to {}M".format(size))
+        self.run_img(job, img_args, disk_id)
+        self.update_disk(disk, dict(disk.properties, size=size))
+        logger.info("Resized disk %s to %sM", disk_id, size, extra={"disk_id": disk_id})
+        job.message = "resized to {}M".format(size)
+        return {"size": size}
+
+    def run_img(self, job, img_args, disk_id):
+        """
+        Run qemu-img, reporting the progress it prints to the job. qemu-img is terminated if the job is cancelled.
+        :raises DiskJobError: if qemu-img fails
+        """
+        img_args = self.get_prefix() + img_args
+        logger.info("Running: %s", str(img_args), extra={"disk_id": disk_id})
+        proc = subprocess.Popen(img_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = b""
+        try:
+            while True:
+                ready, _, _ = select.select([proc.stdout], [], [], self.poll_interval)
+                if ready:
+                    data = os.read(proc.stdout.fileno(), 4096)
+                    if not data:
+                        break
+                    output = (output + data)[-4096:]
+                    progress = PROGRESS_RE.findall(output)
+                    if progress:
+                        job.update(progress=float(progress[-1]) / 100)
+                job.update()
+        except JobCancelled:
+            proc.terminate()
+            proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+        if proc.wait() != 0:
+            # Keep qemu-img's error messages, not its progress lines
+            lines = PROGRESS_RE.sub(b"", output).decode("UTF-8", errors="replace").split("\n")
+            raise DiskJobError("qemu-img failed: {}".format(" ".join(line.strip() for line in lines if line.strip())))
+
+    def update_disk(self, disk, properties):
+        disk.properties = properties
+        self.master.state.write_disk(disk.disk_id, properties)
+        for machine_spec in list(self.master.machines.values()):
+            machine_spec.machine.invalidate_plan()
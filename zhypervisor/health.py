@@ -0,0 +1,323 @@
+import json
+import math
+import asyncio
+import logging
+from time import time
+from random import randint
+from threading import Thread
+
+from zhypervisor.metrics import CountingExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeFailed(Exception):
+    pass
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel. Timers are bucketed by the tick they expire on, so scheduling a timer and collecting expired
+    ones cost the same no matter how many timers are pending. Not thread safe, it is only used from the event loop.
+    """
+    def __init__(self, tick=0.5, slots=512):
+        """
+        :param tick: resolution of the wheel in seconds
+        :param slots: number of buckets. Timers further out than one turn of the wheel stay in their bucket for more
+                      than one turn.
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.now = 0  # number of the last tick processed
+
+    def schedule(self, delay, item):
+        """
+        Add an item that expires after some seconds
+        """
+        expires = self.now + max(1, int(math.ceil(delay / self.tick)))
+        self.slots[expires % len(self.slots)].append((expires, item))
+
+    def advance(self):
+        """
+        Move forward one tick and return the items that expired
+        """
+        self.now += 1
+        slot = self.slots[self.now % len(self.slots)]
+        expired = [item for expires, item in slot if expires <= self.now]
+        if expired:
+            slot[:] = [(expires, item) for expires, item in slot if expires > self.now]
+        return expired
+
+
+class ProbeState(object):
+    """
+    One probe of one process of a machine, and its recent results
+    """
+    def __init__(self, machine_spec, proc, probe):
+        """
+        :param proc: the process being probed. The probe is dropped once the machine's process is a different one.
+        :param probe: probe definition from the machine's properties, see zhypervisor.schema.PROBE_FIELDS
+        """
+        self.machine_spec = machine_spec
+        self.proc = proc
+        self.probe = probe
+        self.interval = probe.get("interval", 10)
+        self.timeout = probe.get("timeout", 5)
+        self.threshold = probe.get("failures", 3)
+        self.failures = 0  # consecutive failures
+        self.last_check = None
+        self.last_error = None
+
+    def is_current(self):
+        return self.machine_spec.machine.proc is self.proc
+
+    def is_healthy(self):
+        return self.failures < self.threshold
+
+    def serialize(self):
+        return {"type": self.probe["type"],
+                "healthy": self.is_healthy(),
+                "failures": self.failures,
+                "last_check": self.last_check,
+                "last_error": self.last_error}
+
+
+async def probe_tcp(monitor, state):
+    """
+    Healthy if a tcp connection can be opened
+    """
+    _, writer = await asyncio.open_connection(state.probe.get("host", "127.0.0.1"), state.probe["port"])
+    writer.close()
+
+
+async def probe_http(monitor, state):
+    """
+    Healthy if a GET request is answered with a 2xx or 3xx status
+    """
+    host = state.probe.get("host", "127.0.0.1")
+    reader, writer = await asyncio.open_connection(host, state.probe["port"])
+    try:
+        writer.write("GET {} HTTP/1.0\r\nHost: {}\r\n\r\n".format(state.probe.get("path", "/"), host).encode("UTF-8"))
+        await writer.drain()
+        status_line = (await reader.readline()).decode("latin-1").split()
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise ProbeFailed("Not an HTTP response")
+        status = int(status_line[1])
+        if not 200 <= status < 400:
+            raise ProbeFailed("HTTP status {}".format(status))
+    finally:
+        writer.close()
+
+
+async def probe_qmp(monitor, state):
+    """
+    Healthy if qemu reports the guest is running, rather than e.g. paused on an error or panicked. Uses the machine's
+    QMP connection, which is blocking, from the monitor's thread pool.
+    """
+    qmp = state.machine_spec.machine.qmp
+    status = await monitor.loop.run_in_executor(monitor.pool, qmp.execute, "query-status")
+    if status.get("status") != "running":
+        raise ProbeFailed("Guest is {}".format(status.get("status")))
+
+
+async def probe_agent(monitor, state):
+    """
+    Healthy if the qemu guest agent inside the guest answers a ping
+    """
+    reader, writer = await asyncio.open_unix_connection(state.machine_spec.machine.agent_path)
+    try:
+        # guest-sync discards any response left over from an earlier, interrupted exchange
+        sync_id = randint(1, 2 ** 31)
+        for command in ({"execute": "guest-sync", "arguments": {"id": sync_id}}, {"execute": "guest-ping"}):
+            writer.write(json.dumps(command).encode("UTF-8") + b"\n")
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ProbeFailed("Guest agent closed the connection")
+                try:
+                    response = json.loads(line.decode("UTF-8"))
+                except ValueError:
+                    continue
+                if "error" in response:
+                    raise ProbeFailed("Guest agent error: {}".format(response["error"].get("desc")))
+                if "return" in response and (command["execute"] == "guest-ping" or response["return"] == sync_id):
+                    break
+    finally:
+        writer.close()
+
+
+PROBES = {"tcp": probe_tcp, "http": probe_http, "qmp": probe_qmp, "agent": probe_agent}
+
+
+class HealthMonitor(object):
+    """
+    Runs the health probes of every running machine. Probes are scheduled on a single timer wheel and performed as
+    coroutines on one asyncio event loop, so thousands of probes need one thread. Only QMP probes, which share the
+    machine's blocking QMP client, borrow a thread from a small pool.
+
+    A machine is unhealthy once any of its probes has failed its threshold of times in a row. Probes with the
+    "restart" action restart the machine at that point.
+    """
+    def __init__(self, master, tick=0.5, concurrency=256, workers=2):
+        """
+        :param master: ZHypervisorDaemon reference
+        :param tick: resolution of probe scheduling in seconds
+        :param concurrency: most probes to have in flight at once
+        :param workers: number of threads QMP probes are run with
+        """
+        self.master = master
+        self.wheel = TimerWheel(tick)
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.pool = CountingExecutor(workers)
+        self.machines = {}  # Mapping of machine name -> list of ProbeStates of its current process
+        self.stopped = False
+        self.thread = Thread(target=self.run, name="health", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.thread.is_alive():
+            self.thread.join()
+        self.pool.shutdown(wait=False)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.ticker())
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def ticker(self):
+        """
+        Advance the wheel once per tick and start the probes that are due. Ticks are kept aligned to the time the loop
+        started, a loop that falls behind catches up by processing the missed ticks immediately.
+        """
+        self.limit = asyncio.Semaphore(self.concurrency)
+        started = self.loop.time()
+        while not self.stopped:
+            await asyncio.sleep(max(0, started + (self.wheel.now + 1) * self.wheel.tick - self.loop.time()))
+            for state in self.wheel.advance():
+                self.loop.create_task(self.check(state))
+
+    def watch(self, machine_spec, proc):
+        """
+        Start probing a newly launched process of a machine. Probes of the machine's previous process stop by
+        themselves.
+        """
+        if self.stopped or self.loop.is_closed():
+            return  # machines launched during shutdown go unprobed
+        probes = [ProbeState(machine_spec, proc, probe) for probe in machine_spec.properties.get("probes", [])]
+        if not probes:
+            self.machines.pop(machine_spec.machine_id, None)
+            return
+        self.machines[machine_spec.machine_id] = probes
+        for state in probes:
+            # Give the guest time to boot before its first check
+            try:
+                self.loop.call_soon_threadsafe(self.wheel.schedule, state.probe.get("delay", 30), state)
+            except RuntimeError:
+                return  # the loop closed since the check above
+
+    async def check(self, state):
+        """
+        Perform one probe, record the result and schedule the next one
+        """
+        if not state.is_current():
+            return
+        async with self.limit:
+            try:
+                await asyncio.wait_for(PROBES[state.probe["type"]](self, state), state.timeout)
+                error = None
+            except asyncio.TimeoutError:
+                error = "Timed out after {}s".format(state.timeout)
+            except Exception as e:
+                error = str(e) or type(e).__name__
+        if not state.is_current():
+            return
+
+        machine_id = state.machine_spec.machine_id
+        state.last_check = time()
+        if error is None:
+            if not state.is_healthy():
+                logger.info("%s %s probe has recovered", machine_id, state.probe["type"],
+                            extra={"machine_id": machine_id})
+            state.failures = 0
+            state.last_error = None
+            state.machine_spec.machine.record_boot("probe")
+        else:
+            state.failures += 1
+            state.last_error = error
+            logger.debug("%s %s probe failed: %s", machine_id, state.probe["type"], error,
+                         extra={"machine_id": machine_id})
+            if state.failures == state.threshold:
+                logger.warning("%s is unhealthy, %s probe failed %s times: %s", machine_id, state.probe["type"],
+                               state.failures, error, extra={"machine_id": machine_id})
+                if state.probe.get("action", "none") == "restart":
+                    Thread(target=self.restart, args=[state.machine_spec, state.proc], daemon=True).start()
+        self.wheel.schedule(state.interval, state)
+
+    def restart(self, machine_spec, proc):
+        """
+        Restart an unhealthy machine, unless it has been stopped or restarted meanwhile
+        """
+        machine = machine_spec.machine
+        with machine.lock:
+            if machine.proc is not proc:
+                return
+            machine.log.warning("Restarting unhealthy machine %s", machine_spec.machine_id)
+            try:
+                self.master.forceful_stop(machine_spec.machine_id)
+                machine_spec.start()
+            except Exception:
+                machine.log.exception("Could not restart %s", machine_spec.machine_id)
+
+    def get_probes(self, machine_id):
+        """
+        Return the ProbeStates of a machine's current process, or None if it is not being probed
+        """
+        probes = self.machines.get(machine_id)
+        if not probes or not probes[0].is_current():
+            return None
+        return probes
+
+    def get_status(self, machine_id):
+        """
+        Return "healthy", "unhealthy", "unknown" if no probe has completed yet, or None if the machine is not probed
+        """
+        probes = self.get_probes(machine_id)
+        if probes is None:
+            return None
+        if not all(state.is_healthy() for state in probes):
+            return "unhealthy"
+        if all(state.last_check is None for state in probes):
+            return "unknown"
+        return "healthy"
+
+    def get_machine(self, machine_id):
+        """
+        Return a json-friendly summary of a machine's health
+        """
+        probes = self.get_probes(machine_id)
+        return {"machine_id": machine_id,
+                "status": self.get_status(machine_id),
+                "probes": [state.serialize() for state in probes] if probes else []}
+
+    def get_gauge(self):
+        """
+        Return 1 for every healthy and 0 for every unhealthy probed machine, keyed by prometheus labels
+        """
+        values = {}
+        for machine_id in list(self.machines):
+            status = self.get_status(machine_id)
+            if status in ("healthy", "unhealthy"):
+                values[(("machine_id", machine_id), )] = int(status == "healthy")
+        return values
@@ -0,0 +1,173 @@
+import logging
+from time import time
+from uuid import uuid4
+from threading import Event, Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobConflict(Exception):
+    """
+    Another job is already working on the same machine or disk
+    """
+    pass
+
+
+class Job(object):
+    """
+    A long running operation, such as a migration, run in the background. The function doing the work reports its
+    progress through update(), which also ends the job if it was cancelled.
+    """
+    def __init__(self, kind, target_type, target):
+        """
+        :param kind: what the job does, e.g. "migrate"
+        :param target_type: "machine" or "disk"
+        :param target: id of the machine or disk the job works on
+        """
+        self.job_id = uuid4().hex
+        self.kind = kind
+        self.target_type = target_type
+        self.target = target
+        self.status = "queued"  # then running, and one of done, failed or cancelled
+        self.progress = 0.0
+        self.message = None
+        self.error = None
+        self.result = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.cancelled = Event()
+
+    def update(self, progress=None, message=None):
+        """
+        Report progress
+        :param progress: fraction of the work done, 0 to 1
+        :param message: description of the current step
+        :raises JobCancelled: if the job was cancelled
+        """
+        if progress is not None:
+            self.progress = min(max(progress, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+        if self.cancelled.is_set():
+            raise JobCancelled("Job {} was cancelled".format(self.job_id))
+
+    def serialize(self):
+        return {"job_id": self.job_id,
+                "kind": self.kind,
+                "target_type": self.target_type,
+                "target": self.target,
+                "status": self.status,
+                "progress": round(self.progress, 4),
+                "message": self.message,
+                "error": self.error,
+                "result": self.result,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished}
+
+
+class JobManager(object):
+    """
+    Runs jobs on pools of worker threads and keeps the most recent finished ones for inspection. Only one job at a time
+    may work on a machine or disk. Jobs run on the default pool unless another was added for them with add_pool().
+    """
+    def __init__(self, master, workers=4, history=100):
+        """
+        :param workers: jobs run at once, others wait in the queue
+        :param history: finished jobs remembered
+        """
+        self.master = master
+        self.history = history
+        self.executors = {"default": ThreadPoolExecutor(workers, thread_name_prefix="job")}
+        self.jobs = OrderedDict()  # Mapping of job id -> Job, oldest first
+        self.lock = Lock()
+        self.master.stats.describe("zd_job_seconds", "Time spent running background jobs")
+
+    def add_pool(self, name, workers):
+        """
+        Add a pool of worker threads jobs can be submitted to, bounding how many of them run at once apart from others
+        """
+        self.executors[name] = ThreadPoolExecutor(workers, thread_name_prefix="job-" + name)
+
+    def submit(self, kind, target_type, target, func, *args, pool="default"):
+        """
+        Queue func(job, *args) to run as a job and return the Job. The return value of func becomes the job's result.
+        :param pool: name of the pool of workers to run the job on
+        :raises JobConflict: if an unfinished job works on the same target
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.finished is None and (job.target_type, job.target) == (target_type, target):
+                    raise JobConflict("Job {} is already working on {} {}".format(job.job_id, target_type, target))
+            job = Job(kind, target_type, target)
+            self.jobs[job.job_id] = job
+            finished = [job_id for job_id, old in self.jobs.items() if old.finished is not None]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[job_id]
+        self.executors[pool].submit(self.run, job, func, args)
+        return job
+
+    def run(self, job, func, args):
+        job.started = time()
+        job.status = "running"
+        logger.info("Started %s job %s on %s %s", job.kind, job.job_id, job.target_type, job.target,
+                    extra={job.target_type + "_id": job.target})
+        try:
+            job.update()
+            job.result = func(job, *args)
+            job.progress = 1.0
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            logger.exception("%s job %s on %s %s failed", job.kind, job.job_id, job.target_type, job.target,
+                             extra={job.target_type + "_id": job.target})
+            job.error = str(e)
+            job.status = "failed"
+        job.finished = time()
+        self.master.stats.observe("zd_job_seconds", job.finished - job.started, kind=job.kind, status=job.status)
+        logger.info("%s job %s on %s %s is %s", job.kind, job.job_id, job.target_type, job.target, job.status,
+                    extra={job.target_type + "_id": job.target})
+
+    def active(self, target_type, target):
+        """
+        Return the unfinished job working on a machine or disk, or None
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.finished is None and (job.target_type, job.target) == (target_type, target):
+                    return job
+        return None
+
+    def get(self, job_id):
+        """
+        :raises KeyError: if there is no such job
+        """
+        return self.jobs[job_id]
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Ask a job to stop at its next progress report. Jobs still queued do not run at all.
+        """
+        self.jobs[job_id].cancelled.set()
+
+    def stop(self):
+        """
+        Cancel all jobs and wait for the running ones to end
+        """
+        for job in self.list():
+            job.cancelled.set()
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
@@ -1,9 +1,210 @@
-
+import sys
+import copy
+import json
+import queue
+import atexit
 import logging
+import logging.handlers
+from threading import Lock
+
+
+def get_level(level):
+    """
+    Return the number of a logging level given by name, e.g. "INFO", or number
+    :raises ValueError: if the level is unknown
+    """
+    number = level if isinstance(level, int) else logging.getLevelName(level)
+    if not isinstance(number, int):
+        raise ValueError("Unknown logging level: {!r}".format(level))
+    return number
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one json object per line. The machine_id, disk_id and template_id a record was logged with, e.g.
+    through extra={"machine_id": ...}, are included as fields of their own.
+    """
+    fields = ("machine_id", "disk_id", "template_id")
+
+    def format(self, record):
+        entry = {"time": record.created,
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The format of logging.basicConfig, noting how many repeats of a message were suppressed
+    """
+    def __init__(self):
+        logging.Formatter.__init__(self, logging.BASIC_FORMAT)
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        if getattr(record, "suppressed", 0):
+            text += " ({} similar messages suppressed)".format(record.suppressed)
+        return text
+
+
+class LevelFilter(logging.Filter):
+    """
+    Apply per-logger levels to records from loggers that set their own levels, such as cherrypy's. A record is checked
+    against the level of the closest configured ancestor of its logger.
+    """
+    def __init__(self, levels):
+        """
+        :param levels: dict of logger name -> level
+        :raises ValueError: if a level is unknown
+        """
+        logging.Filter.__init__(self)
+        self.levels = {name: get_level(level) for name, level in levels.items()}
+
+    def filter(self, record):
+        name = record.name
+        while True:
+            if name in self.levels:
+                return record.levelno >= self.levels[name]
+            if "." not in name:
+                return True
+            name = name.rsplit(".", 1)[0]
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop records repeating a message more than burst times per interval. Messages are told apart by logger, level,
+    unformatted message and machine, so e.g. the same failure of two machines is limited separately. The number of
+    records dropped is attached to the next one let through.
+    """
+    def __init__(self, interval=60, burst=10, max_keys=10000):
+        """
+        :param interval: seconds over which repeats are counted
+        :param burst: records of a message let through per interval
+        :param max_keys: distinct messages tracked before expired ones are forgotten
+        """
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.max_keys = max_keys
+        self.windows = {}  # Mapping of message key -> [window start, records seen, records dropped]
+        self.lock = Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, str(record.msg), getattr(record, "machine_id", None))
+        now = record.created
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                if window is None and len(self.windows) >= self.max_keys:
+                    self.expire(now)
+                self.windows[key] = [now, 1, 0]
+                return True
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            window[2] += 1
+            return False
+
+    def expire(self, now):
+        for key, window in list(self.windows.items()):
+            if now - window[0] >= self.interval:
+                del self.windows[key]
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread. Callers never wait on logging i/o: records are only merged with their arguments
+    before being queued, and dropped if the queue is full.
+    """
+    def __init__(self, record_queue):
+        logging.handlers.QueueHandler.__init__(self, record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Arguments are merged now as they may be changed after the call, formatting is left to the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level="DEBUG", format="json", levels=None, rate_limit=None, queue_size=10000):
+    """
+    Route all logging through a queue to a single thread writing to stderr, so no other thread blocks on log output.
+    Accepts the 'logging' key of zd.json as keyword arguments.
+    :param level: level of the root logger
+    :param format: "json" for one json object per record, or "text"
+    :param levels: dict of logger name -> level, e.g. {"cherrypy": "WARNING", "zhypervisor.health": "INFO"}
+    :param rate_limit: dict of RateLimitFilter arguments. Repeated messages are not limited if unset.
+    :param queue_size: records that may wait for the writer thread before new ones are dropped
+    :return: the DroppingQueueHandler
+    :raises ValueError: if a level is unknown
+    """
+    level = get_level(level)
+    level_filter = LevelFilter(levels or {})
+    writer = logging.StreamHandler(sys.stderr)
+    writer.setFormatter(JsonFormatter() if format == "json" else TextFormatter())
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    if levels:
+        handler.addFilter(level_filter)
+    if rate_limit is not None:
+        handler.addFilter(RateLimitFilter(**rate_limit))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in level_filter.levels.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    atexit.register(listener.stop)  # flushes the queue
+    return handler
 
 
-def setup_logging():
+def update_logging(level="DEBUG", levels=None, **kwargs):
     """
-    Set up a standard logging level/format
+    Apply new levels to logging set up by setup_logging, e.g. after zd.json was reloaded. Accepts the same keyword
+    arguments. The format, rate limit and queue size are kept until restart.
+    :raises ValueError: if a level is unknown, in which case the levels in effect are kept
     """
-    logging.basicConfig(level=logging.DEBUG)
+    level = get_level(level)
+    level_filter = LevelFilter(levels or {})
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            for old in [f for f in handler.filters if isinstance(f, LevelFilter)]:
+                handler.removeFilter(old)
+                for name in old.levels:
+                    logging.getLogger(name).setLevel(logging.NOTSET)
+            if levels:
+                handler.filters.insert(0, level_filter)  # ahead of the rate limit, as in setup_logging
+    root.setLevel(level)
+    for name, logger_level in level_filter.levels.items():
+        logging.getLogger(name).setLevel(logger_level)
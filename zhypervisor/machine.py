@@ -2,6 +2,11 @@ import logging
 
 from zhypervisor.clients.qmachine import QMachine
 from zhypervisor.clients.dockermachine import DockerMachine
+from zhypervisor.schema import SpecError
+
+
+logger = logging.getLogger(__name__)
+
 
 MACHINETYPES = {"q": QMachine, "docker": DockerMachine}
 
@@ -15,33 +20,67 @@ class MachineSpec(object):
         Initialize options and properties of the machine. More importantly, initialize the self.machine object which
         should be a subclass of zhypervisor.util.Machine.
         """
-        logging.info("Initting machine %s", machine_id)
+        logger.info("Initting machine %s", machine_id, extra={"machine_id": machine_id})
         self.master = master
         self.machine_id = machine_id
+        self.machine = None
 
         self.properties = spec
+        self.machine = MachineSpec.get_type(spec)(self)
+
+    @property
+    def properties(self):
+        return self._properties
+
+    @properties.setter
+    def properties(self, spec):
+        """
+        Replace the machine's properties, discarding the launch plan compiled from the old ones
+        """
+        self._properties = spec
+        if self.machine is not None:
+            self.machine.invalidate_plan()
 
+    @staticmethod
+    def get_type(spec):
+        """
+        Return the machine class for a spec
+        """
         try:
-            machine_type = MACHINETYPES[self.properties.get("type", None)]
+            return MACHINETYPES[spec.get("type", None)]
         except KeyError:
-            raise Exception("Unknown or missing machine type: {}".format(self.properties.get("type", None)))
+            raise SpecError("Unknown or missing machine type: {}".format(spec.get("type", None)))
 
-        self.machine = machine_type(self)
+    @staticmethod
+    def validate(master, machine_id, spec):
+        """
+        Check a spec is valid for a new or existing machine, raising SpecError if not
+        """
+        if not isinstance(spec, dict):
+            raise SpecError("Machine spec must be an object")
+        machine_type = MachineSpec.get_type(spec)
+        if machine_id in master.machines and type(master.machines[machine_id].machine) is not machine_type:
+            raise SpecError("Cannot change the type of existing machine {}".format(machine_id))
+        machine_type.validate_spec(master, spec)
 
     def start(self):
         """
         Start this machine (pass-through)
         """
-        self.machine.block_respawns = False
         self.machine.start_machine()
 
     def stop(self):
         """
         Stop this machine
         """
-        self.machine.block_respawns = True
         self.machine.stop_machine()
 
+    def powerdown(self):
+        """
+        Ask this machine to stop without waiting for it
+        """
+        self.machine.powerdown()
+
     def save(self):
         """
         Write the machine's config to disk
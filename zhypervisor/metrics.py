@@ -0,0 +1,372 @@
+import os
+import math
+import logging
+from time import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+logger = logging.getLogger(__name__)
+
+
+# Per-sample fields collected from every machine. Machines report the subset they can measure; the rest are NaN.
+FIELDS = ("cpu_seconds", "rss_bytes",
+          "block_read_bytes", "block_write_bytes", "block_read_ops", "block_write_ops",
+          "net_rx_bytes", "net_tx_bytes")
+
+# Prometheus metric name, type and help text per field
+PROM_METRICS = {"cpu_seconds": ("zd_machine_cpu_seconds_total", "counter", "CPU time consumed by the machine"),
+                "rss_bytes": ("zd_machine_memory_rss_bytes", "gauge", "Resident memory of the machine"),
+                "block_read_bytes": ("zd_machine_block_read_bytes_total", "counter", "Bytes read from disks"),
+                "block_write_bytes": ("zd_machine_block_write_bytes_total", "counter", "Bytes written to disks"),
+                "block_read_ops": ("zd_machine_block_read_ops_total", "counter", "Disk read operations"),
+                "block_write_ops": ("zd_machine_block_write_ops_total", "counter", "Disk write operations"),
+                "net_rx_bytes": ("zd_machine_network_receive_bytes_total", "counter", "Bytes received"),
+                "net_tx_bytes": ("zd_machine_network_transmit_bytes_total", "counter", "Bytes transmitted")}
+
+# Default histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def read_proc_stats(pid):
+    """
+    Return cpu time and rss of a process as read from /proc/<pid>/stat
+    """
+    with open("/proc/{}/stat".format(pid), "rb") as f:
+        stat = f.read()
+    # The process name field may contain spaces, so only split what comes after it
+    fields = stat[stat.rindex(b")") + 2:].split()
+    utime, stime, rss = int(fields[11]), int(fields[12]), int(fields[21])
+    return {"cpu_seconds": (utime + stime) / CLOCK_TICKS,
+            "rss_bytes": rss * PAGE_SIZE}
+
+
+def read_iface_stats(ifname):
+    """
+    Return host-side rx/tx byte counters for a network interface. Note that for a guest's tap device, what the host
+    transmits the guest receives.
+    """
+    stats_dir = "/sys/class/net/{}/statistics".format(ifname)
+    counters = {}
+    for field, counter in [("net_rx_bytes", "tx_bytes"), ("net_tx_bytes", "rx_bytes")]:
+        with open(os.path.join(stats_dir, counter)) as f:
+            counters[field] = int(f.read())
+    return counters
+
+
+class RingBuffer(object):
+    """
+    Fixed size history of samples. Each sample is a timestamp plus one float per field, all packed into a single flat
+    array so memory use is constant no matter how long the daemon runs.
+    """
+    def __init__(self, capacity, fields=FIELDS):
+        self.capacity = capacity
+        self.fields = fields
+        self.width = len(fields) + 1
+        self.data = array("d", [math.nan]) * (capacity * self.width)
+        self.head = 0  # slot the next sample is written to
+        self.count = 0
+
+    def append(self, timestamp, sample):
+        """
+        Record a sample
+        :param timestamp: unix time the sample was taken
+        :param sample: dict of field name -> value. Missing fields are recorded as NaN
+        """
+        offset = self.head * self.width
+        self.data[offset] = timestamp
+        for i, field in enumerate(self.fields, start=1):
+            self.data[offset + i] = sample.get(field, math.nan)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _row(self, slot):
+        offset = slot * self.width
+        row = {"time": self.data[offset]}
+        for i, field in enumerate(self.fields, start=1):
+            value = self.data[offset + i]
+            row[field] = None if math.isnan(value) else value
+        return row
+
+    def latest(self):
+        """
+        Return the most recent sample or None if there are no samples yet
+        """
+        if not self.count:
+            return None
+        return self._row((self.head - 1) % self.capacity)
+
+    def samples(self):
+        """
+        Return all retained samples, oldest first
+        """
+        start = (self.head - self.count) % self.capacity
+        return [self._row((start + i) % self.capacity) for i in range(self.count)]
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that counts the tasks submitted to it and the tasks taken off its queue, by a worker or by being
+    cancelled, so the length of its queue can be reported
+    """
+    def __init__(self, *args, **kwargs):
+        ThreadPoolExecutor.__init__(self, *args, **kwargs)
+        self.submitted = 0
+        self.dequeued = 0
+        self.count_lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = ThreadPoolExecutor.submit(self, self.run_task, fn, args, kwargs)
+        with self.count_lock:
+            self.submitted += 1
+        future.add_done_callback(self.count_cancelled)
+        return future
+
+    def run_task(self, fn, args, kwargs):
+        with self.count_lock:
+            self.dequeued += 1
+        return fn(*args, **kwargs)
+
+    def count_cancelled(self, future):
+        if future.cancelled():
+            with self.count_lock:
+                self.dequeued += 1
+
+    def queue_length(self):
+        """
+        Return the number of tasks waiting for a worker
+        """
+        with self.count_lock:
+            # A worker may pick a task up before its submission is counted
+            return max(0, self.submitted - self.dequeued)
+
+
+class MetricsCollector(object):
+    """
+    Samples resource usage of every running machine on one shared interval. Sampling is fanned out across a small,
+    fixed size pool of threads so that one slow or hung machine can only ever delay its own sample.
+    """
+    def __init__(self, master, interval=10, history=360, workers=4):
+        """
+        :param master: ZHypervisorDaemon reference
+        :param interval: seconds between samples
+        :param history: number of samples retained per machine
+        :param workers: number of threads machines are sampled with
+        """
+        self.master = master
+        self.interval = interval
+        self.history = history
+        self.buffers = {}  # Mapping of machine name -> RingBuffer
+        self.pending = {}  # Mapping of machine name -> sample future that has not yet finished
+        self.pool = CountingExecutor(workers)
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.pool.shutdown(wait=False)
+
+    def run(self):
+        """
+        Collection loop. Each pass is aligned to the interval, a pass that overruns simply delays the next one.
+        """
+        while not self.stopped.is_set():
+            started = time()
+            try:
+                self.collect()
+            except Exception:
+                logger.exception("Metrics collection failed")
+            self.stopped.wait(max(0, self.interval - (time() - started)))
+
+    def collect(self):
+        """
+        Take one sample of every running machine
+        """
+        machines = dict(self.master.machines)
+        for machine_id in set(self.buffers) - set(machines):
+            del self.buffers[machine_id]
+        for machine_id in set(self.pending) - set(machines):
+            del self.pending[machine_id]
+
+        futures = {}
+        for machine_id, machine_spec in machines.items():
+            if machine_spec.machine.get_status() == "stopped":
+                continue
+            if machine_id in self.pending:
+                # A hung machine gets at most one queued sample
+                if not self.pending[machine_id].done():
+                    continue
+            future = self.pool.submit(machine_spec.machine.get_stats)
+            self.pending[machine_id] = future
+            futures[future] = machine_id
+
+        done, not_done = wait(futures, timeout=self.interval)
+        for future in not_done:
+            logger.warning("Metrics sample of %s timed out", futures[future], extra={"machine_id": futures[future]})
+        for future in done:
+            machine_id = futures[future]
+            del self.pending[machine_id]
+            try:
+                sample = future.result()
+            except Exception as e:
+                logger.warning("Could not sample %s: %s", machine_id, e, extra={"machine_id": machine_id})
+                continue
+            if machine_id not in self.buffers:
+                self.buffers[machine_id] = RingBuffer(self.history)
+            self.buffers[machine_id].append(time(), sample)
+
+    def queue_size(self):
+        """
+        Return the number of samples waiting for a worker
+        """
+        return self.pool.queue_length()
+
+    def get_machine(self, machine_id, history=False):
+        """
+        Return a json-friendly summary of a machine's metrics
+        :param history: include all retained samples rather than just the latest
+        """
+        buf = self.buffers.get(machine_id)
+        info = {"machine_id": machine_id,
+                "interval": self.interval,
+                "latest": buf.latest() if buf else None}
+        if history:
+            info["samples"] = buf.samples() if buf else []
+        return info
+
+    def render_prometheus(self):
+        """
+        Return the latest sample of every machine in the prometheus text exposition format
+        """
+        latest = {machine_id: buf.latest() for machine_id, buf in list(self.buffers.items())}
+        lines = []
+        for field in FIELDS:
+            name, metric_type, help_text = PROM_METRICS[field]
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for machine_id, sample in sorted(latest.items()):
+                if sample is None or sample[field] is None:
+                    continue
+                lines.append("{}{} {} {}".format(name, format_labels((("machine_id", machine_id), )),
+                                                 repr(sample[field]), int(sample["time"] * 1000)))
+        return "\n".join(lines) + "\n"
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values with fixed bucket bounds
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.total += value
+
+    def snapshot(self):
+        """
+        Return (cumulative bucket counts, sum, count)
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, running
+
+
+class Instrumentation(object):
+    """
+    Registry of the daemon's own latency histograms and gauges
+    """
+    def __init__(self):
+        self.histograms = {}  # Mapping of metric name -> {labels tuple: Histogram}
+        self.help = {}  # Mapping of metric name -> help text
+        self.gauges = {}  # Mapping of metric name -> (help text, callable returning {labels tuple: value})
+        self.lock = Lock()
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in the histogram identified by the metric name and labels
+        """
+        key = tuple(sorted(labels.items()))
+        series = self.histograms.get(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            with self.lock:
+                series = self.histograms.setdefault(name, {})
+                histogram = series.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager observing the wall time spent within it
+        """
+        started = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - started, **labels)
+
+    def register_gauge(self, name, help_text, func):
+        """
+        Register a gauge whose values are computed when rendered
+        :param func: callable returning a number, or a dict of labels tuple -> number
+        """
+        self.gauges[name] = (help_text, func)
+
+    def render_prometheus(self):
+        lines = []
+        for name, (help_text, func) in sorted(self.gauges.items()):
+            try:
+                values = func()
+            except Exception as e:
+                logger.warning("Could not compute gauge %s: %s", name, e)
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in sorted(values.items()):
+                lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+        for name, series in sorted(list(self.histograms.items())):
+            lines.append("# HELP {} {}".format(name, self.help.get(name, name)))
+            lines.append("# TYPE {} histogram".format(name))
+            for labels, histogram in sorted(list(series.items())):
+                cumulative, total, count = histogram.snapshot()
+                bounds = [repr(float(b)) for b in histogram.buckets] + ["+Inf"]
+                for bound, value in zip(bounds, cumulative):
+                    lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", bound), )), value))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), repr(total)))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """
+    Format a tuple of (name, value) pairs as a prometheus label set
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
@@ -0,0 +1,262 @@
+import socket
+import logging
+from time import time, sleep
+from threading import Timer, Lock
+
+from zhypervisor.client import ZClient, ZClientError
+from zhypervisor.machine import MachineSpec
+from zhypervisor.schema import SpecError
+from zhypervisor.util import InvalidTransition
+from zhypervisor.clients.qmachine import QMachine
+
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationError(Exception):
+    pass
+
+
+class MigrationManager(object):
+    """
+    Moves running qemu machines between zd nodes without stopping them. The source node asks the target node's API to
+    launch the machine with -incoming, streams the guest to it over TCP through QMP and, once the guest runs on the
+    target, hands the machine record over to the target and drops its own. Migrations run as jobs on the source.
+
+    Disks are not copied: they must be reachable from both nodes under the same disk ids, e.g. in a datastore on shared
+    storage.
+    """
+    def __init__(self, master, peers=None, address=None, ports=(49152, 49215), bandwidth=None, downtime=300,
+                 incoming_timeout=3600, poll_interval=0.5):
+        """
+        :param peers: dict of nodename -> ZClient arguments for the nodes machines may be migrated to, e.g.
+                      {"node2": {"url": "http://node2:3000", "username": "root", "password": "toor"}}
+        :param address: address sources connect to for incoming migrations. Defaults to the host the source reaches this
+                        node's API on
+        :param ports: range of TCP ports incoming migrations listen on
+        :param bandwidth: default limit of the migration stream in MiB/s, qemu's default if unset
+        :param downtime: default longest pause of the guest at switchover in milliseconds
+        :param incoming_timeout: seconds an incoming machine waits for its migration before it is discarded
+        :param poll_interval: seconds between progress checks
+        """
+        self.master = master
+        self.peers = peers or {}
+        self.address = address
+        self.ports = ports
+        self.bandwidth = bandwidth
+        self.downtime = downtime
+        self.incoming_timeout = incoming_timeout
+        self.poll_interval = poll_interval
+        self.timers = {}  # Mapping of incoming machine id -> Timer discarding it
+        self.lock = Lock()
+
+    def migrate(self, machine_id, target, bandwidth=None, downtime=None):
+        """
+        Start migrating a running machine to another node and return the job doing it
+        :param target: nodename of the peer to migrate to
+        :param bandwidth: limit of the migration stream in MiB/s
+        :param downtime: longest pause of the guest at switchover in milliseconds
+        """
+        machine_spec = self.master.machines[machine_id]
+        if not isinstance(machine_spec.machine, QMachine):
+            raise SpecError("Only qemu machines can be migrated")
+        if machine_spec.properties.get("volumes"):
+            raise SpecError("Machines with volumes can't be migrated, virtiofs and 9p don't support it")
+        if target not in self.peers:
+            raise SpecError("Unknown migration target {}, expected one of: {}".format(target,
+                                                                                     ", ".join(sorted(self.peers))))
+        if machine_spec.machine.get_status() != "running":
+            raise InvalidTransition("Only running machines can be migrated")
+        bandwidth = self.bandwidth if bandwidth is None else float(bandwidth)
+        downtime = self.downtime if downtime is None else int(downtime)
+        return self.master.jobs.submit("migrate", "machine", machine_id, self.run_migration, machine_id, target,
+                                       bandwidth, downtime)
+
+    def run_migration(self, job, machine_id, target, bandwidth, downtime):
+        machine_spec = self.master.machines[machine_id]
+        machine = machine_spec.machine
+        client = ZClient(**self.peers[target])
+        # Other operations on the machine wait until it is gone from this node, or the migration failed
+        with machine.lock:
+            if machine.get_status() != "running":
+                raise InvalidTransition("Only running machines can be migrated")
+            job.update(message="launching the machine on {}".format(target))
+            incoming = client.prepare_incoming(machine_id, machine_spec.properties,
+                                               source=self.master.config.get("nodename"))
+            uri = "tcp:{}:{}".format(incoming.get("address") or client.host, incoming["port"])
+            logger.info("Migrating %s to %s at %s", machine_id, target, uri, extra={"machine_id": machine_id})
+            completed = False
+            try:
+                info = machine.migrate(uri, job, bandwidth=None if bandwidth is None else bandwidth * 1048576,
+                                       downtime=downtime, poll_interval=self.poll_interval)
+                completed = True
+                job.message = "handing the machine over to {}".format(target)
+                client.commit_incoming(machine_id)
+            except Exception as e:
+                discarded = self.abort_target(client, machine_id, target)
+                if completed:
+                    # The guest is paused here once the stream completed. Unless the target surely dropped its copy,
+                    # it may be running there: resuming it here too would run the guest twice on the same disks.
+                    if not discarded:
+                        raise MigrationError("Migration of {} failed after the stream completed ({}) and {} did not "
+                                             "discard the machine: it is left paused here, check {} before resuming "
+                                             "it".format(machine_id, e, target, target)) from e
+                    machine.qmp.execute("cont")
+                raise
+            finally:
+                client.close()
+
+            # The target owns the machine now, stop the paused qemu left here and forget the machine
+            machine.begin_stop()
+            try:
+                machine.qmp.execute("quit")
+            except (OSError, ValueError):
+                pass
+            if not machine.wait_stopped(10):
+                machine.kill_machine()
+            self.master.remove_machine(machine_id)
+        logger.info("Migrated %s to %s", machine_id, target, extra={"machine_id": machine_id})
+        job.message = "migrated to {}".format(target)
+        return {"target": target,
+                "total_time_ms": info.get("total-time"),
+                "downtime_ms": info.get("downtime"),
+                "transferred_bytes": info.get("ram", {}).get("transferred")}
+
+    def abort_target(self, client, machine_id, target):
+        """
+        Ask the target to discard its incoming copy of a machine whose migration failed. Returns whether the target no
+        longer has the machine.
+        """
+        try:
+            client.abort_incoming(machine_id)
+            return True
+        except ZClientError as e:
+            if e.status == 404:
+                return True
+            error = e
+        except Exception as e:
+            error = e
+        logger.warning("Could not discard incoming machine %s on %s: %s", machine_id, target, error,
+                       extra={"machine_id": machine_id})
+        return False
+
+    # Below here is the target side of migrations, called through the API by the source
+
+    def prepare_incoming(self, machine_id, properties, source=None):
+        """
+        Launch a machine waiting for an incoming migration. Returns the address and port the source should stream it to.
+        The machine is only kept after commit_incoming() is called.
+        """
+        if machine_id in self.master.machines:
+            raise InvalidTransition("Machine {} already exists on this node".format(machine_id))
+        if MachineSpec.get_type(properties) is not QMachine:
+            raise SpecError("Only qemu machines can be migrated")
+        MachineSpec.validate(self.master, machine_id, properties)
+        with self.lock:
+            port = self.get_port()
+            self.master.allocators.reserve(machine_id, properties)
+            machine_spec = self.master.add_machine(machine_id, properties)
+            machine_spec.machine.incoming = port
+            machine_spec.machine.invalidate_plan()
+        try:
+            machine_spec.start()
+            self.wait_listening(machine_spec)
+        except Exception:
+            self.discard(machine_id)
+            raise
+        timer = Timer(self.incoming_timeout, self.expire, [machine_id])
+        timer.daemon = True
+        with self.lock:
+            self.timers[machine_id] = timer
+        timer.start()
+        logger.info("Waiting for %s to be migrated from %s on port %s", machine_id, source, port,
+                    extra={"machine_id": machine_id})
+        return {"port": port, "address": self.address}
+
+    def wait_listening(self, machine_spec, timeout=30):
+        """
+        Wait for an incoming qemu to answer on QMP, which it does once it listens for the migration
+        """
+        deadline = time() + timeout
+        while True:
+            try:
+                machine_spec.machine.qmp.execute("query-status")
+                return
+            except (OSError, ValueError):
+                if time() > deadline or machine_spec.machine.get_status() != "running":
+                    raise MigrationError("qemu did not come up for the migration of {}".format(machine_spec.machine_id))
+                sleep(0.05)
+
+    def get_port(self):
+        """
+        Return a free port of the range for an incoming migration
+        """
+        used = {machine_spec.machine.incoming for machine_spec in list(self.master.machines.values())
+                if isinstance(machine_spec.machine, QMachine)}
+        for port in range(self.ports[0], self.ports[1] + 1):
+            if port in used:
+                continue
+            with socket.socket() as sock:
+                try:
+                    sock.bind(("0.0.0.0", port))
+                except OSError:
+                    continue
+            return port
+        raise MigrationError("No free port for incoming migrations in {}-{}".format(*self.ports))
+
+    def get_incoming(self, machine_id):
+        machine_spec = self.master.machines[machine_id]
+        if getattr(machine_spec.machine, "incoming", None) is None:
+            raise InvalidTransition("{} is not waiting for a migration".format(machine_id))
+        return machine_spec
+
+    def commit_incoming(self, machine_id, timeout=30):
+        """
+        Take ownership of a machine once its migration completed: wait for the guest to run and write its record
+        """
+        machine_spec = self.get_incoming(machine_id)
+        machine = machine_spec.machine
+        # qemu resumes the guest once it received the whole stream, shortly after the source saw it complete
+        deadline = time() + timeout
+        while machine.qmp.execute("query-status")["status"] != "running":
+            if time() > deadline:
+                raise MigrationError("{} did not resume after its migration".format(machine_id))
+            sleep(0.1)
+        machine.record_boot("running")
+        self.cancel_timer(machine_id)
+        machine.incoming = None
+        machine.invalidate_plan()
+        self.master.state.write_machine(machine_id, machine_spec.properties)
+        self.master.allocators.save()
+        logger.info("Machine %s was migrated to this node", machine_id, extra={"machine_id": machine_id})
+
+    def abort_incoming(self, machine_id):
+        """
+        Discard a machine waiting for a migration that failed
+        """
+        self.get_incoming(machine_id)
+        self.discard(machine_id)
+        logger.info("Discarded incoming machine %s", machine_id, extra={"machine_id": machine_id})
+
+    def expire(self, machine_id):
+        with self.lock:
+            if self.timers.get(machine_id) is None:
+                return
+        logger.warning("Migration of %s did not complete in %ss, discarding it", machine_id, self.incoming_timeout,
+                       extra={"machine_id": machine_id})
+        try:
+            self.abort_incoming(machine_id)
+        except (KeyError, InvalidTransition):
+            pass
+
+    def cancel_timer(self, machine_id):
+        with self.lock:
+            timer = self.timers.pop(machine_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def discard(self, machine_id):
+        self.cancel_timer(machine_id)
+        machine_spec = self.master.machines[machine_id]
+        machine_spec.machine.kill_machine()
+        self.master.remove_machine(machine_id, write=False)
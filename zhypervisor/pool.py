@@ -0,0 +1,468 @@
+import os
+import signal
+import logging
+from glob import iglob
+from time import time, sleep
+from uuid import uuid4
+from threading import Thread, Event, Lock
+
+from zhypervisor.machine import MachineSpec
+from zhypervisor.clients.qmachine import QMachine, QDisk
+from zhypervisor.schema import SpecError, Field, validate_fields, non_negative
+from zhypervisor.util import InvalidTransition, read_cmdline
+
+
+logger = logging.getLogger(__name__)
+
+
+# Keys of a template spec
+TEMPLATE_FIELDS = {"pool_size": Field(int, check=non_negative),
+                   "properties": Field(dict, required=True)}
+
+# Prefix of the ids of warm instances and their overlay disks
+INSTANCE_PREFIX = "pool-"
+
+
+class Template(object):
+    """
+    Machine properties new machines can be created from, and the warm instances kept ready for it
+    """
+    def __init__(self, template_id, spec):
+        self.template_id = template_id
+        self.spec = spec
+        self.instances = []  # Ready WarmInstances, oldest first
+
+    @property
+    def properties(self):
+        return self.spec["properties"]
+
+    @property
+    def pool_size(self):
+        return self.spec.get("pool_size", 0)
+
+    def serialize(self):
+        return self.spec
+
+
+class WarmInstance(object):
+    """
+    A paused qemu process waiting to be claimed, along with the overlay disks it was started with
+    """
+    def __init__(self, template, properties, disks, machine_spec):
+        """
+        :param properties: the template's properties with drives pointing at the overlay disks
+        :param disks: ids of the overlay disks
+        :param machine_spec: MachineSpec the instance runs under. It is not listed in the daemon's machines.
+        """
+        self.template = template
+        self.properties = properties
+        self.disks = disks
+        self.machine_spec = machine_spec
+        self.mem = properties.get("mem", 256)
+
+    def is_alive(self):
+        return self.machine_spec.machine.get_status() == "running"
+
+
+class WarmPool(object):
+    """
+    Keeps qemu instances of templates booted ahead of time, with their cpus stopped, so a machine can be created from a
+    template by resuming one rather than booting from scratch. Every instance runs on qcow2 overlays of the template's
+    disks so instances share the template's images. Pools are refilled in the background, within a memory budget.
+    """
+    def __init__(self, master, memory_budget=None, interval=5, boot_timeout=60):
+        """
+        :param master: ZHypervisorDaemon reference
+        :param memory_budget: megabytes of guest memory all warm instances together may use. No limit if None
+        :param interval: seconds between checks of the pools
+        :param boot_timeout: seconds an instance has to start answering QMP before it is discarded
+        """
+        self.master = master
+        self.memory_budget = memory_budget
+        self.interval = interval
+        self.boot_timeout = boot_timeout
+        self.templates = {}  # Mapping of template name -> Template
+        self.lock = Lock()  # Guards templates and their instance lists
+        self.claim_lock = Lock()  # Serializes claims so two can't create the same machine
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="pool", daemon=True)
+
+    @staticmethod
+    def validate(master, spec):
+        """
+        Check a template spec, raising SpecError if it is not valid
+        """
+        if not isinstance(spec, dict):
+            raise SpecError("Template spec must be an object")
+        validate_fields(master, TEMPLATE_FIELDS, spec)
+        properties = spec["properties"]
+        if MachineSpec.get_type(properties) is not QMachine:
+            raise SpecError("Only qemu machines can be created from templates")
+        QMachine.validate_spec(master, dict(properties, vnc=False))
+        # Settings that must be unique per machine can't be shared by every machine made from the template. Displays
+        # and mac addresses are allocated per machine instead.
+        if not isinstance(properties.get("vnc", False), bool):
+            raise SpecError("properties.vnc can only be true or false in templates")
+        if properties.get("volumes"):
+            # Warm instances are snapshots of running guests, which can't carry a shared filesystem's state
+            raise SpecError("properties.volumes cannot be set in templates")
+        for i, iface in enumerate(properties.get("netifaces", [])):
+            for key in ("ifname", "macaddr"):
+                if key in iface:
+                    raise SpecError("properties.netifaces[{}].{} cannot be set in templates".format(i, key))
+
+    def start(self):
+        self.cleanup_stale()
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop refilling and discard every warm instance. Warm instances are never left running, even in detached mode.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            instances = [instance for template in self.templates.values() for instance in template.instances]
+            for template in self.templates.values():
+                template.instances = []
+        for instance in instances:
+            self.discard(instance)
+
+    def cleanup_stale(self):
+        """
+        Kill warm instances and delete overlay disks left behind by a daemon that did not shut down cleanly
+        """
+        state = self.master.state
+        for path in iglob(state.get_runpath(INSTANCE_PREFIX + "*.json")):
+            instance_id = os.path.basename(path)[:-len(".json")]
+            if instance_id in self.master.machines:
+                continue  # a machine that merely has a similar name
+            info = state.get_runinfo(instance_id)
+            cmdline = read_cmdline(info["pid"])
+            if cmdline is not None and any(info["qmp"] in arg for arg in cmdline):
+                logger.warning("Killing stale warm instance %s", instance_id, extra={"machine_id": instance_id})
+                os.kill(info["pid"], signal.SIGKILL)
+            state.remove_runinfo(instance_id)
+        for datastore in self.master.datastores.values():
+            for path in iglob(datastore.get_filepath("disks", INSTANCE_PREFIX + "*.bin")):
+                if os.path.basename(path) not in self.master.disks:
+                    logger.warning("Removing stale overlay disk %s", path)
+                    os.unlink(path)
+
+    def add_template(self, template_id, spec, write=False):
+        """
+        Create or update a template. Warm instances of the old version of a template are discarded.
+        :param write: validate the spec and commit it to on-disk state
+        """
+        if write:
+            self.validate(self.master, spec)
+        with self.lock:
+            template = self.templates.get(template_id)
+            if template is None:
+                template = self.templates[template_id] = Template(template_id, spec)
+                stale = []
+            else:
+                template.spec = spec
+                stale = template.instances
+                template.instances = []
+        for instance in stale:
+            self.discard(instance)
+        if write:
+            self.master.state.write_template(template_id, spec)
+        self.wakeup.set()
+
+    def remove_template(self, template_id, write=True):
+        """
+        Remove a template and discard its warm instances. Machines already claimed from it are kept.
+        :param write: also remove the template from on-disk state
+        """
+        with self.lock:
+            template = self.templates.pop(template_id)
+        for instance in template.instances:
+            self.discard(instance)
+        if write:
+            self.master.state.remove_template(template_id)
+
+    def get_counts(self):
+        """
+        Return the number of warm instances of each template, keyed by prometheus labels
+        """
+        with self.lock:
+            return {(("template", template_id), ): len(template.instances)
+                    for template_id, template in self.templates.items()}
+
+    def memory_used(self):
+        with self.lock:
+            return sum(instance.mem for template in self.templates.values() for instance in template.instances)
+
+    def run(self):
+        """
+        Refill loop. Runs every interval, or as soon as an instance has been claimed or a template has changed.
+        """
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            try:
+                self.refill()
+            except Exception:
+                logger.exception("Refilling warm pools failed")
+            self.wakeup.wait(self.interval)
+
+    def refill(self):
+        """
+        Discard instances that have exited, then boot instances one at a time, always for the template whose pool is
+        the least full, until every pool is full or the memory budget is used up. A template whose instance fails to
+        boot is skipped until the next pass.
+        """
+        self.prune()
+        failed = set()
+        while not self.stopped.is_set():
+            template = self.next_template(failed)
+            if template is None:
+                return
+            try:
+                self.warm(template)
+            except Exception:
+                logger.exception("Could not boot warm instance of %s", template.template_id,
+                                 extra={"template_id": template.template_id})
+                failed.add(template.template_id)
+
+    def prune(self):
+        with self.lock:
+            dead = [instance for template in self.templates.values() for instance in template.instances
+                    if not instance.is_alive()]
+            for instance in dead:
+                instance.template.instances.remove(instance)
+        for instance in dead:
+            logger.warning("Warm instance %s of %s has exited", instance.machine_spec.machine_id,
+                           instance.template.template_id, extra={"machine_id": instance.machine_spec.machine_id})
+            self.discard(instance)
+
+    def next_template(self, skip):
+        """
+        Return the template most in need of another warm instance that fits in the memory budget, or None
+        """
+        used = self.memory_used()
+        with self.lock:
+            candidates = [template for template in self.templates.values()
+                          if template.template_id not in skip and len(template.instances) < template.pool_size and
+                          (self.memory_budget is None or
+                           used + template.properties.get("mem", 256) <= self.memory_budget)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda template: len(template.instances) / template.pool_size)
+
+    def warm(self, template):
+        """
+        Boot a paused instance of a template and add it to the template's pool once it answers QMP
+        """
+        spec = template.spec
+        instance_id = "{}{}-{}".format(INSTANCE_PREFIX, template.template_id, uuid4().hex[:8])
+        properties, disks = self.prepare(instance_id, template)
+        # The instance must not respawn or be started again by anything but a claim, and is only probed once claimed
+        machine_spec = MachineSpec(self.master, instance_id, dict(properties, respawn=False, autostart=False,
+                                                                  probes=[]))
+        instance = WarmInstance(template, properties, disks, machine_spec)
+        machine = machine_spec.machine
+        machine.start_paused = True
+        try:
+            machine.start_machine()
+            deadline = time() + self.boot_timeout
+            while True:
+                try:
+                    machine.qmp.execute("query-status")
+                    break
+                except (OSError, ValueError):
+                    if not instance.is_alive() or time() > deadline or self.stopped.is_set():
+                        raise
+                    sleep(0.05)
+        except:
+            self.discard(instance)
+            raise
+
+        with self.lock:
+            # The template may have been changed or removed while the instance was booting
+            if self.templates.get(template.template_id) is template and template.spec is spec:
+                template.instances.append(instance)
+                logger.info("Warm instance %s of %s is ready", instance_id, template.template_id,
+                            extra={"machine_id": instance_id})
+                return
+        self.discard(instance)
+
+    def prepare(self, owner, template):
+        """
+        Create overlay disks and allocate vnc displays and mac addresses for a new machine or instance of a template
+        :param owner: id of the machine or instance
+        :return: tuple of the machine properties and the ids of the overlay disks
+        """
+        properties, disks = self.make_overlays(owner, template.properties)
+        try:
+            return self.master.allocators.assign(owner, properties), disks
+        except:
+            self.abandon(owner, disks)
+            raise
+
+    def make_overlays(self, prefix, properties):
+        """
+        Create an overlay of each qcow2 disk attached by some machine properties. Other disks, such as isos, are
+        attached as is.
+        :param prefix: prefix of the overlay disk ids
+        :return: tuple of the properties with drives pointing at the overlays, and the ids of the overlays
+        """
+        drives = []
+        disks = []
+        try:
+            for i, drive in enumerate(properties.get("drives", [])):
+                disk = self.master.disks[drive["disk"]]
+                if isinstance(disk, QDisk):
+                    disk_id = "{}-{}.bin".format(prefix, i)
+                    self.master.add_disk(disk_id, {"type": "qdisk",
+                                                   "datastore": disk.datastore.name,
+                                                   "fmt": "qcow2",
+                                                   "backing": drive["disk"],
+                                                   "backing_fmt": disk.properties["fmt"]})
+                    disks.append(disk_id)
+                    drive = dict(drive, disk=disk_id)
+                drives.append(drive)
+        except:
+            self.abandon(prefix, disks)
+            raise
+        properties = dict(properties)
+        if drives:
+            properties["drives"] = drives
+        return properties, disks
+
+    def abandon(self, owner, disks):
+        """
+        Delete the overlay disks and release the values allocated for a machine or instance that will not be used
+        """
+        for disk_id in disks:
+            try:
+                self.master.remove_disk(disk_id, write=False)
+            except Exception:
+                logger.exception("Could not delete overlay disk %s", disk_id, extra={"disk_id": disk_id})
+        self.master.allocators.release(owner)
+
+    def discard(self, instance):
+        """
+        Kill a warm instance and delete its overlay disks
+        """
+        try:
+            instance.machine_spec.machine.kill_machine()
+        except Exception:
+            logger.exception("Could not kill warm instance %s", instance.machine_spec.machine_id,
+                             extra={"machine_id": instance.machine_spec.machine_id})
+        self.abandon(instance.machine_spec.machine_id, instance.disks)
+        self.master.output.remove(instance.machine_spec)
+
+    def next_machine_ids(self, template_id, count):
+        """
+        Return the lowest unused machine ids of the form <template_id>-<n>
+        """
+        machine_ids = []
+        n = 1
+        while len(machine_ids) < count:
+            machine_id = "{}-{}".format(template_id, n)
+            if machine_id not in self.master.machines:
+                machine_ids.append(machine_id)
+            n += 1
+        return machine_ids
+
+    def claim(self, template_id, machine_ids=None, count=1):
+        """
+        Create and start machines from a template. Ready warm instances of the template are resumed, the remaining
+        machines are booted from scratch on new overlays. Every machine is prepared before any state is written, then
+        the state of all of them is written in one go. The pool is refilled in the background.
+        :param machine_ids: ids of the machines to create
+        :param count: number of machines to create if no ids are passed. They are named <template_id>-<n>
+        :raises KeyError: if there is no such template
+        :raises SpecError: if a machine already exists
+        :return: list of the new MachineSpecs
+        """
+        with self.claim_lock:
+            if machine_ids is None:
+                machine_ids = self.next_machine_ids(template_id, count)
+            if len(set(machine_ids)) != len(machine_ids):
+                raise SpecError("Machine ids must be unique")
+            for machine_id in machine_ids:
+                if machine_id in self.master.machines:
+                    raise SpecError("Machine {} already exists".format(machine_id))
+            started = time()
+            with self.lock:
+                template = self.templates[template_id]
+                instances = template.instances[:len(machine_ids)]
+                del template.instances[:len(machine_ids)]
+            self.wakeup.set()
+
+            prepared = []  # tuples of (MachineSpec, overlay disk ids, WarmInstance or None if booted from scratch)
+            try:
+                for machine_id in machine_ids:
+                    machine_spec = None
+                    while instances and machine_spec is None:
+                        instance = instances.pop(0)
+                        machine_spec = self.take_instance(instance, machine_id)
+                    if machine_spec is not None:
+                        prepared.append((machine_spec, instance.disks, instance))
+                        continue
+                    properties, disks = self.prepare(machine_id, template)
+                    try:
+                        MachineSpec.validate(self.master, machine_id, properties)
+                    except:
+                        self.abandon(machine_id, disks)
+                        raise
+                    prepared.append((MachineSpec(self.master, machine_id, properties), disks, None))
+            except:
+                for instance in instances:
+                    self.discard(instance)
+                for machine_spec, disks, _ in prepared:
+                    machine_spec.machine.kill_machine()
+                    self.abandon(machine_spec.machine_id, disks)
+                raise
+
+            state = self.master.state
+            for machine_spec, disks, _ in prepared:
+                for disk_id in disks:
+                    state.write_disk(disk_id, self.master.disks[disk_id].serialize())
+                state.write_machine(machine_spec.machine_id, machine_spec.properties)
+                self.master.machines[machine_spec.machine_id] = machine_spec
+            self.master.allocators.save()
+
+            for machine_spec, _, instance in prepared:
+                try:
+                    if instance is not None:
+                        machine_spec.machine.qmp.execute("cont")
+                        machine_spec.machine.record_boot("running")
+                    else:
+                        logger.info("No warm instance of %s is ready, booting %s from scratch", template_id,
+                                    machine_spec.machine_id, extra={"machine_id": machine_spec.machine_id})
+                        machine_spec.start()
+                except Exception:
+                    logger.exception("Could not start %s", machine_spec.machine_id,
+                                     extra={"machine_id": machine_spec.machine_id})
+                    machine_spec.machine.kill_machine()
+                    continue
+                self.master.stats.observe("zd_lifecycle_seconds", time() - started,
+                                          phase="claim_warm" if instance else "claim_cold", type=QMachine.machine_type)
+            return [machine_spec for machine_spec, _, _ in prepared]
+
+    def take_instance(self, instance, machine_id):
+        """
+        Hand a warm instance's process, disks and allocated values over to a new machine. Return the new MachineSpec,
+        or None if the instance has exited and was discarded.
+        """
+        instance_id = instance.machine_spec.machine_id
+        self.master.allocators.transfer(instance_id, machine_id)
+        machine_spec = MachineSpec(self.master, machine_id, instance.properties)
+        try:
+            machine_spec.machine.take_over(instance.machine_spec.machine)
+        except InvalidTransition:
+            logger.warning("Warm instance %s exited before it could be claimed", instance_id,
+                           extra={"machine_id": machine_id})
+            self.master.allocators.release(machine_id)
+            self.discard(instance)
+            return None
+        logger.info("Claimed warm instance %s of %s as %s", instance_id, instance.template.template_id, machine_id,
+                    extra={"machine_id": machine_id})
+        return machine_spec
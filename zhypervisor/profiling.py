@@ -0,0 +1,114 @@
+import os
+import sys
+import pstats
+import cProfile
+import tempfile
+import threading
+from time import time, sleep
+from collections import Counter
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class DaemonProfiler(object):
+    """
+    Captures time-boxed profiles of the running daemon. Two modes are supported:
+    - "sample": periodically snapshot the stacks of every thread. Cheap and sees the whole daemon. Output is in the
+      collapsed-stack format consumed by flamegraph tools.
+    - "cprofile": deterministic profile of every API request handled during the window. Each request thread gets its
+      own profiler, and all are merged into one pstats file at the end.
+    Only one profile may be captured at a time.
+    """
+    max_seconds = 300
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None  # list of cProfile.Profile objects while a cprofile session is active
+        self.local = threading.local()
+
+    def profile(self, seconds, mode="sample", interval=0.01):
+        """
+        Capture a profile, blocking for its duration
+        :param seconds: how long to profile for
+        :param mode: "sample" or "cprofile"
+        :param interval: sampling interval in seconds, for sample mode
+        :return: tuple of (filename, bytes)
+        """
+        assert mode in ("sample", "cprofile"), "Unknown profile mode: {}".format(mode)
+        seconds = min(float(seconds), self.max_seconds)
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already being captured")
+        try:
+            stamp = int(time())
+            if mode == "sample":
+                return "zd-{}.collapsed".format(stamp), self.sample(seconds, float(interval))
+            return "zd-{}.prof".format(stamp), self.cprofile(seconds)
+        finally:
+            self.lock.release()
+
+    def sample(self, seconds, interval):
+        """
+        Sample all threads' stacks, return them in collapsed format: one line per unique stack, frames joined by ";"
+        followed by the number of times it was seen
+        """
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        deadline = time() + seconds
+        while time() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                      code.co_firstlineno))
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(frames))] += 1
+            sleep(interval)
+        return "".join("{} {}\n".format(stack, count) for stack, count in stacks.most_common()).encode("UTF-8")
+
+    def cprofile(self, seconds):
+        """
+        Profile request handling for the given time, return a marshalled pstats file
+        """
+        self.session = []
+        try:
+            sleep(seconds)
+        finally:
+            profiles, self.session = self.session, None
+
+        stats = pstats.Stats()
+        for profile in profiles:
+            stats.add(profile)
+        with tempfile.NamedTemporaryFile() as f:
+            stats.dump_stats(f.name)
+            return f.read()
+
+    def enter(self):
+        """
+        Called by worker threads when they begin a unit of work. Starts a profiler if a cprofile session is active.
+        """
+        session = self.session
+        if session is not None and getattr(self.local, "profile", None) is None:
+            profile = cProfile.Profile()
+            self.local.profile = profile
+            profile.enable()
+
+    def exit(self):
+        """
+        Called by worker threads when they finish a unit of work
+        """
+        profile = getattr(self.local, "profile", None)
+        if profile is not None:
+            profile.disable()
+            self.local.profile = None
+            session = self.session
+            if session is not None:
+                session.append(profile)
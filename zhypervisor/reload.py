@@ -0,0 +1,375 @@
+import os
+import json
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from time import time
+from threading import Thread, Lock
+
+from zhypervisor.logging import update_logging
+from zhypervisor.machine import MachineSpec
+from zhypervisor.schema import SpecError
+
+
+logger = logging.getLogger(__name__)
+
+
+class Inotify(object):
+    """
+    Minimal binding of linux's inotify through ctypes. Reports the names of files written, moved or deleted in some
+    directories.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct("iIII")  # struct inotify_event without its name
+
+    def __init__(self, paths):
+        """
+        :raises OSError: if inotify is not available
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+        self.fd = init(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        for path in paths:
+            if add_watch(self.fd, path.encode(), mask) < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, "Could not watch {}".format(path))
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        Return the names of files changed since the last call
+        """
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _wd, _mask, _cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                names.append(data[offset:offset + length].rstrip(b"\0").decode("UTF-8", "replace"))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigReloader(object):
+    """
+    Applies changes of zd.json and of the on-disk state to the running daemon, on SIGHUP or, if watching, when files of
+    the state directories change. Running guests are never stopped or restarted by a reload.
+
+    State files are compared by modification time and size with when they were last loaded, so only changed records are
+    parsed again. Records equal to what the daemon already holds, such as those the daemon wrote itself, are left alone.
+    Changed machine definitions take effect the next time the machine is started. Records that fail to load are tried
+    again on the next reload.
+    """
+    # Top level keys of zd.json applied by a reload. Changes to others are kept in the config but need a restart.
+    live_keys = ("datastores", "access", "auth", "apiport", "logging", "shutdown", "detach")
+
+    def __init__(self, master, config_path=None, watch=False, debounce=1.0):
+        """
+        :param master: the ZHypervisorDaemon
+        :param config_path: zd.json path. Only the on-disk state is reloaded if unset.
+        :param watch: also reload the on-disk state when files of the machines, disks or templates directories change
+        :param debounce: seconds to wait for more changes after a file changed, so a batch of edits is applied at once
+        """
+        self.master = master
+        self.config_path = config_path
+        self.watch = watch
+        self.debounce = debounce
+        self.loaded = {}  # Mapping of state file path -> (modification time, size, record id) when last loaded
+        self.lock = Lock()  # held while reloading
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.thread = Thread(target=self.run, name="reload", daemon=True)
+
+    def start(self):
+        """
+        Note the state files loaded at startup and begin handling reload requests
+        """
+        for kind, directory in self.directories():
+            for path, (mtime, size) in self.scan(directory).items():
+                self.loaded[path] = (mtime, size, os.path.basename(path)[:-len(".json")])
+        self.thread.start()
+
+    def stop(self):
+        if self.thread.is_alive():
+            os.write(self.wakeup_w, b"x")
+            self.thread.join()
+
+    def request(self):
+        """
+        Ask for the config and on-disk state to be reloaded. Safe to call from a signal handler.
+        """
+        os.write(self.wakeup_w, b"r")
+
+    def directories(self):
+        # Disks come first as machines refer to them
+        state = self.master.state
+        return (("disk", state.disk_data_dir), ("template", state.template_data_dir),
+                ("machine", state.machine_data_dir))
+
+    def run(self):
+        inotify = None
+        if self.watch:
+            try:
+                inotify = Inotify([directory for _kind, directory in self.directories()])
+                logger.info("Watching the state directories for changes")
+            except OSError as e:
+                logger.warning("Cannot watch the state directories, reloading on SIGHUP only: %s", e)
+        watched = [self.wakeup_r] + ([inotify] if inotify else [])
+        due = None  # when a reload of the on-disk state is due after files changed
+        try:
+            while True:
+                timeout = None if due is None else max(0, due - time())
+                readable, _, _ = select.select(watched, [], [], timeout)
+                if self.wakeup_r in readable:
+                    data = os.read(self.wakeup_r, 64)
+                    if b"x" in data:
+                        return
+                    due = None
+                    self.reload()
+                elif inotify in readable:
+                    if any(name.endswith(".json") for name in inotify.read()) and due is None:
+                        due = time() + self.debounce
+                elif due is not None:
+                    due = None
+                    self.reload(config=False)
+        finally:
+            if inotify:
+                inotify.close()
+
+    def reload(self, config=True):
+        """
+        Apply changes of zd.json, unless config is False, then of the on-disk state
+        """
+        with self.lock:
+            started = time()
+            if config and self.config_path:
+                try:
+                    self.reload_config()
+                except Exception:
+                    logger.exception("Could not apply the config")
+            try:
+                changes = self.reload_state()
+            except Exception:
+                logger.exception("Could not reload the on-disk state")
+                changes = None
+            logger.info("Reloaded in %.3fs, %s state records changed", time() - started, changes)
+
+    def reload_config(self):
+        """
+        Read zd.json again and apply what changed. The current config is kept if the file cannot be read.
+        """
+        try:
+            with open(self.config_path) as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error("Could not read %s, keeping the current config: %s", self.config_path, e)
+            return
+        master = self.master
+        old = master.config
+
+        for name, info in config.get("datastores", {}).items():
+            if name not in master.datastores:
+                try:
+                    master.add_datastore(name, info)
+                except Exception as e:
+                    logger.error("Could not add datastore %s: %s", name, e)
+            elif os.path.abspath(info["path"]) != os.path.abspath(master.datastores[name].root_path):
+                logger.warning("Moving datastore %s to %s needs a restart", name, info["path"])
+        for name in set(master.datastores) - set(config.get("datastores", {})):
+            logger.warning("Datastore %s was removed from the config but stays in use until restart", name)
+
+        if old.get("access") != config.get("access") or old.get("auth") != config.get("auth"):
+            master.api.auth.configure(config.get("access", []), **config.get("auth", {}))
+            logger.info("Applied new API access settings")
+
+        port = config.get("apiport", 3000)
+        if old.get("apiport", 3000) != port:
+            try:
+                master.api.rebind(port)
+            except Exception as e:
+                logger.error("Could not move the API to port %s: %s", port, e)
+                config["apiport"] = old.get("apiport", 3000)
+
+        settings = config.get("logging", {})
+        if old.get("logging", {}) != settings:
+            try:
+                update_logging(**settings)
+            except ValueError as e:
+                logger.error("Could not apply the logging levels, keeping the current ones: %s", e)
+                config["logging"] = old.get("logging", {})
+            else:
+                for key in ("format", "rate_limit", "queue_size"):
+                    if old.get("logging", {}).get(key) != settings.get(key):
+                        logger.warning("Changes to logging.%s take effect after a restart", key)
+
+        restart = [key for key in sorted(set(old) | set(config))
+                   if key not in self.live_keys and old.get(key) != config.get(key)]
+        if restart:
+            logger.warning("Changes to %s take effect after a restart", ", ".join(restart))
+        master.config = config
+
+    def scan(self, directory):
+        """
+        Return a dict of path -> (modification time, size) of the json files in a directory
+        """
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def reload_state(self):
+        """
+        Load the state files that were added or changed since they were last loaded and drop the records of removed
+        ones. Return the number of records applied.
+        """
+        changes = 0
+        for kind, directory in self.directories():
+            apply, remove = getattr(self, "apply_" + kind), getattr(self, "remove_" + kind)
+            files = self.scan(directory)
+            for path, signature in sorted(files.items()):
+                loaded = self.loaded.get(path)
+                if loaded is not None and loaded[:2] == signature:
+                    continue
+                try:
+                    with open(path) as f:
+                        record = json.load(f)
+                    record_id = record[kind + "_id"]
+                    if apply(record_id, record["spec" if kind == "template" else "properties"]):
+                        changes += 1
+                except Exception as e:
+                    logger.error("Could not load %s: %s", path, e)
+                    continue
+                self.loaded[path] = signature + (record_id, )
+            for path in [path for path in self.loaded if path.startswith(directory + os.sep) and path not in files]:
+                record_id = self.loaded[path][2]
+                try:
+                    if remove(record_id):
+                        changes += 1
+                except Exception as e:
+                    logger.error("Could not remove %s %s: %s", kind, record_id, e)
+                    continue
+                del self.loaded[path]
+        return changes
+
+    def apply_machine(self, machine_id, properties):
+        master = self.master
+        machine_spec = master.machines.get(machine_id)
+        if machine_spec is not None and machine_spec.properties == properties:
+            return False
+        try:
+            machine_type = MachineSpec.get_type(properties)
+        except SpecError as e:
+            logger.warning("%s: %s", machine_id, e, extra={"machine_id": machine_id})
+            machine_type = None
+        running = machine_spec is not None and machine_spec.machine.get_status() != "stopped"
+        if machine_spec is not None and type(machine_spec.machine) is not machine_type:
+            if running:
+                logger.warning("Not changing the type of %s while it is running", machine_id,
+                               extra={"machine_id": machine_id})
+                return False
+            master.remove_machine(machine_id, write=False)
+            machine_spec = None
+
+        try:
+            master.allocators.reserve(machine_id, properties)
+        except SpecError as e:
+            logger.warning("%s: %s", machine_id, e, extra={"machine_id": machine_id})
+        master.allocators.save()
+        if machine_spec is None:
+            machine_spec = master.add_machine(machine_id, properties)
+            logger.info("Loaded new machine %s", machine_id, extra={"machine_id": machine_id})
+            if properties.get("autostart", False):
+                machine_spec.start()
+        else:
+            master.add_machine(machine_id, properties)
+            logger.info("Loaded changes to machine %s%s", machine_id,
+                        ", they take effect when it is next started" if running else "",
+                        extra={"machine_id": machine_id})
+        return True
+
+    def remove_machine(self, machine_id):
+        machine_spec = self.master.machines.get(machine_id)
+        if machine_spec is None:
+            return False
+        if machine_spec.machine.get_status() != "stopped":
+            logger.warning("The file of running machine %s was removed, it is kept until the daemon restarts",
+                           machine_id, extra={"machine_id": machine_id})
+            return False
+        self.master.remove_machine(machine_id, write=False)
+        logger.info("Removed machine %s", machine_id, extra={"machine_id": machine_id})
+        return True
+
+    def apply_disk(self, disk_id, properties):
+        master = self.master
+        disk = master.disks.get(disk_id)
+        if disk is not None:
+            if disk.serialize() == properties:
+                return False
+            users = self.master.disk_users(disk_id)
+            if users:
+                logger.warning("Not changing disk %s while it is used by %s", disk_id, ", ".join(users),
+                               extra={"disk_id": disk_id})
+                return False
+            del master.disks[disk_id]
+        try:
+            master.add_disk(disk_id, properties)
+        except Exception:
+            if disk is not None:
+                master.disks[disk_id] = disk
+            raise
+        for machine_spec in list(master.machines.values()):
+            machine_spec.machine.invalidate_plan()
+        logger.info("Loaded %s disk %s", "changed" if disk is not None else "new", disk_id, extra={"disk_id": disk_id})
+        return True
+
+    def remove_disk(self, disk_id):
+        if disk_id not in self.master.disks:
+            return False
+        users = self.master.disk_users(disk_id)
+        if users:
+            logger.warning("The file of disk %s was removed, it is kept while it is used by %s", disk_id,
+                           ", ".join(users), extra={"disk_id": disk_id})
+            return False
+        # The image is left in place, only the record is gone
+        self.master.remove_disk(disk_id, write=False, delete=False)
+        logger.info("Removed disk %s", disk_id, extra={"disk_id": disk_id})
+        return True
+
+    def apply_template(self, template_id, spec):
+        template = self.master.pool.templates.get(template_id)
+        if template is not None and template.spec == spec:
+            return False
+        self.master.pool.add_template(template_id, spec)
+        logger.info("Loaded template %s", template_id, extra={"template_id": template_id})
+        return True
+
+    def remove_template(self, template_id):
+        if template_id not in self.master.pool.templates:
+            return False
+        self.master.pool.remove_template(template_id, write=False)
+        logger.info("Removed template %s", template_id, extra={"template_id": template_id})
+        return True
@@ -0,0 +1,106 @@
+class SpecError(Exception):
+    pass
+
+
+class Field(object):
+    """
+    Describes one key of a machine spec
+    """
+    def __init__(self, *types, required=False, check=None, items=None, fields=None):
+        """
+        :param types: python types the value may be. Booleans are only accepted if bool is listed explicitly
+        :param required: raise if the key is missing
+        :param check: callable(master, value, path) raising SpecError if the value is unacceptable
+        :param items: Field describing each item, for list values
+        :param fields: dict of key -> Field describing each key, for dict values
+        """
+        self.types = types
+        self.required = required
+        self.check = check
+        self.items = items
+        self.fields = fields
+
+    def validate(self, master, value, path):
+        if not isinstance(value, self.types) or (isinstance(value, bool) and bool not in self.types):
+            raise SpecError("{} must be of type {}, not {}".format(path, " or ".join(t.__name__ for t in self.types),
+                                                                    type(value).__name__))
+        if self.fields is not None:
+            validate_fields(master, self.fields, value, path)
+        if self.items is not None:
+            for i, item in enumerate(value):
+                self.items.validate(master, item, "{}[{}]".format(path, i))
+        if self.check is not None:
+            self.check(master, value, path)
+
+
+def validate_fields(master, fields, values, path=None):
+    """
+    Validate a dict of values against a dict of Fields. Keys without a Field are allowed and not checked.
+    :param master: ZHypervisorDaemon reference, passed to checks that need to look up e.g. disks
+    :param path: name of the dict being checked, used in error messages
+    """
+    for name, field in fields.items():
+        field_path = "{}.{}".format(path, name) if path else name
+        if name not in values:
+            if field.required:
+                raise SpecError("{} is required".format(field_path))
+            continue
+        field.validate(master, values[name], field_path)
+
+
+def positive(master, value, path):
+    if value < 1:
+        raise SpecError("{} must be at least 1".format(path))
+
+
+def non_negative(master, value, path):
+    if value < 0:
+        raise SpecError("{} must not be negative".format(path))
+
+
+def disk_exists(master, value, path):
+    if value not in master.disks:
+        raise SpecError("{} references unknown disk: {}".format(path, value))
+
+
+def datastore_exists(master, value, path):
+    if value not in master.datastores:
+        raise SpecError("{} references unknown datastore: {}".format(path, value))
+
+
+def one_of(*choices):
+    def check(master, value, path):
+        if value not in choices:
+            raise SpecError("{} must be one of {}".format(path, ", ".join(str(c) for c in choices)))
+    return check
+
+
+def port_number(master, value, path):
+    if not 0 < value < 65536:
+        raise SpecError("{} must be a port number".format(path))
+
+
+def network_probe(master, value, path):
+    if value["type"] in ("tcp", "http") and "port" not in value:
+        raise SpecError("{}.port is required for {} probes".format(path, value["type"]))
+
+
+# Keys of a health probe, see zhypervisor.health
+PROBE_FIELDS = {"type": Field(str, required=True, check=one_of("tcp", "http", "qmp", "agent")),
+                "host": Field(str),
+                "port": Field(int, check=port_number),
+                "path": Field(str),
+                "interval": Field(int, float, check=positive),
+                "timeout": Field(int, float, check=positive),
+                "delay": Field(int, float, check=non_negative),
+                "failures": Field(int, check=positive),
+                "action": Field(str, check=one_of("restart", "none"))}
+
+# Keys understood for every machine type
+COMMON_FIELDS = {"type": Field(str, required=True),
+                 "autostart": Field(bool),
+                 "respawn": Field(bool),
+                 "shutdown_order": Field(int),
+                 "shutdown_timeout": Field(int, float, check=non_negative),
+                 "log_datastore": Field(str, check=datastore_exists),
+                 "probes": Field(list, items=Field(dict, fields=PROBE_FIELDS, check=network_probe))}
@@ -7,6 +7,9 @@ from subprocess import check_call
 from zhypervisor.logging import setup_logging
 
 
+logger = logging.getLogger(__name__)
+
+
 def main():
     """
     Helper script for dealing with QEMU network interfaces. When QEMU starts, it calls this script passing an interface
@@ -14,10 +17,10 @@ def main():
     """
     setup_logging()
     _, tap_name = sys.argv
-    logging.info("Enabling interface %s...", tap_name)
+    logger.info("Enabling interface %s...", tap_name)
     check_call(["brctl", "addif", "br0", tap_name])
     check_call(["ifconfig", tap_name, "up"])
-    logging.info("Enabled interface %s", tap_name)
+    logger.info("Enabled interface %s", tap_name)
 
 if __name__ == '__main__':
     main()
@@ -1,15 +1,35 @@
 
 import os
 import json
+import shutil
+import select
+import signal
+import logging
+import subprocess
+from time import time, sleep
 from random import randint
+from collections import namedtuple, deque
+from threading import Thread, Timer, Lock, RLock, Condition
+
+from zhypervisor.metrics import read_proc_stats
+from zhypervisor.schema import SpecError, validate_fields, COMMON_FIELDS
+
+
+logger = logging.getLogger(__name__)
+
+
+# Everything needed to launch a machine, compiled once from its validated spec. Tuples so it can't be modified.
+# helpers are the processes the machine's process needs running first, such as virtiofsd, as (socket path, argv) tuples.
+LaunchPlan = namedtuple("LaunchPlan", ["argv", "disks", "netifaces", "helpers"], defaults=[()])
 
 
 class TapDevice(object):
     """
     Utility class - adds/removes a tap device on the linux system. Can be used as a context manager.
+    :param num: number of the device, machines get theirs from zhypervisor.allocators. Random if not passed.
     """
-    def __init__(self):
-        self.num = randint(0, 100000)
+    def __init__(self, num=None):
+        self.num = randint(0, 100000) if num is None else num
 
     def create(self):
         os.system("ip tuntap add name {} mode tap".format(self))
@@ -28,37 +48,453 @@ class TapDevice(object):
         self.destroy()
 
 
+class MachineState(object):
+    """
+    Lifecycle states of a machine
+    """
+    STOPPED = "stopped"
+    STARTING = "starting"  # being spawned, or waiting to be respawned after an exit
+    RUNNING = "running"
+    STOPPING = "stopping"
+    CRASHLOOPING = "crashlooping"  # exited repeatedly, waiting for a delayed respawn
+
+
+TRANSITIONS = {MachineState.STOPPED: {MachineState.STARTING},
+               MachineState.STARTING: {MachineState.RUNNING, MachineState.STOPPED},
+               MachineState.RUNNING: {MachineState.STOPPING, MachineState.STOPPED, MachineState.STARTING,
+                                      MachineState.CRASHLOOPING},
+               MachineState.STOPPING: {MachineState.STOPPED},
+               MachineState.CRASHLOOPING: {MachineState.STARTING, MachineState.STOPPED}}
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+class PidHandle(object):
+    """
+    Popen-like handle for a process that is not our child, such as a guest left running by a previous instance of the
+    daemon. Provides the subset of the Popen interface the machine classes use.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+        self.pidfd = None
+        try:
+            self.pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pass  # Without pidfds, wait() falls back to polling
+
+    def _alive(self):
+        if self.pidfd is not None:
+            # A pidfd becomes readable once the process exits, even if it lingers as an unreaped zombie
+            poller = select.poll()
+            poller.register(self.pidfd, select.POLLIN)
+            return not poller.poll(0)
+        try:
+            with open("/proc/{}/stat".format(self.pid), "rb") as f:
+                stat = f.read()
+        except (FileNotFoundError, ProcessLookupError):
+            return False
+        return stat[stat.rindex(b")") + 2:stat.rindex(b")") + 3] != b"Z"
+
+    def poll(self):
+        if self.returncode is None and not self._alive():
+            # The exit status of a process that isn't our child can't be known
+            self.returncode = 0
+            if self.pidfd is not None:
+                os.close(self.pidfd)
+                self.pidfd = None
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while self.poll() is None:
+            remaining = None if deadline is None else deadline - time()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            if self.pidfd is not None:
+                poller = select.poll()
+                poller.register(self.pidfd, select.POLLIN)
+                poller.poll(None if remaining is None else remaining * 1000)
+            else:
+                sleep(0.5 if remaining is None else min(0.5, remaining))
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def read_cmdline(pid):
+    """
+    Return the argv of a running process or None if there is no such process
+    """
+    try:
+        with open("/proc/{}/cmdline".format(pid), "rb") as f:
+            return [arg.decode("UTF-8", errors="replace") for arg in f.read().split(b"\0") if arg]
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+
+def scope_args(unit_name):
+    """
+    Return the argv prefix that runs a command in its own systemd scope, so that stopping the daemon's service does not
+    take the command down with it. Returns an empty list on systems without systemd.
+    """
+    if not shutil.which("systemd-run") or not os.path.isdir("/run/systemd/system"):
+        return []
+    return ["systemd-run", "--scope", "--quiet", "--collect", "--unit", unit_name]
+
+
 class Machine(object):
     """
     All runnable types should subclass this
     """
+    schema = COMMON_FIELDS  # Mapping of spec key -> zhypervisor.schema.Field
+    respawn_delay = 1  # seconds to wait before respawning a machine that exited
+    crashloop_threshold = 5  # exits within crashloop_window after which a machine is considered crashlooping
+    crashloop_window = 60
+    max_backoff = 60  # longest delay between respawns of a crashlooping machine
+    probe_types = ("tcp", "http")  # types of health probe the machine supports, see zhypervisor.health
+    running_on_spawn = True  # the guest counts as running once its process is spawned, else record_boot() is called
+
     def __init__(self, machine_spec):
         self.spec = machine_spec
+        # Logs under the module of the machine type, tagged with the machine's id
+        self.log = logging.LoggerAdapter(logging.getLogger(type(self).__module__),
+                                         {"machine_id": machine_spec.machine_id})
+        self.plan = None
+        self.proc = None
+        self.block_respawns = False
+        self.state = MachineState.STOPPED
+        # Operations on this machine (start, stop, restart...) hold the operation lock for their whole duration so they
+        # are applied in order. State and proc are guarded by the state lock, which is only ever held briefly.
+        self.lock = RLock()
+        self.state_lock = Lock()
+        self.changed = Condition(self.state_lock)  # Notified on every state transition
+        self.exits = deque(maxlen=self.crashloop_threshold)  # Times of recent unexpected exits
+        self.backoff = 0  # Current respawn delay of a crashlooping machine
+        self.respawn_timer = None
+        self.boot = None  # Timings of the current process's boot, see begin_boot()
 
-    def start_machine(self):
+    @classmethod
+    def validate_spec(cls, master, properties):
+        """
+        Raise SpecError if the machine properties are not valid for this type of machine
+        """
+        validate_fields(master, cls.schema, properties)
+        for i, probe in enumerate(properties.get("probes", [])):
+            if probe["type"] not in cls.probe_types:
+                raise SpecError("probes[{}]: {} probes are not supported by {} machines".format(i, probe["type"],
+                                                                                              cls.machine_type))
+
+    def get_plan(self):
+        """
+        Return the machine's LaunchPlan, compiling it if the properties have changed since it was last used
+        """
+        plan = self.plan
+        if plan is None:
+            self.validate_spec(self.spec.master, self.spec.properties)
+            plan = self.plan = self.compile_plan()
+        return plan
+
+    def compile_plan(self):
         """
-        Run the machine and block until it exits (or was killed)
+        Build the LaunchPlan from the machine's (already validated) properties
         """
         raise NotImplemented()
 
+    def invalidate_plan(self):
+        self.plan = None
+
+    def get_status(self):
+        """
+        Get the machine's lifecycle state, one of the MachineState constants
+        """
+        return self.state
+
+    def transition(self, state):
+        """
+        Move the machine to a new lifecycle state. Must be called with the state lock held.
+        """
+        if state not in TRANSITIONS[self.state]:
+            raise InvalidTransition("{}: cannot go from {} to {}".format(self.spec.machine_id, self.state, state))
+        self.log.debug("%s: %s -> %s", self.spec.machine_id, self.state, state)
+        self.state = state
+        self.changed.notify_all()
+
+    def start_machine(self):
+        """
+        Launch the machine and return once its process has been spawned
+        """
+        with self.lock:
+            with self.state_lock:
+                if self.state not in (MachineState.STOPPED, MachineState.CRASHLOOPING):
+                    raise InvalidTransition("Machine already running!")
+                self.cancel_respawn()
+                self.block_respawns = False
+                self.exits.clear()
+                self.backoff = 0
+                self.transition(MachineState.STARTING)
+            self.launch()
+
+    def launch(self, kind="start"):
+        """
+        Spawn the machine's process. Called with the operation lock held and the machine in the starting state. If the
+        machine is powered down while its process is being spawned, the new process is killed.
+        :param kind: why the machine is launched, start or respawn, recorded with the boot's timings
+        """
+        self.begin_boot(kind)
+        try:
+            with self.spec.master.stats.timer("zd_lifecycle_seconds", phase="build_args", type=self.machine_type):
+                plan = self.get_plan()
+            proc = self.spawn(plan)
+        except:
+            with self.state_lock:
+                self.transition(MachineState.STOPPED)
+            raise
+        with self.state_lock:
+            self.proc = proc
+            self.transition(MachineState.RUNNING)
+            stopped = self.block_respawns  # set by begin_stop() while the process was spawned
+            if stopped:
+                self.transition(MachineState.STOPPING)
+        Thread(target=self.wait_on_exit, args=[proc], daemon=True).start()
+        if stopped:
+            self.log.warning("%s was stopped while starting, killing it", self.spec.machine_id)
+            self.send_kill(proc)
+            return
+        self.spec.master.health.watch(self.spec, proc)
+        if self.running_on_spawn:
+            self.record_boot("running")
+
+    def begin_boot(self, kind):
+        """
+        Start timing the boot of a new process of the machine
+        :param kind: how the machine was brought up: start, respawn, warm for claimed warm instances or migrate
+        """
+        self.boot = {"kind": kind, "started": time(), "running_seconds": None, "probe_seconds": None}
+
+    def record_boot(self, milestone):
+        """
+        Record how long after its launch the current process first reached a milestone of its boot: running, once the
+        guest executes, or probe, once one of its health probes first succeeds. Later calls for the same milestone are
+        ignored.
+        """
+        boot = self.boot
+        key = milestone + "_seconds"
+        if boot is None or boot[key] is not None:
+            return
+        boot[key] = time() - boot["started"]
+        self.spec.master.stats.observe("zd_boot_seconds", boot[key], milestone=milestone, kind=boot["kind"],
+                                       type=self.machine_type)
+
+    def wait_on_exit(self, proc):
+        """
+        Listener started for each process of the machine. Once the process exits, move to the stopped state or, if
+        the exit was unexpected and the machine should respawn, schedule a respawn. Machines that keep exiting are
+        moved to the crashlooping state and respawned with exponential backoff.
+        """
+        proc.wait()
+        with self.state_lock:
+            if self.proc is not proc:
+                return
+            self.log.info("%s process has exited", self.spec.machine_id)
+            self.proc = None
+            self.cleanup()
+            if self.state == MachineState.STOPPING or self.block_respawns or \
+                    not self.spec.properties.get("respawn", False):
+                self.transition(MachineState.STOPPED)
+                return
+
+            now = time()
+            self.exits.append(now)
+            if len(self.exits) == self.crashloop_threshold and now - self.exits[0] < self.crashloop_window:
+                self.backoff = min(max(self.backoff * 2, self.respawn_delay * 2), self.max_backoff)
+                delay = self.backoff
+                self.log.warning("%s is crashlooping, respawning in %ss", self.spec.machine_id, delay)
+                self.transition(MachineState.CRASHLOOPING)
+            else:
+                self.backoff = 0
+                delay = self.respawn_delay  # anti-spin
+                self.transition(MachineState.STARTING)
+            timer = Timer(delay, self.respawn)
+            timer.args = [timer]
+            timer.daemon = True
+            self.respawn_timer = timer
+            timer.start()
+
+    def respawn(self, timer):
+        """
+        Relaunch the machine after an unexpected exit, unless the respawn was cancelled meanwhile
+        """
+        with self.lock:
+            with self.state_lock:
+                if self.respawn_timer is not timer:
+                    return
+                self.respawn_timer = None
+                if self.state == MachineState.CRASHLOOPING:
+                    self.transition(MachineState.STARTING)
+            try:
+                self.launch("respawn")
+            except Exception:
+                self.log.exception("Could not respawn %s", self.spec.machine_id)
+
+    def cancel_respawn(self):
+        """
+        Cancel a pending respawn. Must be called with the state lock held.
+        """
+        if self.respawn_timer is not None:
+            self.respawn_timer.cancel()
+            self.respawn_timer = None
+
     def stop_machine(self):
         """
-        Ask the machine to stop nicely
+        Ask the machine to stop nicely and wait until it has
         """
-        raise NotImplemented()
+        with self.lock:
+            stats = self.spec.master.stats
+            with stats.timer("zd_lifecycle_seconds", phase="stop", type=self.machine_type):
+                self.powerdown()
+                self.wait_stopped()
+
+    def begin_stop(self):
+        """
+        Block respawns and move the machine towards the stopped state. Return the process that must be stopped, or
+        None if nothing is running.
+        """
+        with self.state_lock:
+            self.block_respawns = True
+            proc = self.proc
+            if proc is None:
+                # Nothing is running, but a respawn may be pending. A machine starting without one is being launched
+                # right now, and launch() stops the new process itself once it is spawned.
+                if self.state == MachineState.CRASHLOOPING or \
+                        (self.state == MachineState.STARTING and self.respawn_timer is not None):
+                    self.cancel_respawn()
+                    self.transition(MachineState.STOPPED)
+            elif self.state == MachineState.RUNNING:
+                self.transition(MachineState.STOPPING)
+            return proc
+
+    def powerdown(self):
+        """
+        Ask the machine to stop nicely, without waiting for it to do so. Does not take the operation lock, so the
+        daemon can broadcast powerdown to every machine at once.
+        """
+        proc = self.begin_stop()
+        if proc is not None:
+            self.log.info("stopping machine %s", self.spec.machine_id)
+            self.send_powerdown(proc)
+
+    def wait_stopped(self, timeout=None):
+        """
+        Wait for the machine to reach the stopped state. Return True if it has stopped or False if the timeout passed
+        first.
+        """
+        with self.state_lock:
+            return self.changed.wait_for(lambda: self.state == MachineState.STOPPED, timeout)
 
     def kill_machine(self):
         """
-        Stop the machine, brutally
+        Stop the machine, brutally, and wait until it has stopped
+        """
+        with self.lock:
+            proc = self.begin_stop()
+            if proc is not None:
+                self.log.warning("Killing machine %s", self.spec.machine_id)
+                self.send_kill(proc)
+                self.wait_stopped()
+
+    def adopt(self, proc):
+        """
+        Take over supervision of an already running process, e.g. one found by reattach()
+        """
+        with self.lock:
+            with self.state_lock:
+                self.transition(MachineState.STARTING)
+                self.proc = proc
+                self.transition(MachineState.RUNNING)
+            Thread(target=self.wait_on_exit, args=[proc], daemon=True).start()
+            self.spec.master.health.watch(self.spec, proc)
+
+    def release(self):
+        """
+        Give up supervision of the running process without stopping it and return it, e.g. to hand it over to another
+        machine with adopt(). The machine is left in the stopped state.
+        """
+        with self.lock:
+            with self.state_lock:
+                if self.state != MachineState.RUNNING:
+                    raise InvalidTransition("{}: cannot release a machine that is {}".format(self.spec.machine_id,
+                                                                                             self.state))
+                proc = self.proc
+                self.proc = None  # the exit listener ignores processes that are no longer ours
+                self.block_respawns = True
+                self.transition(MachineState.STOPPED)
+            return proc
+
+    def spawn(self, plan):
+        """
+        Launch the machine's process from its LaunchPlan and return a Popen-like handle for it
         """
         raise NotImplemented()
 
-    def get_status(self):
+    def cleanup(self):
+        """
+        Release resources held for a process that has exited. Called with the state lock held.
         """
-        Get the machine's status (return one of "running" or "stopped")
+        pass
+
+    def send_powerdown(self, proc):
+        """
+        Deliver the powerdown request to the machine's process
         """
         raise NotImplemented()
 
+    def send_kill(self, proc):
+        """
+        Forcefully terminate the machine's process
+        """
+        proc.kill()
+
+    def reattach(self):
+        """
+        Look for a running instance of this machine left behind by a previous daemon and, if one is found, take over
+        supervision of it. Return True if the machine was reattached.
+        """
+        return False
+
+    def is_detached(self):
+        """
+        Return True if the machine should outlive the daemon
+        """
+        return self.spec.master.config.get("detach", False)
+
+    def get_pid(self):
+        """
+        Return the pid of the machine's process or None if it is not running
+        """
+        proc = self.proc
+        return proc.pid if proc else None
+
+    def get_stats(self):
+        """
+        Return a dict of resource usage counters, see zhypervisor.metrics.FIELDS. By default, cpu and memory use of the
+        machine's process is reported.
+        """
+        pid = self.get_pid()
+        if pid is None:
+            return {}
+        return read_proc_stats(pid)
+
     def get_datastore_path(self, datastore_name, *paths):
         """
         Resolve the filesystem path for a path in the given datastore